@@ -1,44 +1,30 @@
 import PySimpleGUI as sg
-import os.path
-from zipfile import ZipFile
-from tempfile import TemporaryDirectory
-from serial_tools import get_com_ports
-from serial_tools import port_is_avaiable
-import esptool
-import pyboard
+from serial_tools import is_usb_uart
+import device_profiles
 import os
-import pyb_files
-from pyb_files import DirectoryExistsError
-import pathlib
+import queue
 import sys
-import time
-from simple_timer import SimpleTimer
-from pyboard import PyboardError
+import threading
+from port_watcher import PortWatcher
+from provisioning import AutoProvisioner
+from provisioning import BAUD_RATES
+from provisioning import CHIPS
+from provisioning import EVENT_DONE
+from provisioning import EVENT_LOG
+from provisioning import EVENT_RESULT
+from provisioning import FLASH_OFFSETS
+from provisioning import InstallOptions
+from provisioning import METRICS_FILE
+from provisioning import ProgressEvent
+from provisioning import ProvisioningError
+from provisioning import ProvisioningWorker
 
 APP_NAME = "ESP MicroPython Setup Utility (v1.0.8)"
 
-CHIPS = [
-    "esp8266",
-    "esp32",
-    "esp32s2",
-    "esp32s3beta2",
-    "esp32s3",
-    "esp32c3",
-    "esp32c6beta",
-    "esp32h2beta1",
-    "esp32h2beta2",
-    "esp32c2",
-    "esp32c6",
-]
-
-BAUD_RATES = [9600, 19200, 28800, 38400, 57600, 115200, 230400, 460800, 576000, 921600]
-
 COMMON_COM_CHIP_SAFE_BAUD_RATES = {
     "ch340": 921600,
 }
 
-FLASH_OFFSETS = ["0x0", "0x1000"]
-
 # This has to do with how pyinstaller links files
 if hasattr(sys, "_MEIPASS"):
     app_icon = sys._MEIPASS + "/logo.ico"
@@ -48,24 +34,55 @@ else:
 
 sg.theme("SystemDefault")
 
-com_ports_available = list()
-default_com_port = None
+
+def port_choices(ports):
+    """Combo entries for a {device: ListPortInfo} table, and the one to preselect."""
+    choices = [
+        f"{device}{(5 - len(device)) * ' '} : {info.description}"
+        for device, info in sorted(ports.items())
+    ]
+    for choice in choices:
+        if is_usb_uart(choice):
+            return choices, choice
+    return choices, (choices[0] if choices else None)
+
+
+# The port list follows boards being plugged in and out while the app runs.
+ports_changed = threading.Event()
+port_watcher = PortWatcher(
+    on_attach=lambda info: ports_changed.set(),
+    on_detach=lambda info: ports_changed.set(),
+).start()
+com_ports_available, default_com_port = port_choices(port_watcher.ports())
 default_baud_rate = None
-for com_port_entry in get_com_ports():
-    com_ports_available.append(
-        f"{com_port_entry[0]}{(5 - len(com_port_entry[0])) * ' '} : {com_port_entry[1]}"
-    )
-for port in com_ports_available:
-    if "CH340" in port.upper():
-        default_com_port = port
-        default_baud_rate = 921600
-        break
-    elif "CP210" in port.upper():
-        default_com_port = port
-        default_baud_rate = 921600
-        break
-    else:
-        default_com_port = com_ports_available[0]
+if default_com_port is not None and is_usb_uart(default_com_port):
+    default_baud_rate = 921600
+
+profiles = device_profiles.ProfileCache()
+
+
+def port_profile(choice):
+    """The cached profile of the adapter behind a port list entry."""
+    if not choice:
+        return dict()
+    return profiles.get(device_profiles.adapter_key(choice.split(":")[0].strip()))
+
+
+def profile_defaults(profile):
+    """Chip, baud rate and flash offset to preselect for an adapter's profile."""
+    chip = profile.get("chip") if profile.get("chip") in CHIPS else CHIPS[0]
+    baud_rate = profile.get("flash_baud")
+    if baud_rate not in BAUD_RATES:
+        baud_rate = default_baud_rate or 115200
+    flash_offset = profile.get("flash_offset")
+    if flash_offset not in FLASH_OFFSETS:
+        flash_offset = "0x0"
+    return chip, baud_rate, flash_offset
+
+
+default_chip, default_baud_rate, default_flash_offset = profile_defaults(
+    port_profile(default_com_port)
+)
 
 
 layout = [
@@ -77,6 +94,7 @@ layout = [
             font=("Courier New", 10),
             size=(60, 1),
             key="port",
+            enable_events=True,
         )
     ],
     [sg.Text("Firmware Image", font=("Courier New", 12))],
@@ -101,21 +119,21 @@ layout = [
     [
         sg.Combo(
             CHIPS,
-            default_value=CHIPS[0],
+            default_value=default_chip,
             font=("Courier New", 10),
             size=(14, 1),
             key="chip",
         ),
         sg.Combo(
             BAUD_RATES,
-            default_value=default_baud_rate or 115200,
+            default_value=default_baud_rate,
             font=("Courier New", 10),
             size=(14, 1),
             key="baud_rate",
         ),
         sg.Combo(
             FLASH_OFFSETS,
-            default_value="0x0",
+            default_value=default_flash_offset,
             font=("Courier New", 10),
             size=(14, 1),
             key="flash_offset",
@@ -126,6 +144,49 @@ layout = [
             "Software upload only (skip erase & flash)", default=False, key="skip"
         )
     ],
+    [
+        sg.Checkbox(
+            "Negotiate fastest baud rates (remembered per USB adapter)",
+            default=False,
+            key="negotiate_baud",
+        )
+    ],
+    [
+        sg.Checkbox(
+            "Install on all connected CH340/CP210x devices at once",
+            default=False,
+            key="all_ports",
+        )
+    ],
+    [
+        sg.Checkbox(
+            "Keep installing on every CH340/CP210x device plugged in",
+            default=False,
+            key="auto_install",
+        )
+    ],
+    [
+        sg.Checkbox("Only upload changed files", default=False, key="sync"),
+        sg.Checkbox("Delete files not in package", default=False, key="delete_stale"),
+    ],
+    [
+        sg.Checkbox("Compress uploads", default=True, key="compress"),
+        sg.Checkbox("Precompile .py files (mpy-cross)", default=False, key="precompile"),
+    ],
+    [
+        sg.Checkbox(
+            "Verify uploaded files on the device (hash check)",
+            default=True,
+            key="verify",
+        )
+    ],
+    [
+        sg.Checkbox(
+            "Install software package as a filesystem image (ESP32 family only)",
+            default=False,
+            key="fs_image",
+        )
+    ],
     [
         sg.Button("Install", font=("Courier New", 12), size=(10, 3)),
         sg.Multiline(
@@ -141,233 +202,150 @@ layout = [
 
 window = sg.Window(APP_NAME, icon=app_icon).Layout(layout)
 
+def gui_log(message):
+    print(message)
+    window["output"].update(message, append=True)
+    window.refresh()
+
+
+def refresh_ports(selected):
+    """Update the port list from the watcher, keeping `selected` if it's still there."""
+    choices, default = port_choices(port_watcher.ports())
+    window["port"].update(
+        value=selected if selected in choices else default, values=choices
+    )
+
+
+def select_port(choice):
+    """Preselect what worked last time on the adapter behind `choice`."""
+    profile = port_profile(choice)
+    chip, baud_rate, flash_offset = profile_defaults(profile)
+    window["chip"].update(value=chip)
+    window["baud_rate"].update(value=baud_rate)
+    window["flash_offset"].update(value=flash_offset)
+    if profile.get("mac"):
+        gui_log(f"Last seen on this adapter: {device_profiles.describe(profile)}.\n")
+
+
+def handle_progress_events():
+    """Show the worker's progress events, returns True once it is done."""
+    done = False
+    while True:
+        try:
+            progress = events.get_nowait()
+        except queue.Empty:
+            return done
+        if progress.kind == EVENT_LOG:
+            gui_log(progress.message)
+        elif progress.kind == EVENT_RESULT:
+            print(repr(progress.result))
+            if auto_provisioner is not None:
+                gui_log(f"{progress.result!r}\n")
+        elif progress.kind == EVENT_DONE:
+            done = True
+
+
+events = queue.Queue()
+worker = None
+auto_provisioner = None
+
 while True:
     try:
-        event, values = window.read()
-        if event == "Install":
+        # Poll so progress from the background worker keeps flowing in.
+        event, values = window.read(timeout=100)
+        if ports_changed.is_set() and values:
+            ports_changed.clear()
+            refresh_ports(values["port"])
+        if worker is not None and handle_progress_events():
+            worker = None
+            window["Install"].update(disabled=False)
+        if auto_provisioner is not None:
+            handle_progress_events()
+        if event == "port":
+            select_port(values["port"])
+        if event == "Install" and auto_provisioner is not None:
+            gui_log("Stopping, waiting for running installs to finish.\n")
+            auto_provisioner.stop()
+            auto_provisioner = None
+            handle_progress_events()
+            window["Install"].update(text="Install")
+        elif event == "Install" and worker is None:
             output_text = ""
             window["output"].update(output_text)
             port = values["port"].split(":")[0].strip()
             firmware = values["firmware"].replace("'", "").replace('"', "")
             software = values["software"].replace("'", "").replace('"', "")
-            if not port:
-                print("ERROR: missing port.\n")
-                window["output"].update("ERROR: missing port.\n", append=True)
-                window.refresh()
-                continue
-
-            if not port_is_avaiable(port):
-                window["output"].update("ERROR: port is unavailable.\n", append=True)
-                window["output"].update(
-                    "(port is already in use or device is no longer connected)\n",
-                    append=True,
+            if str(values["baud_rate"]) in str(BAUD_RATES):
+                baud_rate = values["baud_rate"]
+            else:
+                baud_rate = 115200
+            options = InstallOptions(
+                firmware=firmware,
+                software=software,
+                chip=values["chip"],
+                baud_rate=baud_rate,
+                flash_offset=values["flash_offset"],
+                skip_flash=values["skip"],
+                sync=values["sync"],
+                delete_stale=values["delete_stale"],
+                fs_image=values["fs_image"],
+                transport="pipeline",
+                compress=values["compress"],
+                precompile=values["precompile"],
+                negotiate_baud=values["negotiate_baud"],
+                verify=values["verify"],
+                resume=True,
+                metrics_file=os.path.join("logs", METRICS_FILE),
+            )
+
+            if values["auto_install"]:
+                try:
+                    options.validate()
+                except ProvisioningError as e:
+                    gui_log(f"ERROR: {e}\n")
+                    continue
+                auto_provisioner = AutoProvisioner(
+                    options,
+                    on_log=lambda port, message: events.put(
+                        ProgressEvent(EVENT_LOG, port=port, message=message)
+                    ),
+                    on_result=lambda result: events.put(
+                        ProgressEvent(EVENT_RESULT, port=result.port, result=result)
+                    ),
+                    on_attach=lambda info: events.put(
+                        ProgressEvent(EVENT_LOG, message=f"New board on {info.device}.\n")
+                    ),
                 )
-                window.refresh()
-                continue
-
-            if not firmware and not values["skip"]:
-                print("ERROR: missing firmware image.\n")
-                window["output"].update("ERROR: missing firmware image.\n", append=True)
+                auto_provisioner.start()
+                window["Install"].update(text="Stop")
+                gui_log("Waiting for boards to be plugged in.\n")
                 continue
 
-            window.Hide()
-
-            total_timer = SimpleTimer()
-            total_timer.start()
-            timer = SimpleTimer()
-
-            if not values["skip"]:
-                print("Erasing Flash.\n")
-                window["output"].update("Erasing Flash.\n", append=True)
-                window.refresh()
-                if str(values["baud_rate"]) in str(BAUD_RATES):
-                    baud_rate = values["baud_rate"]
-                else:
-                    baud_rate = 115200
-                esptool_command = [
-                    "--baud",
-                    f"{ baud_rate }",
-                    "--port",
-                    port,
-                    "erase_flash",
+            if values["all_ports"]:
+                ports = [
+                    device
+                    for device, info in sorted(port_watcher.ports().items())
+                    if is_usb_uart(info.description)
                 ]
+                if not ports:
+                    gui_log("ERROR: no CH340/CP210x devices found.\n")
+                    continue
+                gui_log(f"Provisioning {len(ports)} devices.\n")
+            elif not port:
+                gui_log("ERROR: missing port.\n")
+                continue
+            else:
+                ports = [port]
 
-                timer = SimpleTimer()
-                timer.start()
-                esptool.main(esptool_command)
-                print(f"\nFlash erased in: {(timer.end_with_results()):.1f}s\n")
-                print("ERASE FIRMWARE SUCCESSFUL!\n\n")
-                window["output"].update("ERASE FIRMWARE SUCCESSFUL!\n\n", append=True)
-                window.refresh()
-                print("Flashing NEW firmware.\n")
-                window["output"].update("Flashing NEW firmware.\n", append=True)
-                window.refresh()
-                flash_offset = values["flash_offset"]
-                if str(values["chip"]).lower() == "esp8266":
-                    chip = "esp8266"
-                    esptool_command = [
-                        "--baud",
-                        f"{baud_rate}",
-                        "--port",
-                        port,
-                        "--chip",
-                        f"{chip}",
-                        "write_flash",
-                        "--flash_mode",
-                        "dout",
-                        "--flash_size",
-                        "detect",
-                        f"{flash_offset}",
-                        firmware,
-                    ]
-                else:
-                    chip = str(values["chip"]).lower()
-                    esptool_command = [
-                        "--baud",
-                        f"{baud_rate}",
-                        "--port",
-                        port,
-                        "--chip",
-                        f"{chip}",
-                        "write_flash",
-                        "-z",
-                        f"{flash_offset}",
-                        firmware,
-                    ]
-
-                timer.start()
-                print(*esptool_command)
-                esptool.main(esptool_command)
-                print(f"\nFirmware flashed in: {(timer.end_with_results()):.1f}s\n")
-                print("FIRMWARE FLASH SUCCESSFUL!\n\n")
-                window["output"].update("FIRMWARE FLASH SUCCESSFUL!\n\n", append=True)
-                window.refresh()
-
-            print("Uploading software package.\n")
-            window["output"].update("Uploading software package.\n", append=True)
-
-            if not software:
-                print("WARNING: missing software package!\n")
-                window["output"].update(
-                    "WARNING: missing software package!\n", append=True
-                )
-                window.refresh()
-                window.UnHide()
+            try:
+                options.validate()
+            except ProvisioningError as e:
+                gui_log(f"ERROR: {e}\n")
                 continue
 
-            if "esp32c3" in chip.lower():
-                print(
-                    f"\n\n{'#' * 80}\nWARNING: esp32c3 chip detected, unable to force reboot, but reboot/reset required!"
-                )
-                print(
-                    "\nPlease press the reset button, or unplug and replug device and then\nhit ENTER to continue with software upload."
-                )
-                input()
-
-            zf = ZipFile(software)
-            timer.start()
-            with TemporaryDirectory() as tempdir:
-                zf.extractall(tempdir)
-                pyb = pyboard.Pyboard(port, 115200)
-                directories_to_make = ["."]
-                files_and_data_to_bulk_write = dict()
-
-                print("Generating directories list.\n")
-                window["output"].update("Generating directories list.\n", append=True)
-                try:
-                    for path, currentDirectory, files in os.walk(tempdir):
-                        for file in files:
-                            dir = path.replace(tempdir, "")
-                            new_path = pathlib.Path(dir).as_posix()
-                            fh = pyb_files.Files(pyb)
-                            if new_path not in directories_to_make:
-                                try:
-                                    directories = new_path.split("/")
-                                    path_part = ""
-                                    for d in directories[1::]:
-                                        path_part += "/" + d
-                                        if path_part in directories_to_make:
-                                            continue
-                                        window["output"].update(
-                                            f"{path_part}\n", append=True
-                                        )
-                                        window.refresh()
-                                        print(path_part)
-                                        directories_to_make.append(path_part)
-                                except DirectoryExistsError:
-                                    pass
-                                except Exception as e:
-                                    print(e)
-                            with open(os.path.join(path, file), "rb") as f:
-                                data = f.read()
-                            new_file_name = pathlib.Path(
-                                os.path.join(dir, file)
-                            ).as_posix()
-                            files_and_data_to_bulk_write[str(new_file_name)] = data
-
-                    window.refresh()
-                    print(f"\nCreating and/or verifying directories.\n")
-                    window["output"].update(
-                        f"\nCreating and/or verifying directories.\n", append=True
-                    )
-                    window.refresh()
-
-                    fh.mkdir(directory_list=directories_to_make)
-
-                    print(f"\nUploading Files.\n")
-                    window["output"].update(f"\nUploading Files.\n", append=True)
-                    window.refresh()
-
-                    fh.put(
-                        files_and_data_to_bulk_write
-                    )  # We don't need to enter raw because we will still be in raw repl from folder creation.
-                    print(
-                        f"\nSoftware package uploaded in: {(timer.end_with_results()):.1f}s"
-                    )
-                    window["output"].update(
-                        "SOFTWARE PACKAGE UPLOAD SUCCESSFUL!\n", append=True
-                    )
-                    window.refresh()
-                    total_timer_result = total_timer.end_with_results()
-                    print(
-                        f"Total time: {total_timer_result:.1f}s   ({total_timer_result/60:.1f}m)\n"
-                    )
-                    pyb.soft_reset()
-                    pyb.close()
-                except PyboardError:
-                    print("\n\nERROR: something went wrong talking to the device.")
-                    print("(It is recommended to unplug the device and plug in again.)")
-                    window["output"].update(
-                        "ERROR: something went wrong talking to the device.\n",
-                        append=True,
-                    )
-                    window["output"].update(
-                        "Unplug device and plug in and try again.)\n", append=True
-                    )
-                    window.refresh()
-                    pyb.close()
-                    continue
-                except KeyboardInterrupt:
-                    print(
-                        "\n\nERROR: user forcefully bailed, file system may be corrupt due to partial software upload.\n"
-                    )
-                    window["output"].update(
-                        "ERROR: user forcefully bailed, file system may be corrupt due to partial software upload.\n",
-                        append=True,
-                    )
-                    window.refresh()
-                    pyb.close()
-                    continue
-                except Exception as e:
-                    print("\n\nERROR: something went wrong...\n")
-                    window["output"].update(
-                        "ERROR: something went wrong...\n", append=True
-                    )
-                    window.refresh()
-                    pyb.close()
-                    continue
-                finally:
-                    window.UnHide()
+            window["Install"].update(disabled=True)
+            worker = ProvisioningWorker(ports, options, events)
+            worker.start()
 
     except Exception as e:
         window["output"].update(f"{e}\n", append=True)
@@ -382,8 +360,9 @@ while True:
                 i = str(i)
                 crash_log.write(i)
 
-    window.UnHide()
-
     if event == sg.WIN_CLOSED:
         break
+if auto_provisioner is not None:
+    auto_provisioner.stop()
+port_watcher.stop()
 window.close()
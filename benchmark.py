@@ -0,0 +1,207 @@
+"""
+Transfer benchmarks for pyboard.Pyboard and pyb_files.Files.
+
+Runs against sim_board.SimulatedBoard, so it needs no hardware but only runs
+on Linux. Every measurement gets a fresh board limited to the given baud rate,
+latency, RX buffer and flash write speed, and reports handshake latency,
+throughput and round trips per file for a few representative packages and
+every transport.
+
+    python benchmark.py
+    python benchmark.py --baud 921600 --latency 0.004 --json results.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import time
+
+import pyboard
+import pyb_files
+from sim_board import SimulatedBoard
+from software_package import PackageFile
+from software_package import parent_directories
+
+HANDSHAKE_REPEAT = 5
+PACKAGE_SIZE = 48 * 1024
+
+# (transport, compress) combinations measured for every package.
+TRANSFERS = [
+    ("exec", False),
+    ("exec", True),
+    ("agent", False),
+    ("agent", True),
+    ("pipeline", False),
+    ("pipeline", True),
+]
+
+
+def source_package(size=PACKAGE_SIZE):
+    """This repository's own .py files, a stand-in for a typical package."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    files = list()
+    total = 0
+    for name in sorted(os.listdir(here)):
+        if not name.endswith(".py") or total >= size:
+            continue
+        with open(os.path.join(here, name), "rb") as f:
+            data = f.read()[: size - total]
+        files.append(PackageFile.from_bytes("/lib/" + name, data))
+        total += len(data)
+    return files
+
+
+def small_files_package(size=PACKAGE_SIZE, file_size=512):
+    """Many small text files, where per-file overhead dominates."""
+    text = b"".join(entry.read() for entry in source_package(size))
+    return [
+        PackageFile.from_bytes(f"/small/file_{i:03}.py", text[offset : offset + file_size])
+        for i, offset in enumerate(range(0, len(text), file_size))
+    ]
+
+
+def binary_package(size=PACKAGE_SIZE):
+    """Incompressible data, like images or precompiled modules."""
+    rng = random.Random(0)
+    half = size // 2
+    return [
+        PackageFile.from_bytes(f"/data/blob_{i}.bin", rng.randbytes(half))
+        for i in range(2)
+    ]
+
+
+PACKAGES = {
+    "sources": source_package,
+    "small files": small_files_package,
+    "binary": binary_package,
+}
+
+
+def measure_handshake(board_kwargs, baudrate, repeat=HANDSHAKE_REPEAT):
+    """Time entering the raw REPL and a minimal exec round trip, in ms."""
+    with SimulatedBoard(**board_kwargs) as board:
+        pyb = pyboard.Pyboard(board.port, baudrate)
+        try:
+            enter = list()
+            for _ in range(repeat):
+                start = time.perf_counter()
+                pyb.enter_raw_repl()
+                enter.append(time.perf_counter() - start)
+                pyb.exit_raw_repl()
+            pyb.enter_raw_repl(reuse=True)
+            round_trip = list()
+            for _ in range(repeat):
+                start = time.perf_counter()
+                pyb.eval("1")
+                round_trip.append(time.perf_counter() - start)
+        finally:
+            pyb.close()
+    return {
+        "enter_raw_repl_ms": 1000 * sum(enter) / len(enter),
+        "exec_round_trip_ms": 1000 * sum(round_trip) / len(round_trip),
+    }
+
+
+def measure_upload(board_kwargs, baudrate, files, transport, compress):
+    """Upload `files` to a fresh board and report what it took."""
+    with SimulatedBoard(**board_kwargs) as board:
+        pyb = pyboard.Pyboard(board.port, baudrate)
+        try:
+            pyb.enter_raw_repl()
+            fh = pyb_files.Files(pyb, keep_raw_repl=True)
+            with contextlib.redirect_stdout(io.StringIO()):
+                fh.mkdir(directory_list=parent_directories(e.path for e in files))
+                before = board.counters()
+                start = time.perf_counter()
+                fh.put(files, transport=transport, compress=compress)
+                elapsed = time.perf_counter() - start
+            after = board.counters()
+        finally:
+            pyb.close()
+        for entry in files:
+            with open(os.path.join(board.root, entry.path.lstrip("/")), "rb") as f:
+                if f.read() != entry.read():
+                    raise AssertionError(f"{entry.path} arrived corrupted")
+    payload = sum(entry.size for entry in files)
+    return {
+        "transport": transport,
+        "compress": compress,
+        "files": len(files),
+        "payload_bytes": payload,
+        "wire_bytes": after["bytes_received"] - before["bytes_received"],
+        "seconds": elapsed,
+        "bytes_per_second": payload / elapsed,
+        "round_trips_per_file": (after["round_trips"] - before["round_trips"]) / len(files),
+        "execs": after["execs"] - before["execs"],
+    }
+
+
+def run(baudrate, latency=0.0, rx_buffer=None, packages=None, flash_rate=None):
+    board_kwargs = dict(
+        baudrate=baudrate, latency=latency, rx_buffer=rx_buffer, flash_rate=flash_rate
+    )
+    results = {
+        "baudrate": baudrate,
+        "latency": latency,
+        "handshake": measure_handshake(board_kwargs, baudrate),
+        "uploads": dict(),
+    }
+    for name in packages or PACKAGES:
+        files = PACKAGES[name]()
+        results["uploads"][name] = [
+            measure_upload(board_kwargs, baudrate, files, transport, compress)
+            for transport, compress in TRANSFERS
+        ]
+    return results
+
+
+def print_results(results):
+    print(f"Simulated link: {results['baudrate']} baud, {results['latency'] * 1000:.1f} ms latency")
+    handshake = results["handshake"]
+    print(f"Enter raw REPL:   {handshake['enter_raw_repl_ms']:8.1f} ms")
+    print(f"Exec round trip:  {handshake['exec_round_trip_ms']:8.1f} ms")
+    for name, uploads in results["uploads"].items():
+        first = uploads[0]
+        print(f"\n{name}: {first['files']} files, {first['payload_bytes']} bytes")
+        print(f"  {'transport':<20}{'seconds':>9}{'bytes/s':>10}{'wire bytes':>12}{'trips/file':>12}")
+        for upload in uploads:
+            transport = upload["transport"] + (" + deflate" if upload["compress"] else "")
+            print(
+                f"  {transport:<20}{upload['seconds']:>9.2f}{upload['bytes_per_second']:>10.0f}"
+                f"{upload['wire_bytes']:>12}{upload['round_trips_per_file']:>12.1f}"
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--baud", type=int, default=115200, help="simulated link speed")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="extra seconds per USB transfer"
+    )
+    parser.add_argument(
+        "--rx-buffer", type=int, default=None, help="board UART RX buffer size in bytes"
+    )
+    parser.add_argument(
+        "--flash-rate", type=int, default=None, help="board file writes in bytes/s"
+    )
+    parser.add_argument(
+        "--package", action="append", choices=list(PACKAGES), help="only run these"
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = run(
+        args.baud, args.latency, args.rx_buffer, args.package, args.flash_rate
+    )
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
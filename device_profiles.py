@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import threading
+
+from serial_tools import get_port_info
+
+PROFILE_FILE = "device_profiles.json"
+
+# What describe() shows of a profile, in this order.
+DESCRIBED = [
+    ("description", "{}"),
+    ("flash_size", "{} flash"),
+    ("mac", "MAC {}"),
+    ("flash_baud", "esptool at {} baud"),
+    ("repl_baud", "upload at {} baud"),
+]
+
+
+def adapter_key(port):
+    """Identify the USB serial adapter behind `port` across runs.
+
+    The adapter's serial number is used where it has one. Adapters without
+    one, like most CH340s, are told apart by the USB socket they are in, and
+    ports that aren't USB at all by their name.
+    """
+    info = get_port_info(port)
+    if info is None or info.vid is None:
+        return port
+    if info.serial_number:
+        return f"{info.vid:04X}:{info.pid:04X}:{info.serial_number}"
+    return f"{info.vid:04X}:{info.pid:04X}@{info.location or port}"
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(64 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def describe(profile):
+    """One line on the board last seen on an adapter, "" for an empty profile."""
+    return ", ".join(
+        template.format(profile[name])
+        for name, template in DESCRIBED
+        if profile.get(name) is not None
+    )
+
+
+class ProfileCache(object):
+    """What was learned about each serial adapter, kept in a JSON file.
+
+    A profile holds the fastest working "flash_baud" and "repl_baud", what
+    esptool found on the board last time ("chip", "description",
+    "flash_size", "mac"), the "flash_offset" used, and the "firmware_sha256"
+    and "package_digest" last installed. The board values are only a hint:
+    the adapter may have a different board plugged in by now.
+
+    Safe to share between the threads of a ProvisioningEngine: every update
+    re-reads the file, so values written for other adapters are kept.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, path=PROFILE_FILE):
+        self.path = path
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def _save(self, profiles):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(profiles, f, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+    def get(self, key):
+        with self._lock:
+            return self._load().get(key, dict())
+
+    def update(self, key, **values):
+        with self._lock:
+            profiles = self._load()
+            profiles.setdefault(key, dict()).update(values)
+            self._save(profiles)
+
+    def forget(self, key, *names):
+        """Drop `names` from the profile of `key` (the whole profile if none)."""
+        with self._lock:
+            profiles = self._load()
+            if key not in profiles:
+                return
+            if names:
+                for name in names:
+                    profiles[key].pop(name, None)
+            else:
+                del profiles[key]
+            self._save(profiles)
@@ -0,0 +1,106 @@
+"""
+One esptool connection shared by several esptool commands.
+
+Every esptool.main() call resets the board into its bootloader, syncs, finds
+out what chip it is and uploads the flasher stub before it does any work.
+EsptoolSession does that once and hands the connection to each command, and
+reports what it learned about the board on the way.
+
+    with EsptoolSession(port, "auto", 921600) as session:
+        print(session.chip, session.mac, session.flash_size)
+        session.run(["erase_flash"])
+        session.run(["write_flash", "-z", "0x0", "firmware.bin"])
+"""
+import esptool
+from esptool.cmds import DETECTED_FLASH_SIZES
+
+CHIP_AUTO = "auto"
+
+
+def chip_name(esp):
+    """The --chip argument for a connected esptool loader, e.g. "esp32c3"."""
+    for name, chip_class in esptool.CHIP_DEFS.items():
+        if type(esp) is chip_class:
+            return name
+    return CHIP_AUTO
+
+
+class EsptoolSession(object):
+    """A board in its bootloader, connected to once for several commands.
+
+    `chip` is an esptool --chip name, or CHIP_AUTO to detect it. Detection
+    costs ESP32s and ESP8266s an extra reset, so pass the chip when it is
+    known. After connect(), `chip`, `description`, `mac` and `flash_size`
+    ("4MB", None if it couldn't be read) describe the board.
+    """
+
+    def __init__(self, port, chip=CHIP_AUTO, baud_rate=esptool.ESPLoader.ESP_ROM_BAUD):
+        self.port = port
+        self.chip = chip
+        self.baud_rate = baud_rate
+        self.description = None
+        self.mac = None
+        self.flash_size = None
+        self.esp = None
+        self._no_stub = False
+
+    def connect(self):
+        rom_baud = esptool.ESPLoader.ESP_ROM_BAUD
+        if self.chip == CHIP_AUTO:
+            esp = esptool.detect_chip(self.port, rom_baud)
+        else:
+            esp = esptool.CHIP_DEFS[self.chip](self.port, rom_baud)
+            try:
+                esp.connect()
+            except BaseException:
+                esp._port.close()
+                raise
+        try:
+            self.chip = chip_name(esp)
+            if not esp.secure_download_mode:
+                self.description = esp.get_chip_description()
+                self.mac = ":".join(f"{b:02x}" for b in esp.read_mac())
+            if esp.secure_download_mode or esp.stub_is_disabled:
+                self._no_stub = True
+                esp.flash_spi_attach(0)
+            else:
+                esp = esp.run_stub()
+                # Commands run later find the stub there instead of uploading it again.
+                esp.sync_stub_detected = True
+            try:
+                self.flash_size = DETECTED_FLASH_SIZES.get(esp.flash_id() >> 16)
+            except esptool.FatalError:
+                # Secure download mode hides the flash ID, the size is only a hint.
+                pass
+        except BaseException:
+            esp._port.close()
+            raise
+        self.esp = esp
+        return self
+
+    def run(self, command):
+        """Run an esptool command (["write_flash", ...]) on the connected board."""
+        argv = ["--baud", f"{self.baud_rate}", "--port", self.port, "--chip", self.chip]
+        if self._no_stub:
+            argv += ["--after", "no_reset", "--no-stub"]
+        else:
+            argv += ["--after", "no_reset_stub"]
+        esptool.main(argv + list(command), esp=self.esp)
+
+    def close(self):
+        """Reset the board into its firmware and let go of the port."""
+        if self.esp is None:
+            return
+        try:
+            self.esp.hard_reset()
+        finally:
+            self.esp._port.close()
+            self.esp = None
+
+    def __enter__(self):
+        if self.esp is None:
+            self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,144 @@
+import os
+import struct
+from collections import namedtuple
+from tempfile import TemporaryDirectory
+
+import esptool
+
+from software_package import SoftwarePackage
+
+try:
+    from littlefs import LittleFS
+except ImportError:  # optional, only needed for filesystem image installs
+    LittleFS = None
+
+PARTITION_TABLE_OFFSET = 0x8000
+PARTITION_TABLE_SIZE = 0xC00
+PARTITION_ENTRY = struct.Struct("<2sBBLL16sL")
+PARTITION_MAGIC = b"\xaa\x50"
+PARTITION_MD5_MAGIC = b"\xeb\xeb"
+
+PARTITION_TYPE_DATA = 0x01
+PARTITION_SUBTYPE_FAT = 0x81
+PARTITION_SUBTYPE_LITTLEFS = 0x83
+
+VFS_LABEL = "vfs"
+
+# MicroPython's ESP32 port mounts LittleFS v2 on the vfs partition with one
+# flash sector per block.
+LFS_BLOCK_SIZE = 4096
+LFS_READ_SIZE = 32
+LFS_PROG_SIZE = 32
+LFS_LOOKAHEAD_SIZE = 32
+LFS_DISK_VERSION = 0x00020000
+
+Partition = namedtuple("Partition", ["label", "type", "subtype", "offset", "size"])
+
+
+class FilesystemImageError(Exception):
+    ...
+
+
+def parse_partition_table(data):
+    """Parse an ESP-IDF binary partition table into a list of Partitions."""
+    partitions = list()
+    for i in range(0, len(data) - PARTITION_ENTRY.size + 1, PARTITION_ENTRY.size):
+        entry = data[i : i + PARTITION_ENTRY.size]
+        if entry[:2] == PARTITION_MD5_MAGIC or entry[:2] == b"\xff\xff":
+            break
+        magic, type_, subtype, offset, size, label, flags = PARTITION_ENTRY.unpack(
+            entry
+        )
+        if magic != PARTITION_MAGIC:
+            raise FilesystemImageError("invalid partition table entry at 0x%x" % i)
+        label = label.rstrip(b"\x00").decode("ascii", "replace")
+        partitions.append(Partition(label, type_, subtype, offset, size))
+    if not partitions:
+        raise FilesystemImageError("no partition table found")
+    return partitions
+
+
+def find_vfs_partition(partitions):
+    """Return the partition MicroPython mounts its filesystem on."""
+    for partition in partitions:
+        if partition.label == VFS_LABEL:
+            return partition
+    for partition in partitions:
+        if partition.type == PARTITION_TYPE_DATA and partition.subtype in (
+            PARTITION_SUBTYPE_FAT,
+            PARTITION_SUBTYPE_LITTLEFS,
+        ):
+            return partition
+    raise FilesystemImageError("no vfs partition in partition table")
+
+
+def partition_table_from_firmware(firmware, flash_offset):
+    """Read the partition table embedded in a MicroPython firmware image.
+
+    ESP32 firmware images bundle the bootloader, the partition table and the
+    application, so the table sits at PARTITION_TABLE_OFFSET - flash_offset in
+    the file.
+    """
+    if isinstance(flash_offset, str):
+        flash_offset = int(flash_offset, 0)
+    with open(firmware, "rb") as f:
+        f.seek(PARTITION_TABLE_OFFSET - flash_offset)
+        return parse_partition_table(f.read(PARTITION_TABLE_SIZE))
+
+
+def partition_table_from_device(port, baud_rate, session=None):
+    """Read the partition table from the board's flash with esptool.
+
+    Given an esptool_session.EsptoolSession, its connection is used instead
+    of esptool connecting to the board on its own.
+    """
+    with TemporaryDirectory() as tempdir:
+        table_file = os.path.join(tempdir, "partitions.bin")
+        command = [
+            "read_flash",
+            hex(PARTITION_TABLE_OFFSET),
+            hex(PARTITION_TABLE_SIZE),
+            table_file,
+        ]
+        if session is not None:
+            session.run(command)
+        else:
+            esptool.main(["--baud", f"{baud_rate}", "--port", port] + command)
+        with open(table_file, "rb") as f:
+            return parse_partition_table(f.read())
+
+
+def build_littlefs_image(software, size):
+    """Build a LittleFS image of `size` bytes from a software package zip."""
+    if LittleFS is None:
+        raise FilesystemImageError(
+            "filesystem images need the littlefs-python package (pip install littlefs-python)"
+        )
+    fs = LittleFS(
+        block_size=LFS_BLOCK_SIZE,
+        block_count=size // LFS_BLOCK_SIZE,
+        read_size=LFS_READ_SIZE,
+        prog_size=LFS_PROG_SIZE,
+        lookahead_size=LFS_LOOKAHEAD_SIZE,
+        disk_version=LFS_DISK_VERSION,
+    )
+    with SoftwarePackage(software) as package:
+        for directory in package.directories():
+            fs.makedirs(directory, exist_ok=True)
+        for entry in package.files():
+            with fs.open(entry.path, "wb") as fh:
+                for chunk in entry.chunks():
+                    fh.write(chunk)
+    return bytes(fs.context.buffer)
+
+
+def write_filesystem_image(software, partitions, image_file):
+    """Build the vfs image for `software` into `image_file`.
+
+    Returns the flash offset the image has to be written to.
+    """
+    vfs = find_vfs_partition(partitions)
+    image = build_littlefs_image(software, vfs.size)
+    with open(image_file, "wb") as f:
+        f.write(image)
+    return vfs.offset
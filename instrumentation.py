@@ -0,0 +1,143 @@
+"""
+Nested timing spans and transfer counters for provisioning runs.
+
+A Recorder collects the spans of one device run. While it is active on a
+thread or asyncio task, instrumentation.span() and instrumentation.count()
+calls made there (from the pipeline, Files or Pyboard) are recorded into it,
+and are no-ops otherwise.
+
+    recorder = Recorder(port="COM3")
+    with recorder.activate():
+        with span("upload", files=12):
+            count(bytes_sent=1024, round_trips=1)
+    recorder.finish(success=True)
+    recorder.write_jsonl("logs/metrics.jsonl")
+
+Counts go to every open span, so a span's counters include its children's.
+"""
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+
+# Threads start with an empty context and tasks with a copy of their creator's,
+# so each board's thread or task records into its own Recorder.
+_recorder = contextvars.ContextVar("recorder", default=None)
+
+
+class Span(object):
+    def __init__(self, span_id, name, parent=None, **attrs):
+        self.span_id = span_id
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.counters = dict()
+        self.start = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+
+    def add(self, counts):
+        for name, value in counts.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self._start
+
+    def to_dict(self):
+        record = {
+            "span": self.span_id,
+            "parent": self.parent.span_id if self.parent else None,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "attrs": self.attrs,
+            "counters": self.counters,
+        }
+        if self.duration and self.counters.get("bytes_sent"):
+            record["throughput"] = self.counters["bytes_sent"] / self.duration
+        return record
+
+
+class Recorder(object):
+    """The spans of one device run, exported as one JSON object per line."""
+
+    _write_lock = threading.Lock()
+
+    def __init__(self, **attrs):
+        self.run_id = uuid.uuid4().hex
+        self.root = Span(0, "run", **attrs)
+        self.spans = [self.root]
+        self._stack = [self.root]
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Record this thread's (or task's) spans and counts into this recorder."""
+        token = _recorder.set(self)
+        try:
+            yield self
+        finally:
+            _recorder.reset(token)
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        span = Span(len(self.spans), name, self._stack[-1], **attrs)
+        self.spans.append(span)
+        self._stack.append(span)
+        try:
+            yield span
+        except BaseException as ex:
+            span.attrs["error"] = repr(ex)
+            raise
+        finally:
+            span.finish()
+            self._stack.remove(span)
+
+    def count(self, **counts):
+        for span in self._stack:
+            span.add(counts)
+
+    def finish(self, **attrs):
+        self.root.attrs.update(attrs)
+        self.root.finish()
+
+    def records(self):
+        records = list()
+        for span in self.spans:
+            record = span.to_dict()
+            record["run"] = self.run_id
+            records.append(record)
+        return records
+
+    def write_jsonl(self, path):
+        """Append the run's spans to `path`, one JSON line per span."""
+        lines = "".join(json.dumps(record) + "\n" for record in self.records())
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._write_lock:
+            with open(path, "a") as f:
+                f.write(lines)
+
+
+def current():
+    """The Recorder active on this thread or task, or None."""
+    return _recorder.get()
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    recorder = current()
+    if recorder is None:
+        yield None
+    else:
+        with recorder.span(name, **attrs) as recorded:
+            yield recorded
+
+
+def count(**counts):
+    recorder = current()
+    if recorder is not None:
+        recorder.count(**counts)
@@ -0,0 +1,85 @@
+import hashlib
+import json
+
+# Where the uploader keeps the manifest of what it installed on the board.
+MANIFEST_PATH = "/.manifest.json"
+
+
+class Manifest(object):
+    """The files installed on a board: {path: (size, sha256 hex)}.
+
+    `version` and `package` describe the software package the files came
+    from, both are optional.
+    """
+
+    def __init__(self, files=None, version=None, package=None):
+        self.files = dict(files or {})
+        self.version = version
+        self.package = package
+
+    @classmethod
+    def from_package(cls, files, version=None, package=None):
+        """Build a manifest from PackageFiles, hashing their data."""
+        return cls(
+            {entry.path: (entry.size, entry.sha256()) for entry in files},
+            version,
+            package,
+        )
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        files = {path: tuple(entry) for path, entry in data.get("files", {}).items()}
+        return cls(files, data.get("version"), data.get("package"))
+
+    def to_json(self):
+        return json.dumps(
+            {
+                "version": self.version,
+                "package": self.package,
+                "digest": self.digest(),
+                "files": {path: list(entry) for path, entry in sorted(self.files.items())},
+            },
+            separators=(",", ":"),
+        )
+
+    def digest(self):
+        """A hash over every path and file hash, equal for identical installs."""
+        h = hashlib.sha256()
+        for path, (size, sha256) in sorted(self.files.items()):
+            h.update(f"{path}\0{size}\0{sha256}\n".encode("utf-8"))
+        return h.hexdigest()
+
+    def update(self, other, removed=()):
+        """Merge `other` into this manifest and drop the `removed` paths."""
+        for path in removed:
+            self.files.pop(path, None)
+        self.files.update(other.files)
+        if other.version is not None:
+            self.version = other.version
+        if other.package is not None:
+            self.package = other.package
+
+    def diff(self, other):
+        """What it takes to turn this manifest's board into `other`'s.
+
+        Returns a dict of "added", "changed", "removed" and "unchanged" paths.
+        """
+        added = sorted(path for path in other.files if path not in self.files)
+        removed = sorted(path for path in self.files if path not in other.files)
+        changed = list()
+        unchanged = list()
+        for path in sorted(set(self.files) & set(other.files)):
+            if self.files[path] == other.files[path]:
+                unchanged.append(path)
+            else:
+                changed.append(path)
+        return {
+            "added": added,
+            "changed": changed,
+            "removed": removed,
+            "unchanged": unchanged,
+        }
+
+    def __repr__(self):
+        return "Manifest({!r}, {} files)".format(self.version, len(self.files))
@@ -0,0 +1,176 @@
+import hashlib
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+
+from software_package import PackageFile
+
+try:
+    import mpy_cross
+except ImportError:  # optional, only needed to precompile software packages
+    mpy_cross = None
+
+CACHE_DIR = "mpy_cache"
+
+# MicroPython only runs these as source, never as .mpy.
+SOURCE_ONLY = ("/boot.py", "/main.py")
+
+# mpy-cross processes run at once while precompiling a package.
+COMPILE_WORKERS = os.cpu_count() or 1
+
+# Architecture field of sys.implementation._mpy -> mpy-cross -march value.
+MPY_ARCHES = [
+    None,
+    "x86",
+    "x64",
+    "armv6",
+    "armv6m",
+    "armv7m",
+    "armv7em",
+    "armv7emsp",
+    "armv7emdp",
+    "xtensa",
+    "xtensawin",
+    "rv32imc",
+    "rv64imc",
+]
+
+
+class MpyCacheError(Exception):
+    ...
+
+
+def decode_mpy_version(mpy):
+    """Split sys.implementation._mpy into (version, sub version, arch)."""
+    arch = mpy >> 10
+    return (
+        mpy & 0xFF,
+        (mpy >> 8) & 0x3,
+        MPY_ARCHES[arch] if arch < len(MPY_ARCHES) else None,
+    )
+
+
+def compiler_version():
+    """Return the (version, sub version) of .mpy files mpy-cross emits."""
+    if mpy_cross is None:
+        raise MpyCacheError(
+            "precompiling needs the mpy-cross package (pip install mpy-cross)"
+        )
+    proc = mpy_cross.run("--version", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, _ = proc.communicate()
+    match = re.search(rb"mpy v(\d+)(?:\.(\d+))?", out)
+    if match is None:
+        raise MpyCacheError("can't tell mpy-cross version from: %r" % out)
+    return int(match.group(1)), int(match.group(2) or 0)
+
+
+class MpyCompiler(object):
+    """Compiles package .py files to .mpy for one board, through a disk cache.
+
+    Compiled files are stored under `cache_dir` by a hash of their source,
+    path and compiler arguments, so installing the same package again only
+    compiles files that changed.
+    """
+
+    def __init__(self, mpy, cache_dir=CACHE_DIR):
+        version, sub_version, arch = decode_mpy_version(mpy)
+        compiler = compiler_version()
+        if compiler[0] != version:
+            raise MpyCacheError(
+                f"mpy-cross emits .mpy v{compiler[0]}.{compiler[1]}, the board needs v{version}"
+            )
+        self.cache_dir = cache_dir
+        self.args = list()
+        # Native code only loads if the sub version matches as well; plain
+        # bytecode runs on any board with the same major version.
+        if arch is not None and compiler[1] == sub_version:
+            self.args.append(f"-march={arch}")
+        self._key = repr((compiler, self.args)).encode("utf-8")
+
+    def _cache_path(self, entry, source):
+        h = hashlib.sha256(self._key)
+        h.update(entry.path.encode("utf-8"))
+        h.update(b"\x00")
+        h.update(source)
+        digest = h.hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + ".mpy")
+
+    def _compile(self, entry, source, cached):
+        with TemporaryDirectory() as tempdir:
+            source_file = os.path.join(tempdir, "source.py")
+            output_file = os.path.join(tempdir, "output.mpy")
+            with open(source_file, "wb") as f:
+                f.write(source)
+            proc = mpy_cross.run(
+                *self.args,
+                "-s",
+                entry.path.lstrip("/"),
+                "-o",
+                output_file,
+                source_file,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            _, err = proc.communicate()
+            if proc.returncode != 0:
+                # Only the last line names the problem, the traceback above it
+                # points into the temporary folder.
+                message = err.decode("utf-8", "replace").strip().splitlines()
+                raise MpyCacheError(message[-1] if message else "mpy-cross failed")
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            # Boards provisioned in parallel share the cache, so only ever
+            # move complete files into it.
+            os.replace(output_file, cached)
+
+    def compile(self, entry):
+        """Return a PackageFile of the compiled `entry`."""
+        source = entry.read()
+        cached = self._cache_path(entry, source)
+        if not os.path.exists(cached):
+            self._compile(entry, source, cached)
+        return PackageFile(
+            entry.path[:-3] + ".mpy",
+            os.path.getsize(cached),
+            lambda: open(cached, "rb"),
+        )
+
+
+def precompile(files, mpy, cache_dir=CACHE_DIR, log=print):
+    """Swap the .py files in `files` for compiled .mpy files.
+
+    `mpy` is the board's sys.implementation._mpy. Files that fail to compile
+    are kept as source. Returns the new file list and the paths of the
+    replaced .py files, which have to go from the board as MicroPython
+    imports a .py before an .mpy of the same name.
+    """
+    if mpy is None:
+        log("Board doesn't report its .mpy version, uploading sources.\n")
+        return files, []
+    try:
+        compiler = MpyCompiler(mpy, cache_dir)
+    except MpyCacheError as ex:
+        log(f"Can't precompile: {ex}, uploading sources.\n")
+        return files, []
+
+    def compile_entry(entry):
+        if not entry.path.endswith(".py") or entry.path in SOURCE_ONLY:
+            return entry, None
+        try:
+            return compiler.compile(entry), None
+        except MpyCacheError as ex:
+            return entry, ex
+
+    compiled = list()
+    sources = list()
+    # mpy-cross runs as a subprocess, so files compile on all cores at once.
+    with ThreadPoolExecutor(COMPILE_WORKERS) as pool:
+        for entry, (result, error) in zip(files, pool.map(compile_entry, files)):
+            if error is not None:
+                log(f"{entry.path} not precompiled: {error}\n")
+            elif result is not entry:
+                sources.append(entry.path)
+            compiled.append(result)
+    log(f"{len(sources)} files precompiled.\n")
+    return compiled, sources
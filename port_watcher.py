@@ -0,0 +1,142 @@
+"""
+A live table of the serial ports on this machine.
+
+PortWatcher keeps the ports (with USB VID/PID and serial number) cached so
+callers don't have to enumerate them on every use, and calls back when a
+board is plugged in or unplugged. On Linux with pyudev installed it wakes up
+on udev tty events, everywhere else it polls pyserial's port list.
+
+    watcher = PortWatcher(on_attach=lambda info: print("new board", info.device))
+    watcher.start()
+    ...
+    watcher.ports()   # {device: ListPortInfo}
+    watcher.stop()
+"""
+import threading
+
+import serial.tools.list_ports
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+POLL_INTERVAL = 0.5
+
+# How long a udev wait blocks before checking whether the watcher was stopped.
+UDEV_TIMEOUT = 0.5
+
+
+def port_key(info):
+    """What identifies the board behind a port, to tell a replug from a swap."""
+    return (info.vid, info.pid, info.serial_number, info.hwid)
+
+
+class PortWatcher(object):
+    """Tracks serial ports being attached and detached.
+
+    `on_attach` and `on_detach` are called with the port's pyserial
+    ListPortInfo from the watcher's thread. Ports present when the watcher
+    starts are reported as attached only with `report_existing`.
+    """
+
+    def __init__(
+        self,
+        on_attach=None,
+        on_detach=None,
+        poll_interval=POLL_INTERVAL,
+        use_udev=True,
+        report_existing=False,
+    ):
+        self.on_attach = on_attach
+        self.on_detach = on_detach
+        self.poll_interval = poll_interval
+        self.use_udev = use_udev and pyudev is not None
+        self.report_existing = report_existing
+        self._ports = dict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def ports(self):
+        """A snapshot of the attached ports, {device: ListPortInfo}."""
+        with self._lock:
+            return dict(self._ports)
+
+    def get(self, device):
+        with self._lock:
+            return self._ports.get(device)
+
+    def scan(self):
+        """Enumerate the ports now, firing callbacks for what changed.
+
+        Returns the (attached, detached) ListPortInfos.
+        """
+        found = {info.device: info for info in serial.tools.list_ports.comports()}
+        with self._lock:
+            previous = self._ports
+            attached = [
+                info
+                for device, info in sorted(found.items())
+                if device not in previous or port_key(previous[device]) != port_key(info)
+            ]
+            detached = [
+                info
+                for device, info in sorted(previous.items())
+                if device not in found or port_key(found[device]) != port_key(info)
+            ]
+            self._ports = found
+        for info in detached:
+            if self.on_detach:
+                self.on_detach(info)
+        for info in attached:
+            if self.on_attach:
+                self.on_attach(info)
+        return attached, detached
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        if self.report_existing:
+            self.scan()
+        else:
+            with self._lock:
+                self._ports = {
+                    info.device: info for info in serial.tools.list_ports.comports()
+                }
+        self._stop.clear()
+        target = self._watch_udev if self.use_udev else self._watch_polling
+        self._thread = threading.Thread(target=target, name="port-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _watch_polling(self):
+        while not self._stop.wait(self.poll_interval):
+            self.scan()
+
+    def _watch_udev(self):
+        try:
+            monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            monitor.filter_by(subsystem="tty")
+            monitor.start()
+        except (OSError, ImportError):
+            # No netlink access (containers, some sandboxes), poll instead.
+            self._watch_polling()
+            return
+        while not self._stop.is_set():
+            # pyserial reads the same sysfs entries udev just announced, so a
+            # rescan on any tty event gives the table the usual ListPortInfos.
+            if monitor.poll(timeout=UDEV_TIMEOUT) is not None:
+                self.scan()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -0,0 +1,1080 @@
+import argparse
+import copy
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+
+import esptool
+from serial import SerialException
+
+import device_profiles
+import esptool_session
+import fs_image
+import instrumentation
+import mpy_cache
+import pyboard
+import pyb_agent
+import pyb_files
+import transfer_journal
+from manifest import Manifest
+from port_watcher import PortWatcher
+from pyboard import PyboardError
+from serial_tools import get_flashable_ports
+from serial_tools import is_usb_uart
+from serial_tools import port_is_avaiable
+from simple_timer import SimpleTimer
+from software_package import SoftwarePackage
+
+CHIPS = [
+    esptool_session.CHIP_AUTO,
+    "esp8266",
+    "esp32",
+    "esp32s2",
+    "esp32s3beta2",
+    "esp32s3",
+    "esp32c3",
+    "esp32c6beta",
+    "esp32h2beta1",
+    "esp32h2beta2",
+    "esp32c2",
+    "esp32c6",
+]
+
+BAUD_RATES = [9600, 19200, 28800, 38400, 57600, 115200, 230400, 460800, 576000, 921600]
+
+FLASH_OFFSETS = ["0x0", "0x1000"]
+
+# MicroPython starts its REPL at REPL_BAUD_RATE. When negotiating, the faster
+# rates are tried fastest first.
+REPL_BAUD_RATE = 115200
+REPL_BAUD_RATES = [921600, 460800, 230400]
+
+# Flash read back at each rate to find the fastest one esptool can use.
+FLASH_PROBE_SIZE = 0x4000
+
+# USB serial devices get their permissions from udev rules a moment after the
+# port appears, so freshly plugged in boards are left alone this long.
+ATTACH_SETTLE = 1.0
+
+# Timing spans of every run are appended here, in the log folder.
+METRICS_FILE = "metrics.jsonl"
+
+# Kinds of ProgressEvent put on a ProvisioningWorker's queue.
+EVENT_LOG = "log"
+EVENT_RESULT = "result"
+EVENT_DONE = "done"
+
+
+class ProvisioningError(Exception):
+    ...
+
+
+class InstallOptions(object):
+    """Everything the install pipeline needs to know besides the port.
+
+    Uploads default to what the installer always did: one exec per chunk,
+    uncompressed, unverified and not resumable. The GUI and the command line
+    turn on the pipeline transport, compression, verification and `resume`.
+    """
+
+    def __init__(
+        self,
+        firmware=None,
+        software=None,
+        chip=esptool_session.CHIP_AUTO,
+        baud_rate=115200,
+        flash_offset="0x0",
+        skip_flash=False,
+        sync=False,
+        delete_stale=False,
+        fs_image=False,
+        transport="exec",
+        compress=False,
+        precompile=False,
+        mpy_cache_dir=mpy_cache.CACHE_DIR,
+        negotiate_baud=False,
+        profile_file=device_profiles.PROFILE_FILE,
+        metrics_file=None,
+        package_version=None,
+        resume=False,
+        retries=pyb_agent.MAX_RETRIES,
+        verify=False,
+    ):
+        self.firmware = firmware
+        self.software = software
+        self.chip = str(chip).lower()
+        self.baud_rate = baud_rate
+        self.flash_offset = flash_offset
+        self.skip_flash = skip_flash
+        self.sync = sync
+        self.delete_stale = delete_stale
+        self.fs_image = fs_image
+        self.transport = transport
+        self.compress = compress
+        self.precompile = precompile
+        self.mpy_cache_dir = mpy_cache_dir
+        self.negotiate_baud = negotiate_baud
+        self.profile_file = profile_file
+        self.metrics_file = metrics_file
+        self.package_version = package_version
+        self.resume = resume
+        self.retries = retries
+        self.verify = verify
+
+    @property
+    def journal_file(self):
+        """Where upload progress is kept with `resume` set, next to the profiles."""
+        if not self.resume:
+            return None
+        profile_dir = os.path.dirname(self.profile_file or device_profiles.PROFILE_FILE)
+        return os.path.join(profile_dir, transfer_journal.JOURNAL_FILE)
+
+    def validate(self):
+        if not self.firmware and not self.skip_flash:
+            raise ProvisioningError("missing firmware image.")
+        if self.fs_image and self.software and self.chip == "esp8266":
+            raise ProvisioningError(
+                "filesystem images are not supported on the esp8266."
+            )
+
+
+def wait_for_manual_reset(port):
+    print(
+        f"\n\n{'#' * 80}\nWARNING: esp32c3 chip detected, unable to force reboot, but reboot/reset required!"
+    )
+    print(
+        "\nPlease press the reset button, or unplug and replug device and then\nhit ENTER to continue with software upload."
+    )
+    input()
+
+
+def esptool_write_flash_command(options):
+    if options.chip == "esp8266":
+        return [
+            "write_flash",
+            "--flash_mode",
+            "dout",
+            "--flash_size",
+            "detect",
+            f"{options.flash_offset}",
+            options.firmware,
+        ]
+    return [
+        "write_flash",
+        "-z",
+        f"{options.flash_offset}",
+        options.firmware,
+    ]
+
+
+def probe_flash_baud(port, options, log):
+    """Return the fastest baud rate esptool can read the board's flash at.
+
+    Rates above the selected one are tried fastest first. esptool checks the
+    data it read, so a rate the adapter can't keep up with fails here.
+    """
+    for baud_rate in sorted(BAUD_RATES, reverse=True):
+        if baud_rate <= options.baud_rate:
+            break
+        log(f"Trying esptool at {baud_rate} baud.\n")
+        with TemporaryDirectory() as tempdir:
+            try:
+                esptool.main(
+                    [
+                        "--baud",
+                        f"{baud_rate}",
+                        "--port",
+                        port,
+                        "--chip",
+                        f"{options.chip}",
+                        "read_flash",
+                        "0",
+                        hex(FLASH_PROBE_SIZE),
+                        os.path.join(tempdir, "probe.bin"),
+                    ]
+                )
+                return baud_rate
+            except (esptool.FatalError, SerialException, OSError) as ex:
+                print(f"esptool failed at {baud_rate} baud: {ex}")
+                instrumentation.count(retries=1)
+    return options.baud_rate
+
+
+def negotiate_flash_baud(port, options, profiles, log):
+    """Return a copy of `options` with the fastest esptool baud rate for `port`."""
+    key = device_profiles.adapter_key(port)
+    baud_rate = profiles.get(key).get("flash_baud")
+    if baud_rate is None:
+        baud_rate = probe_flash_baud(port, options, log)
+        profiles.update(key, flash_baud=baud_rate)
+    log(f"Using esptool at {baud_rate} baud.\n")
+    options = copy.copy(options)
+    options.baud_rate = baud_rate
+    return options
+
+
+def connect_esptool(port, options, profiles, log):
+    """Connect esptool to the board on `port` once, for all the flashing.
+
+    Returns the EsptoolSession and a copy of `options` with the board's chip.
+    With the chip left to "auto", the chip last seen on the adapter is tried
+    first, which spares esptool detecting it. What the session finds out
+    about the board is remembered in the adapter's profile.
+    """
+    key = device_profiles.adapter_key(port)
+    chip = options.chip
+    if chip == esptool_session.CHIP_AUTO:
+        chip = profiles.get(key).get("chip", chip)
+    try:
+        session = esptool_session.EsptoolSession(port, chip, options.baud_rate).connect()
+    except esptool.FatalError as ex:
+        if chip == options.chip:
+            raise
+        # Most likely another kind of board on the adapter than last time.
+        print(f"esptool failed as {chip}: {ex}")
+        session = esptool_session.EsptoolSession(
+            port, options.chip, options.baud_rate
+        ).connect()
+    profiles.update(
+        key,
+        chip=session.chip,
+        description=session.description,
+        flash_size=session.flash_size,
+        mac=session.mac,
+    )
+    log(f"Found {device_profiles.describe(profiles.get(key))}.\n")
+    options = copy.copy(options)
+    options.chip = session.chip
+    return session, options
+
+
+def negotiate_repl_baud(pyb, port, profiles, log):
+    """Move the raw REPL session on `pyb` to the fastest rate the link holds."""
+    key = device_profiles.adapter_key(port)
+    cached = profiles.get(key).get("repl_baud")
+    if cached == REPL_BAUD_RATE:
+        return REPL_BAUD_RATE
+    if cached is None:
+        candidates = REPL_BAUD_RATES
+    else:
+        candidates = [cached] + [rate for rate in REPL_BAUD_RATES if rate < cached]
+    for baud_rate in candidates:
+        try:
+            switched = pyb.switch_baudrate(baud_rate)
+        except PyboardError as ex:
+            # The board drops back to the old rate by itself; start over there.
+            log(f"Switching to {baud_rate} baud failed: {ex}\n")
+            pyb.enter_raw_repl()
+            break
+        if switched:
+            log(f"Uploading at {baud_rate} baud.\n")
+            if baud_rate != cached:
+                profiles.update(key, repl_baud=baud_rate)
+            return baud_rate
+    log(f"Uploading at {REPL_BAUD_RATE} baud.\n")
+    profiles.update(key, repl_baud=REPL_BAUD_RATE)
+    return REPL_BAUD_RATE
+
+
+def flash_firmware(session, options, log):
+    """Erase the board and write the firmware, over the session's connection."""
+    timer = SimpleTimer()
+    log("Erasing Flash.\n")
+    timer.start()
+    with instrumentation.span("erase", baud_rate=options.baud_rate):
+        session.run(["erase_flash"])
+    print(f"\nFlash erased in: {(timer.end_with_results()):.1f}s\n")
+    log("ERASE FIRMWARE SUCCESSFUL!\n\n")
+    log("Flashing NEW firmware.\n")
+    esptool_command = esptool_write_flash_command(options)
+
+    with TemporaryDirectory() as tempdir:
+        if options.fs_image and options.software:
+            log("Building filesystem image.\n")
+            fs_image_file = os.path.join(tempdir, "vfs.bin")
+            with instrumentation.span("build_fs_image"):
+                partitions = fs_image.partition_table_from_firmware(
+                    options.firmware, options.flash_offset
+                )
+                vfs_offset = fs_image.write_filesystem_image(
+                    options.software, partitions, fs_image_file
+                )
+            esptool_command += [hex(vfs_offset), fs_image_file]
+
+        timer.start()
+        print(*esptool_command)
+        with instrumentation.span("flash", baud_rate=options.baud_rate):
+            session.run(esptool_command)
+    print(f"\nFirmware flashed in: {(timer.end_with_results()):.1f}s\n")
+    log("FIRMWARE FLASH SUCCESSFUL!\n\n")
+
+
+def flash_filesystem_image(session, options, log):
+    """Write the software package as a filesystem image to a flashed board."""
+    timer = SimpleTimer()
+    log("Building filesystem image.\n")
+    with TemporaryDirectory() as tempdir:
+        fs_image_file = os.path.join(tempdir, "vfs.bin")
+        with instrumentation.span("build_fs_image"):
+            partitions = fs_image.partition_table_from_device(
+                session.port, options.baud_rate, session
+            )
+            vfs_offset = fs_image.write_filesystem_image(
+                options.software, partitions, fs_image_file
+            )
+        esptool_command = ["write_flash", "-z", hex(vfs_offset), fs_image_file]
+        timer.start()
+        print(*esptool_command)
+        with instrumentation.span("flash_fs_image", baud_rate=options.baud_rate):
+            session.run(esptool_command)
+    print(f"\nFilesystem image flashed in: {(timer.end_with_results()):.1f}s\n")
+
+
+def upload_software(port, options, log):
+    timer = SimpleTimer()
+    timer.start()
+    pyb = None
+    try:
+        pyb = pyboard.Pyboard(port, REPL_BAUD_RATE)
+        if options.negotiate_baud:
+            pyb.enter_raw_repl(reuse=True)
+            with instrumentation.span("repl_baud") as span:
+                baud_rate = negotiate_repl_baud(
+                    pyb, port, device_profiles.ProfileCache(options.profile_file), log
+                )
+                if span is not None:
+                    span.attrs["baud_rate"] = baud_rate
+        with SoftwarePackage(options.software) as package:
+            log("Generating directories list.\n")
+            directories_to_make = package.directories()
+            for directory in directories_to_make:
+                log(f"{directory}\n")
+            files = package.files()
+            fh = pyb_files.Files(pyb, keep_raw_repl=True)
+
+            log(f"\nCreating and/or verifying directories.\n")
+            with instrumentation.span("mkdir", directories=len(directories_to_make)):
+                report = fh.mkdir(directory_list=directories_to_make)
+            log(
+                f"{len(report['created'])} directories created, "
+                f"{len(report['existing'])} already there.\n"
+            )
+
+            sources = list()
+            if options.precompile:
+                log(f"\nPrecompiling Python files.\n")
+                with instrumentation.span("precompile"):
+                    files, sources = mpy_cache.precompile(
+                        files, fh.mpy_version(), options.mpy_cache_dir, log
+                    )
+
+            journal = None
+            if options.journal_file:
+                journal = transfer_journal.TransferJournal(
+                    device_profiles.adapter_key(port), options.journal_file
+                )
+                if journal.files or journal.partial:
+                    log("Found an interrupted upload, resuming what the board has.\n")
+
+            log(f"\nUploading Files.\n")
+            deleted = list()
+            if options.sync or options.delete_stale:
+                with instrumentation.span("sync", delete=options.delete_stale):
+                    deleted = fh.sync(
+                        files,
+                        delete=options.delete_stale,
+                        transport=options.transport,
+                        compress=options.compress,
+                        manifest=False,
+                        journal=journal,
+                        retries=options.retries,
+                    )["deleted"]
+            else:
+                fh.put(
+                    files,
+                    transport=options.transport,
+                    compress=options.compress,
+                    manifest=False,
+                    journal=journal,
+                    retries=options.retries,
+                )
+            if options.verify:
+                verify_upload(fh, files, options, log)
+            if sources:
+                with instrumentation.span("remove_sources", files=len(sources)):
+                    fh.remove_files(sources)
+
+            with instrumentation.span("manifest"):
+                installed = fh.update_manifest(
+                    Manifest.from_package(
+                        files,
+                        options.package_version or package.version,
+                        os.path.basename(options.software),
+                    ),
+                    removed=deleted + sources,
+                    replace=options.delete_stale,
+                )
+            log(f"Manifest written, package version {installed.version}.\n")
+        print(f"\nSoftware package uploaded in: {(timer.end_with_results()):.1f}s")
+        log("SOFTWARE PACKAGE UPLOAD SUCCESSFUL!\n")
+        pyb.soft_reset()
+        return installed
+    except PyboardError as ex:
+        if pyb is None:
+            raise ProvisioningError(f"can't open the port: {ex}")
+        raise ProvisioningError(
+            "something went wrong talking to the device.\n"
+            "(It is recommended to unplug the device and plug in again,"
+            " the next upload resumes where this one stopped.)"
+        )
+    except KeyboardInterrupt:
+        raise ProvisioningError(
+            "user forcefully bailed, software upload incomplete.\n"
+            "(The next upload resumes where this one stopped.)"
+        )
+    finally:
+        if pyb is not None:
+            pyb.close()
+
+
+def verify_upload(fh, files, options, log):
+    """Have the board check its copies of `files`, sending mismatches again once."""
+    log("Verifying uploaded files.\n")
+    with instrumentation.span("verify", files=len(files)):
+        mismatches = fh.verify(files)
+    if mismatches:
+        log(f"{len(mismatches)} files don't match the package, uploading them again.\n")
+        again = [
+            entry
+            for entry in files
+            if pyb_files.device_path(entry.path) in mismatches
+        ]
+        with instrumentation.span("reupload", files=len(again)):
+            fh.put(
+                again,
+                transport=options.transport,
+                compress=options.compress,
+                manifest=False,
+                retries=options.retries,
+            )
+            mismatches = fh.verify(again)
+    if mismatches:
+        raise ProvisioningError(
+            "files on the device don't match the package: "
+            + ", ".join(
+                f"{path} ({problem})" for path, problem in sorted(mismatches.items())
+            )
+        )
+    log("All files verified.\n")
+
+
+def read_board_manifest(port, software=None):
+    """Return the board's Manifest (or None) and, given a software package,
+    the Manifest.diff() of installing it."""
+    pyb = pyboard.Pyboard(port, REPL_BAUD_RATE)
+    try:
+        installed = pyb_files.Files(pyb).read_manifest()
+    finally:
+        pyb.close()
+    diff = None
+    if software:
+        with SoftwarePackage(software) as package:
+            diff = (installed or Manifest()).diff(Manifest.from_package(package.files()))
+    return installed, diff
+
+
+def provision(port, options, log=print, wait_for_reset=wait_for_manual_reset):
+    """Run the full erase/flash/upload pipeline for one board.
+
+    `log` receives the progress messages meant for the operator. Raises
+    ProvisioningError when the board could not be provisioned. With
+    `options.metrics_file` set, the run's timing spans and transfer counters
+    are appended to it as JSON lines.
+    """
+    options.validate()
+    recorder = instrumentation.Recorder(
+        port=port,
+        adapter=device_profiles.adapter_key(port),
+        chip=options.chip,
+        firmware=options.firmware and os.path.basename(options.firmware),
+        software=options.software and os.path.basename(options.software),
+        transport=options.transport,
+    )
+    try:
+        with recorder.activate():
+            _provision(port, options, log, wait_for_reset)
+        recorder.finish(success=True)
+    except BaseException as ex:
+        recorder.finish(success=False, error=str(ex))
+        raise
+    finally:
+        if options.metrics_file:
+            recorder.write_jsonl(options.metrics_file)
+
+
+def _provision(port, options, log, wait_for_reset):
+    with instrumentation.span("port_check"):
+        available = port_is_avaiable(port)
+    if not available:
+        raise ProvisioningError(
+            "port is unavailable.\n"
+            "(port is already in use or device is no longer connected)"
+        )
+
+    total_timer = SimpleTimer()
+    total_timer.start()
+    profiles = device_profiles.ProfileCache(options.profile_file)
+    key = device_profiles.adapter_key(port)
+    uses_esptool = not options.skip_flash or (options.fs_image and options.software)
+    if options.negotiate_baud and uses_esptool:
+        with instrumentation.span("flash_baud"):
+            options = negotiate_flash_baud(port, options, profiles, log)
+    try:
+        if uses_esptool:
+            with instrumentation.span("connect"):
+                session, options = connect_esptool(port, options, profiles, log)
+            try:
+                options.validate()
+                if not options.skip_flash:
+                    flash_firmware(session, options, log)
+                elif options.fs_image and options.software:
+                    flash_filesystem_image(session, options, log)
+            finally:
+                session.close()
+            if not options.skip_flash:
+                profiles.update(
+                    key,
+                    flash_offset=options.flash_offset,
+                    firmware_sha256=device_profiles.file_sha256(options.firmware),
+                )
+
+        if options.fs_image and options.software:
+            log("SOFTWARE PACKAGE IMAGE FLASH SUCCESSFUL!\n")
+            return
+
+        log("Uploading software package.\n")
+        if not options.software:
+            log("WARNING: missing software package!\n")
+            return
+
+        if "esp32c3" in options.chip:
+            wait_for_reset(port)
+
+        with instrumentation.span("upload"):
+            installed = upload_software(port, options, log)
+        profiles.update(key, package_digest=installed.digest())
+    except esptool.FatalError as ex:
+        if options.negotiate_baud:
+            # Probe again next time rather than keep failing at a cached rate.
+            profiles.forget(key, "flash_baud")
+        raise ProvisioningError(f"esptool failed: {ex}")
+    total_timer_result = total_timer.end_with_results()
+    print(f"Total time: {total_timer_result:.1f}s   ({total_timer_result/60:.1f}m)\n")
+
+
+class _ThreadStdout(object):
+    """sys.stdout replacement routing each worker thread to its own log.
+
+    esptool and the pyboard tools print straight to sys.stdout, so this is
+    what keeps the output of boards provisioned in parallel apart.
+    """
+
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def redirect(self, stream):
+        """Send this thread's output to `stream` (None for the console).
+
+        Returns the stream that was in use before.
+        """
+        previous = getattr(self._local, "stream", None)
+        self._local.stream = stream
+        return previous
+
+    def write(self, text):
+        stream = getattr(self._local, "stream", None) or self._default
+        return stream.write(text)
+
+    def flush(self):
+        stream = getattr(self._local, "stream", None) or self._default
+        stream.flush()
+
+    def isatty(self):
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self._default, name)
+
+
+class DeviceLog(object):
+    """Per-board log, kept in memory and mirrored to a file."""
+
+    def __init__(self, port, log_dir=None):
+        self.port = port
+        self.lines = list()
+        self.path = None
+        self._file = None
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+            name = "{}_{}.log".format(
+                time.strftime("%Y%m%d-%H%M%S"), port.strip("/").replace("/", "_")
+            )
+            self.path = os.path.join(log_dir, name)
+            self._file = open(self.path, "w")
+
+    def write(self, text):
+        self.lines.append(text)
+        if self._file:
+            self._file.write(text)
+        return len(text)
+
+    def flush(self):
+        if self._file:
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def text(self):
+        return "".join(self.lines)
+
+
+class ProvisioningResult(object):
+    def __init__(self, port, success, error=None, elapsed=0.0, log=None):
+        self.port = port
+        self.success = success
+        self.error = error
+        self.elapsed = elapsed
+        self.log = log
+
+    def __repr__(self):
+        status = "OK" if self.success else f"FAILED ({self.error})"
+        return f"{self.port}: {status} in {self.elapsed:.1f}s"
+
+
+class ProvisioningEngine(object):
+    """Provision several boards at once, one worker thread per port."""
+
+    def __init__(
+        self, options, max_workers=None, log_dir="logs", on_result=None, on_log=None
+    ):
+        self.options = options
+        self.max_workers = max_workers
+        self.log_dir = log_dir
+        self.on_result = on_result
+        self.on_log = on_log
+        self._input_lock = threading.Lock()
+
+    def _wait_for_reset(self, port):
+        # Prompts from parallel workers would interleave, ask one at a time.
+        with self._input_lock:
+            device_log = sys.stdout.redirect(None)
+            try:
+                print(f"\n[{port}]")
+                wait_for_manual_reset(port)
+            finally:
+                sys.stdout.redirect(device_log)
+
+    def _provision_one(self, port):
+        device_log = DeviceLog(port, self.log_dir)
+        sys.stdout.redirect(device_log)
+        timer = SimpleTimer()
+        timer.start()
+
+        def log(message):
+            device_log.write(message)
+            if self.on_log:
+                self.on_log(port, message)
+
+        try:
+            provision(
+                port,
+                self.options,
+                log=log,
+                wait_for_reset=self._wait_for_reset,
+            )
+            result = ProvisioningResult(port, True, log=device_log)
+        except (Exception, PyboardError) as ex:
+            # PyboardError isn't an Exception, but must only fail this board.
+            device_log.write(f"ERROR: {ex}\n")
+            result = ProvisioningResult(port, False, error=str(ex), log=device_log)
+        finally:
+            sys.stdout.redirect(None)
+            device_log.close()
+        result.elapsed = timer.end_with_results()
+        if self.on_result:
+            self.on_result(result)
+        return result
+
+    def run(self, ports):
+        """Provision every port in `ports`, returning a ProvisioningResult each."""
+        self.options.validate()
+        ports = list(ports)
+        if not ports:
+            return list()
+        original_stdout = sys.stdout
+        sys.stdout = _ThreadStdout(original_stdout)
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers or len(ports)) as pool:
+                return list(pool.map(self._provision_one, ports))
+        finally:
+            sys.stdout = original_stdout
+
+
+def summarize(results):
+    succeeded = [result for result in results if result.success]
+    lines = [f"{len(succeeded)} of {len(results)} boards provisioned successfully."]
+    for result in results:
+        line = repr(result)
+        if result.log is not None and result.log.path:
+            line += f"  (log: {result.log.path})"
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+class ProgressEvent(object):
+    def __init__(self, kind, port=None, message=None, result=None):
+        self.kind = kind
+        self.port = port
+        self.message = message
+        self.result = result
+
+
+class ProvisioningWorker(threading.Thread):
+    """Runs provisioning in the background, reporting ProgressEvents on a queue.
+
+    The last event is always EVENT_DONE, whose result is the list of
+    ProvisioningResults.
+    """
+
+    def __init__(self, ports, options, events=None, log_dir="logs"):
+        super().__init__(daemon=True)
+        self.ports = list(ports)
+        self.options = options
+        self.events = events if events is not None else queue.Queue()
+        self.log_dir = log_dir
+
+    def _log(self, port, message):
+        self.events.put(ProgressEvent(EVENT_LOG, port=port, message=message))
+
+    def _result(self, result):
+        self.events.put(ProgressEvent(EVENT_RESULT, port=result.port, result=result))
+
+    def run(self):
+        results = list()
+        try:
+            if len(self.ports) == 1:
+                port = self.ports[0]
+                timer = SimpleTimer()
+                timer.start()
+                try:
+                    provision(port, self.options, log=lambda m: self._log(port, m))
+                    result = ProvisioningResult(port, True)
+                except (ProvisioningError, PyboardError) as ex:
+                    self._log(port, f"ERROR: {ex}\n")
+                    result = ProvisioningResult(port, False, error=str(ex))
+                result.elapsed = timer.end_with_results()
+                results.append(result)
+                self._result(result)
+            else:
+                engine = ProvisioningEngine(
+                    self.options,
+                    log_dir=self.log_dir,
+                    on_result=self._result,
+                    on_log=self._log,
+                )
+                results = engine.run(self.ports)
+                self._log(None, summarize(results))
+        except (Exception, PyboardError) as ex:
+            self._log(None, f"ERROR: {ex}\n")
+        finally:
+            self.events.put(ProgressEvent(EVENT_DONE, result=results))
+
+
+class AutoProvisioner(object):
+    """Provisions every USB to UART board plugged in while it runs.
+
+    Boards already connected when it starts are left alone. `on_result` and
+    `on_log` are called like ProvisioningEngine's, from the worker threads,
+    `on_attach` with the ListPortInfo of every board about to be provisioned.
+    """
+
+    def __init__(
+        self,
+        options,
+        max_workers=None,
+        log_dir="logs",
+        on_result=None,
+        on_log=None,
+        on_attach=None,
+        port_filter=None,
+        settle=ATTACH_SETTLE,
+        watcher=None,
+    ):
+        self.options = options
+        self.max_workers = max_workers
+        self.on_attach = on_attach
+        self.port_filter = port_filter or (lambda info: is_usb_uart(info.description))
+        self.settle = settle
+        self.engine = ProvisioningEngine(
+            options, log_dir=log_dir, on_result=on_result, on_log=on_log
+        )
+        self.watcher = watcher or PortWatcher()
+        self.watcher.on_attach = self._attached
+        self.results = list()
+        self._busy = set()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._original_stdout = None
+
+    def start(self):
+        self.options.validate()
+        self._original_stdout = sys.stdout
+        sys.stdout = _ThreadStdout(self._original_stdout)
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="provision"
+        )
+        self.watcher.start()
+        return self
+
+    def stop(self):
+        """Stop watching, wait for running installs and return all results."""
+        self.watcher.stop()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+            sys.stdout = self._original_stdout
+        return list(self.results)
+
+    def _attached(self, info):
+        if not self.port_filter(info):
+            return
+        with self._lock:
+            # A board re-enumerating mid-install must not start a second run.
+            if info.device in self._busy:
+                return
+            self._busy.add(info.device)
+        if self.on_attach:
+            self.on_attach(info)
+        self._pool.submit(self._provision, info.device)
+
+    def _provision(self, port):
+        try:
+            time.sleep(self.settle)
+            result = self.engine._provision_one(port)
+            with self._lock:
+                self.results.append(result)
+        finally:
+            with self._lock:
+                self._busy.discard(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Flash MicroPython firmware and upload a software package to ESP boards."
+    )
+    parser.add_argument(
+        "--port",
+        action="append",
+        default=[],
+        help="serial port of a board, may be given more than once",
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="provision every connected CH340/CP210x board",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="provision every CH340/CP210x board plugged in until Ctrl+C",
+    )
+    parser.add_argument("--firmware", help="firmware image (.bin) to flash")
+    parser.add_argument("--software", help="software package (.zip) to upload")
+    parser.add_argument(
+        "--chip",
+        default=esptool_session.CHIP_AUTO,
+        choices=CHIPS,
+        help="chip on the boards (default: the one last seen on the adapter, or detect it)",
+    )
+    parser.add_argument("--baud", type=int, default=115200, choices=BAUD_RATES)
+    parser.add_argument("--flash-offset", default="0x0", choices=FLASH_OFFSETS)
+    parser.add_argument(
+        "--skip-flash",
+        action="store_true",
+        help="software upload only (skip erase & flash)",
+    )
+    parser.add_argument(
+        "--sync", action="store_true", help="only upload changed files"
+    )
+    parser.add_argument(
+        "--delete-stale",
+        action="store_true",
+        help="delete files on the board that are not in the package",
+    )
+    parser.add_argument(
+        "--fs-image",
+        action="store_true",
+        help="install the software package as a filesystem image",
+    )
+    parser.add_argument(
+        "--transport", default="pipeline", choices=pyb_files.TRANSPORTS
+    )
+    parser.add_argument(
+        "--no-compress",
+        dest="compress",
+        action="store_false",
+        help="send files uncompressed even if the board can inflate them",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=pyb_agent.MAX_RETRIES,
+        help="times a corrupted chunk is sent again before the upload fails",
+    )
+    parser.add_argument(
+        "--no-verify",
+        dest="verify",
+        action="store_false",
+        help="skip having the board check the uploaded files' hashes",
+    )
+    parser.add_argument(
+        "--no-resume",
+        dest="resume",
+        action="store_false",
+        help="upload every file from the start, even after an interrupted upload",
+    )
+    parser.add_argument(
+        "--precompile",
+        action="store_true",
+        help="compile .py files to .mpy with mpy-cross before uploading",
+    )
+    parser.add_argument(
+        "--mpy-cache",
+        default=mpy_cache.CACHE_DIR,
+        help="folder compiled .mpy files are cached in",
+    )
+    parser.add_argument(
+        "--negotiate-baud",
+        action="store_true",
+        help="find the fastest baud rates for esptool and the upload (cached per adapter)",
+    )
+    parser.add_argument(
+        "--package-version",
+        help="version recorded in the board's manifest (default: the zip comment)",
+    )
+    parser.add_argument(
+        "--show-manifest",
+        action="store_true",
+        help="print what is installed on the boards (and what --software would change), then exit",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="boards to provision at once"
+    )
+    parser.add_argument("--log-dir", default="logs", help="per-board log folder")
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        help=f"JSON lines file for per-phase timings (default: <log-dir>/{METRICS_FILE})",
+    )
+    args = parser.parse_args(argv)
+
+    ports = list(args.port)
+    if args.all:
+        ports += [port for port in get_flashable_ports() if port not in ports]
+    if not ports and not args.watch:
+        parser.error("no serial port given (use --port, --all or --watch)")
+
+    if args.show_manifest:
+        for port in ports:
+            try:
+                installed, diff = read_board_manifest(port, args.software)
+            except PyboardError as ex:
+                print(f"{port}: can't read manifest: {ex}")
+                continue
+            if installed is None:
+                print(f"{port}: no manifest")
+            else:
+                print(
+                    f"{port}: {installed.package} version {installed.version}, "
+                    f"{len(installed.files)} files, digest {installed.digest()[:12]}"
+                )
+            if diff is not None:
+                print(", ".join(f"{len(paths)} {kind}" for kind, paths in diff.items()))
+        return 0
+
+    options = InstallOptions(
+        firmware=args.firmware,
+        software=args.software,
+        chip=args.chip,
+        baud_rate=args.baud,
+        flash_offset=args.flash_offset,
+        skip_flash=args.skip_flash,
+        sync=args.sync,
+        delete_stale=args.delete_stale,
+        fs_image=args.fs_image,
+        transport=args.transport,
+        compress=args.compress,
+        precompile=args.precompile,
+        mpy_cache_dir=args.mpy_cache,
+        negotiate_baud=args.negotiate_baud,
+        metrics_file=args.metrics or os.path.join(args.log_dir, METRICS_FILE),
+        package_version=args.package_version,
+        resume=args.resume,
+        retries=args.retries,
+        verify=args.verify,
+    )
+    try:
+        options.validate()
+    except ProvisioningError as ex:
+        parser.error(str(ex))
+
+    if args.watch:
+        auto = AutoProvisioner(
+            options,
+            max_workers=args.workers,
+            log_dir=args.log_dir,
+            on_result=lambda result: sys.__stdout__.write(f"{result!r}\n"),
+            on_attach=lambda info: sys.__stdout__.write(
+                f"{info.device}: new board ({info.description}), provisioning.\n"
+            ),
+        )
+        auto.start()
+        print("Waiting for boards to be plugged in, press Ctrl+C to stop.")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print("Stopping, waiting for running installs to finish.")
+        results = auto.stop()
+        print(summarize(results))
+        return 0 if all(result.success for result in results) else 1
+
+    if len(ports) == 1:
+        try:
+            provision(ports[0], options, log=sys.stdout.write)
+        except (ProvisioningError, PyboardError) as ex:
+            print(f"\n\nERROR: {ex}")
+            return 1
+        return 0
+
+    engine = ProvisioningEngine(
+        options,
+        max_workers=args.workers,
+        log_dir=args.log_dir,
+        on_result=lambda result: sys.__stdout__.write(f"{result!r}\n"),
+    )
+    results = engine.run(ports)
+    print(summarize(results))
+    return 0 if all(result.success for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,547 @@
+import collections
+import heapq
+import struct
+import zlib
+
+import instrumentation
+
+from pyboard import PyboardError
+
+# Receiver stub injected onto the board. It reads length-prefixed frames from
+# sys.stdin.buffer into one preallocated buffer and answers every frame with a
+# single ack byte, so a whole package streams through one raw REPL exec.
+#
+#   frame: op (1 byte) | payload length (uint32 LE) | payload
+#   ops:   O = open path for writing, P = open path for appending,
+#          W = write payload, C = close, M = rename "src\0dst",
+#          I = inflate "src\0dst" with the _inflate() an earlier exec of
+#          pyb_files.INFLATE_COMMAND defined, Q = quit
+#   acks:  A = ok, E<message>\n = the operation failed
+AGENT_SOURCE = """
+import sys, micropython
+try:
+    import os
+except ImportError:
+    import uos as os
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+def _agent(size):
+    r = sys.stdin.buffer
+    w = getattr(sys.stdout, "buffer", sys.stdout)
+    buf = bytearray(size)
+    mv = memoryview(buf)
+    hdr = bytearray(5)
+    f = None
+    w.write(b"R")
+    while True:
+        r.readinto(hdr)
+        op = hdr[0]
+        n = struct.unpack_from("<I", hdr, 1)[0]
+        if n:
+            r.readinto(mv[:n])
+        try:
+            if op == 79 or op == 80:
+                f = open(str(buf[:n], "utf-8"), "wb" if op == 79 else "ab")
+            elif op == 87:
+                f.write(mv[:n])
+            elif op == 67:
+                f.close()
+                f = None
+            elif op == 77:
+                src, dst = str(buf[:n], "utf-8").split("\\x00")
+                os.rename(src, dst)
+            elif op == 73:
+                src, dst = str(buf[:n], "utf-8").split("\\x00")
+                _inflate(src, dst)
+            elif op == 81:
+                if f:
+                    f.close()
+                w.write(b"A")
+                return
+            w.write(b"A")
+        except Exception as e:
+            w.write(b"E" + repr(e).encode() + b"\\n")
+micropython.kbd_intr(-1)
+try:
+    _agent({size})
+finally:
+    micropython.kbd_intr(3)
+"""
+
+# Pipelined variant of the stub. Frames carry a sequence number that the
+# board's answer repeats, and the host keeps sending while earlier frames are
+# still being written to flash. The board only leaves received bytes sitting
+# in its UART RX buffer while it is busy with a frame, so the host never sends
+# more than `window` bytes past the end of the oldest unacknowledged frame.
+#
+#   frame:  op (1 byte) | seq (uint16 LE) | payload length (uint16 LE)
+#           | file offset (uint32 LE) | payload crc32 (uint32 LE)
+#           | header check (uint16 LE, low half of the crc32 of the 13 bytes
+#             before) | payload
+#   ops:    as above, plus X = abort, which ends the stub unconditionally
+#   answer: A<seq> = frame done, E<seq><message>\n = frame failed,
+#           N<seq> = frame arrived corrupted, H<seq> = frame held back,
+#           S = header corrupted, the board skips everything up to SYNC_MARKER
+#               and answers Y
+#
+# Where the firmware has binascii.crc32 the board checks both crcs. A frame
+# with a bad payload is answered N and sent again on its own: writes carry
+# their file offset, so later writes to the same file go ahead meanwhile.
+# Every other frame after it is held back (answered H, to be sent again)
+# until it got through.
+PIPELINED_AGENT_SOURCE = """
+import sys, micropython
+try:
+    import os
+except ImportError:
+    import uos as os
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+try:
+    import binascii
+except ImportError:
+    import ubinascii as binascii
+def _resync(r):
+    tail = bytes(8)
+    while tail != {marker}:
+        tail = tail[1:] + r.read(1)
+def _held(missing, seq, op):
+    for s, o in missing:
+        if s == seq:
+            return False
+        if o != 87 or op != 87:
+            return True
+    return False
+def _agent(size, check):
+    r = sys.stdin.buffer
+    w = getattr(sys.stdout, "buffer", sys.stdout)
+    buf = bytearray(size)
+    mv = memoryview(buf)
+    hdr = bytearray(15)
+    hv = memoryview(hdr)
+    crc = getattr(binascii, "crc32", None) if check else None
+    f = None
+    missing = []
+    w.write(b"RC" if crc else b"R-")
+    while True:
+        r.readinto(hdr)
+        if crc and crc(hv[:13]) & 0xFFFF != struct.unpack_from("<H", hdr, 13)[0]:
+            w.write(b"S")
+            _resync(r)
+            missing = []
+            w.write(b"Y")
+            continue
+        op = hdr[0]
+        seq = bytes(hdr[1:3])
+        n, pos, want = struct.unpack_from("<HII", hdr, 3)
+        if n:
+            r.readinto(mv[:n])
+        if op != 88:
+            if crc and crc(mv[:n]) != want:
+                answer = b"N"
+            elif _held(missing, seq, op):
+                answer = b"H"
+            else:
+                answer = None
+            if answer:
+                if not [m for m in missing if m[0] == seq]:
+                    missing.append((seq, op))
+                w.write(answer + seq)
+                continue
+        missing = [m for m in missing if m[0] != seq]
+        try:
+            if op == 79:
+                f = open(str(buf[:n], "utf-8"), "wb")
+            elif op == 80:
+                f = open(str(buf[:n], "utf-8"), "r+b")
+                f.seek(0, 2)
+            elif op == 87:
+                if f.tell() != pos:
+                    f.seek(pos)
+                f.write(mv[:n])
+            elif op == 67:
+                f.close()
+                f = None
+            elif op == 77:
+                src, dst = str(buf[:n], "utf-8").split("\\x00")
+                os.rename(src, dst)
+            elif op == 73:
+                src, dst = str(buf[:n], "utf-8").split("\\x00")
+                _inflate(src, dst)
+            elif op == 81 or op == 88:
+                if f:
+                    f.close()
+                w.write(b"A" + seq)
+                return
+            w.write(b"A" + seq)
+        except Exception as e:
+            w.write(b"E" + seq + repr(e).encode() + b"\\n")
+micropython.kbd_intr(-1)
+try:
+    _agent({size}, {check})
+finally:
+    micropython.kbd_intr(3)
+"""
+
+# Sent by the host after the board answered S. Skipped over until then, so it
+# only has to be unlikely in a garbled stream, not impossible in file data.
+SYNC_MARKER = b"\x00\xffSYNC\xff\x00"
+
+# Seconds to wait for the board's Y before sending SYNC_MARKER again.
+SYNC_TIMEOUT = 1.0
+
+# Times one frame is sent again after arriving corrupted before giving up.
+MAX_RETRIES = 5
+
+# Bytes the board can buffer while it is busy, when it didn't report a
+# raw-paste window. The smallest stdin buffer of the supported ports.
+PIPELINE_WINDOW = 256
+
+# Frames sent but not acknowledged yet, at most.
+MAX_IN_FLIGHT = 16
+
+# Largest pipelined frame, whatever the board's RAM allows. A frame is checked
+# and sent again as a whole, so on a noisy link a RAM-sized frame would almost
+# never get through; small frames also overlap more with the board's writes.
+PIPELINE_FRAME_SIZE = 1024
+
+OP_OPEN = b"O"
+OP_APPEND = b"P"
+OP_WRITE = b"W"
+OP_CLOSE = b"C"
+OP_RENAME = b"M"
+OP_INFLATE = b"I"
+OP_QUIT = b"Q"
+OP_ABORT = b"X"
+
+
+class UploadAgent(object):
+    """Host side of the upload agent; the AsyncPyboard must already be in raw REPL."""
+
+    def __init__(self, pyboard, frame_size):
+        self._pyboard = pyboard
+        self.frame_size = frame_size
+        self.running = False
+
+    async def start(self):
+        await self._pyboard.exec_raw_no_follow(
+            AGENT_SOURCE.replace("{size}", str(self.frame_size))
+        )
+        ready = await self._pyboard.read_exact(1)
+        if ready != b"R":
+            # The stub failed before it could start, collect the traceback.
+            data, data_err = await self._pyboard.follow(10)
+            raise PyboardError("exception", ready + data, data_err)
+        self.running = True
+
+    async def _send(self, op, payload=b""):
+        if len(payload) > self.frame_size:
+            raise ValueError("frame larger than agent buffer")
+        await self._pyboard.write(op + struct.pack("<I", len(payload)))
+        await self._pyboard.write(payload)
+        ack = await self._pyboard.read_exact(1)
+        if ack == b"A":
+            return
+        if ack == b"E":
+            message = await self._pyboard.read_until(1, b"\n")
+            raise PyboardError("exception", b"", message)
+        raise PyboardError("unexpected agent reply: {}".format(ack))
+
+    async def open(self, path, offset=0):
+        """Open `path` for writing, or for appending at `offset`, its size."""
+        await self._send(OP_APPEND if offset else OP_OPEN, path.encode("utf-8"))
+
+    async def write(self, data):
+        for i in range(0, len(data), self.frame_size):
+            await self._send(OP_WRITE, data[i : i + self.frame_size])
+
+    async def close(self):
+        await self._send(OP_CLOSE)
+
+    async def rename(self, src, dst):
+        await self._send(OP_RENAME, f"{src}\0{dst}".encode("utf-8"))
+
+    async def inflate(self, src, dst):
+        await self._send(OP_INFLATE, f"{src}\0{dst}".encode("utf-8"))
+
+    async def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        await self._send(OP_QUIT)
+        data, data_err = await self._pyboard.follow(10)
+        if data_err:
+            raise PyboardError("exception", data, data_err)
+
+    async def abort(self):
+        """Stop a still responsive agent after a failed operation."""
+        try:
+            await self.stop()
+        except PyboardError:
+            pass
+
+
+class AgentError(PyboardError):
+    """A frame the pipelined agent failed, with the file and offset it was for."""
+
+    def __init__(self, seq, path, offset, message):
+        where = path if offset is None else f"{path} at offset {offset}"
+        super().__init__("exception", b"", f"{where}: {message}".encode("utf-8"))
+        self.seq = seq
+        self.path = path
+        self.offset = offset
+        self.message = message
+
+
+class _Frame(object):
+    """A frame for the pipelined agent, kept until the board answered it."""
+
+    def __init__(self, index, seq, op, payload, path, offset):
+        self.index = index
+        self.seq = seq
+        self.op = op
+        self.path = path
+        self.offset = offset
+        head = op + struct.pack(
+            "<HHII", seq, len(payload), offset or 0, zlib.crc32(payload)
+        )
+        self.data = head + struct.pack("<H", zlib.crc32(head) & 0xFFFF) + payload
+        # Stream offset of the frame's end, as last sent.
+        self.end = None
+        self.attempts = 0
+
+
+class PipelinedAgent(UploadAgent):
+    """Upload agent that keeps frames in flight instead of waiting for each ack.
+
+    While the board writes one frame, at most `window` bytes of the next
+    frames are sent, so they fit its UART RX buffer; the window defaults to
+    the board's raw-paste window. At most `max_in_flight` frames are
+    unacknowledged at any time. Frames are at most `max_frame_size` bytes
+    even when `frame_size` is larger. With `checksums` set (and a board that
+    has binascii.crc32) a frame that arrives corrupted is sent again, up to
+    `retries` times.
+    """
+
+    def __init__(
+        self,
+        pyboard,
+        frame_size,
+        window=None,
+        max_in_flight=MAX_IN_FLIGHT,
+        checksums=True,
+        retries=MAX_RETRIES,
+        max_frame_size=PIPELINE_FRAME_SIZE,
+    ):
+        frame_size = min(frame_size, max_frame_size)
+        if frame_size > 0xFFFF:
+            raise ValueError("pipelined agent frames are at most 64 KiB")
+        super().__init__(pyboard, frame_size)
+        self.window = window or pyboard.raw_paste_window or PIPELINE_WINDOW
+        self.max_in_flight = max_in_flight
+        self.checksums = checksums
+        self.retries = retries
+        self.retransmits = 0
+        self.resyncs = 0
+        self._seq = 0
+        self._index = 0
+        self._sent = 0
+        # seq -> _Frame of every frame sent but not answered yet, oldest first.
+        self._in_flight = collections.OrderedDict()
+        # (index, _Frame) heap of frames waiting to be sent, first frame first.
+        self._queue = list()
+        self._error = None
+        self._path = None
+        self._offset = None
+
+    async def start(self):
+        source = PIPELINED_AGENT_SOURCE.replace("{marker}", repr(SYNC_MARKER))
+        source = source.replace("{size}", str(self.frame_size))
+        source = source.replace("{check}", str(int(self.checksums)))
+        await self._pyboard.exec_raw_no_follow(source)
+        ready = await self._pyboard.read_exact(2)
+        if ready[:1] != b"R":
+            data, data_err = await self._pyboard.follow(10)
+            raise PyboardError("exception", ready + data, data_err)
+        # The board tells whether it checks crcs, old firmware can't.
+        self.checksums = ready == b"RC"
+        self.running = True
+
+    def _retry(self, frame, corrupted=True):
+        """Queue `frame` to be sent again.
+
+        Frames that were only held back don't count against `retries`. Like
+        a failed frame, one that runs out of retries fails the upload at the
+        next frame boundary.
+        """
+        if self._error is not None and frame.op != OP_ABORT:
+            return
+        if corrupted:
+            frame.attempts += 1
+        if frame.attempts > self.retries:
+            self._error = AgentError(
+                frame.seq,
+                frame.path,
+                frame.offset,
+                f"arrived corrupted {frame.attempts} times",
+            )
+            return
+        self.retransmits += 1
+        instrumentation.count(retransmits=1)
+        heapq.heappush(self._queue, (frame.index, frame))
+
+    async def _resync(self):
+        """Get back in step with a board that lost track of the frames."""
+        self.resyncs += 1
+        instrumentation.count(resyncs=1)
+        lost = list(self._in_flight.values())
+        self._in_flight.clear()
+        for _ in range(self.retries + 1):
+            await self._pyboard.write(SYNC_MARKER)
+            if await self._pyboard.read_exact(1, timeout=SYNC_TIMEOUT) == b"Y":
+                break
+        else:
+            raise PyboardError("agent lost sync")
+        # Nothing after the last answer got through.
+        for frame in lost:
+            self._retry(frame)
+
+    async def _receive(self):
+        """Handle one answer from the board."""
+        kind = await self._pyboard.read_exact(1)
+        if kind == b"S":
+            await self._resync()
+            return
+        if kind not in (b"A", b"E", b"N", b"H"):
+            raise PyboardError("unexpected agent reply: {}".format(kind))
+        header = await self._pyboard.read_exact(2)
+        if len(header) != 2:
+            raise PyboardError("agent stopped responding")
+        seq = struct.unpack("<H", header)[0]
+        frame = self._in_flight.pop(seq, None)
+        if kind in (b"N", b"H"):
+            if frame is not None:
+                self._retry(frame, corrupted=kind == b"N")
+        elif kind == b"E":
+            message = await self._pyboard.read_until(1, b"\n")
+            if self._error is None:
+                self._error = AgentError(
+                    seq,
+                    frame and frame.path,
+                    frame and frame.offset,
+                    message.decode("utf-8", "replace").strip(),
+                )
+
+    async def _transmit(self, frame):
+        data = frame.data
+        frame.end = self._sent + len(data)
+        self._in_flight[frame.seq] = frame
+        sent = 0
+        while sent < len(data):
+            # Pick up answers that already arrived without waiting.
+            while self._pyboard.in_waiting():
+                await self._receive()
+            if frame.seq not in self._in_flight:
+                # The board lost sync, the frame is queued to go out again.
+                return
+            oldest_end = next(iter(self._in_flight.values())).end
+            room = oldest_end + self.window - self._sent
+            if room <= 0:
+                await self._receive()
+                continue
+            n = min(room, len(data) - sent)
+            await self._pyboard.write(data[sent : sent + n])
+            self._sent += n
+            sent += n
+
+    async def _pump(self):
+        """Send the queued frames, as far as the in-flight limit allows."""
+        while self._queue:
+            if len(self._in_flight) >= self.max_in_flight:
+                await self._receive()
+                continue
+            _, frame = heapq.heappop(self._queue)
+            if self._error is None or frame.op == OP_ABORT:
+                await self._transmit(frame)
+
+    async def _send(self, op, payload=b""):
+        if len(payload) > self.frame_size:
+            raise ValueError("frame larger than agent buffer")
+        # After a failed frame only the abort frame goes out, to end the stub.
+        if self._error is not None and op != OP_ABORT:
+            raise self._error
+        if op == OP_ABORT:
+            self._queue.clear()
+        frame = _Frame(
+            self._index,
+            self._seq,
+            op,
+            payload,
+            self._path,
+            self._offset if op == OP_WRITE else None,
+        )
+        self._index += 1
+        self._seq = (self._seq + 1) & 0xFFFF
+        heapq.heappush(self._queue, (frame.index, frame))
+        await self._pump()
+        if self._error is not None and op != OP_ABORT:
+            raise self._error
+
+    async def open(self, path, offset=0):
+        self._path = path
+        self._offset = None
+        await self._send(OP_APPEND if offset else OP_OPEN, path.encode("utf-8"))
+        self._offset = offset
+
+    async def write(self, data):
+        for i in range(0, len(data), self.frame_size):
+            frame = data[i : i + self.frame_size]
+            await self._send(OP_WRITE, frame)
+            self._offset += len(frame)
+
+    async def close(self):
+        await self._send(OP_CLOSE)
+        self._path = None
+        self._offset = None
+
+    async def rename(self, src, dst):
+        self._path = dst
+        await self._send(OP_RENAME, f"{src}\0{dst}".encode("utf-8"))
+        self._path = None
+
+    async def inflate(self, src, dst):
+        self._path = dst
+        await self._send(OP_INFLATE, f"{src}\0{dst}".encode("utf-8"))
+        self._path = None
+
+    async def stop(self):
+        await self._finish(OP_QUIT if self._error is None else OP_ABORT)
+
+    async def abort(self):
+        try:
+            await self._finish(OP_ABORT)
+        except PyboardError:
+            pass
+
+    async def _finish(self, op):
+        """End the stub with `op`, once every frame before it got through."""
+        if not self.running:
+            return
+        self.running = False
+        self._path = None
+        self._offset = None
+        await self._send(op)
+        while self._in_flight or self._queue:
+            if self._queue:
+                await self._pump()
+            else:
+                await self._receive()
+        data, data_err = await self._pyboard.follow(10)
+        if self._error is not None:
+            raise self._error
+        if data_err:
+            raise PyboardError("exception", data, data_err)
@@ -1,94 +1,1102 @@
+import asyncio
+import binascii
+import collections
+import contextlib
+import functools
+import hashlib
+import io
+import os
+import tempfile
 import textwrap
 import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
+import instrumentation
+from manifest import MANIFEST_PATH
+from manifest import Manifest
 from pyboard import PyboardError
+from pyb_agent import MAX_RETRIES
+from pyb_agent import PipelinedAgent
+from pyb_agent import UploadAgent
+from software_package import PackageFile
+from software_package import package_files
 
 BUFFER_SIZE = 1024
+MIN_BUFFER_SIZE = 256
+MAX_BUFFER_SIZE = 16384
+
+# Chunk encodings understood by Files.put.
+#   "repr"   - python bytes literal, compact for text but up to 4x for binary.
+#   "base64" - decoded on the board with ubinascii.a2b_base64, a flat 4/3 growth.
+#   "auto"   - whichever of the two is shorter, decided per chunk.
+ENCODINGS = ("auto", "base64", "repr")
+
+# How Files.put moves data onto the board.
+#   "exec"  - one raw REPL exec per open, chunk and close.
+#   "agent" - a receiver stub streams every file through a single exec.
+#   "pipeline" - like "agent", but keeps sending while earlier chunks are
+#                still being written, within the board's UART RX buffer.
+TRANSPORTS = ("exec", "agent", "pipeline")
+
+
+# Hashes files on the board in a single exec. Prints "<sha256 hex> <size> <path>"
+# for every file in PATHS, or for every file on the filesystem when PATHS is None.
+HASH_FILES_COMMAND = """
+try:
+    import os
+except ImportError:
+    import uos as os
+try:
+    import hashlib
+except ImportError:
+    import uhashlib as hashlib
+try:
+    import binascii
+except ImportError:
+    import ubinascii as binascii
+def _hash(path, buf, mv):
+    h = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(mv[:n])
+            size += n
+    print(str(binascii.hexlify(h.digest()), "ascii"), size, path)
+def _walk(directory, buf, mv):
+    for entry in os.ilistdir(directory):
+        path = directory.rstrip("/") + "/" + entry[0]
+        if entry[1] & 0x4000:
+            _walk(path, buf, mv)
+        else:
+            _hash(path, buf, mv)
+def _hash_files(paths):
+    buf = bytearray(512)
+    mv = memoryview(buf)
+    if paths is None:
+        _walk("/", buf, mv)
+        return
+    for path in paths:
+        try:
+            _hash(path, buf, mv)
+        except OSError:
+            pass
+_hash_files({paths})
+"""
+
+# Checks files on the board against their expected size and sha256, reading
+# each one through a small reused buffer. FILES is a list of (path, size,
+# sha256 hex) and only mismatches are printed, as "missing <path>",
+# "size <path>" or "hash <path>".
+VERIFY_FILES_COMMAND = """
+try:
+    import os
+except ImportError:
+    import uos as os
+try:
+    import hashlib
+except ImportError:
+    import uhashlib as hashlib
+try:
+    import binascii
+except ImportError:
+    import ubinascii as binascii
+def _verify(files):
+    buf = bytearray(512)
+    mv = memoryview(buf)
+    for path, size, digest in files:
+        try:
+            if os.stat(path)[6] != size:
+                print("size", path)
+                continue
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    h.update(mv[:n])
+        except OSError:
+            print("missing", path)
+            continue
+        if binascii.hexlify(h.digest()) != digest:
+            print("hash", path)
+_verify({files})
+"""
+
+# Files checked per exec by Files.verify and Files.hash_files, which keeps the
+# command well within the board's RAM (about 100 bytes per file).
+VERIFY_BATCH = 100
+
+# Prints the manifest the uploader left on the board, nothing if there is none.
+READ_MANIFEST_COMMAND = """
+import sys
+try:
+    with open({path!r}) as f:
+        while True:
+            text = f.read(512)
+            if not text:
+                break
+            sys.stdout.write(text)
+except OSError:
+    pass
+"""
+
+# Creates the directories in order, printing "+path" for each one created and
+# "=path" for each one that already existed. A file in the way of a directory
+# fails like os.mkdir would.
+MKDIR_COMMAND = """
+try:
+    import os
+except ImportError:
+    import uos as os
+for path in {paths}:
+    try:
+        os.mkdir(path)
+        print("+" + path)
+    except OSError as e:
+        # 17 is EEXIST on every port.
+        if e.args[0] != 17 or not os.stat(path)[0] & 0x4000:
+            raise
+        print("=" + path)
+"""
+
+# Compressed uploads. Files are zlib-compressed on the host with a small
+# window so the board needs little RAM to inflate them, uploaded next to their
+# final path and inflated on the board once the transfer is done.
+COMPRESSION_LEVEL = 9
+COMPRESSION_WBITS = 10
+COMPRESSION_MIN_SIZE = 256
+COMPRESSION_MAX_RATIO = 0.9
+COMPRESSED_SUFFIX = ".zlib~"
+
+# Defines _inflate(src, dst) on the board. Raises if the firmware has neither
+# deflate.DeflateIO (v1.21+) nor (u)zlib.DecompIO.
+INFLATE_COMMAND = """
+try:
+    import os
+except ImportError:
+    import uos as os
+try:
+    import deflate
+    def _inflate_open(f):
+        return deflate.DeflateIO(f, deflate.ZLIB)
+except ImportError:
+    try:
+        import zlib
+    except ImportError:
+        import uzlib as zlib
+    _decompio = zlib.DecompIO
+    def _inflate_open(f):
+        return _decompio(f, {wbits})
+def _inflate(src, dst):
+    buf = bytearray(512)
+    mv = memoryview(buf)
+    with open(src, "rb") as fi:
+        d = _inflate_open(fi)
+        with open(dst + {suffix!r}, "wb") as fo:
+            while True:
+                n = d.readinto(buf)
+                if not n:
+                    break
+                fo.write(mv[:n])
+    os.rename(dst + {suffix!r}, dst)
+    os.remove(src)
+"""
+
+# Files of at least PART_MIN_SIZE bytes are written next to their final path
+# and renamed into place once complete, so the board never runs a half
+# written module; an interrupted one is resumed from the temp file.
+PART_MIN_SIZE = 8 * 1024
+PART_SUFFIX = ".part~"
+
+# Files are read, hashed and compressed on worker threads ahead of the upload,
+# at most PREFETCH_FILES files and PREFETCH_BYTES bytes ahead of the serial
+# link (always at least the next file).
+PREPARE_WORKERS = min(4, os.cpu_count() or 1)
+PREFETCH_FILES = 8
+PREFETCH_BYTES = 4 * 1024 * 1024
+
+# Files up to PREPARE_MAX_SIZE are read into memory ahead of the upload.
+# Larger ones are streamed from the package chunk by chunk, and their
+# compressed stand-ins spill to a temporary file.
+PREPARE_MAX_SIZE = 1024 * 1024
+
+RENAME_COMMAND = """
+try:
+    import os
+except ImportError:
+    import uos as os
+os.rename({src!r}, {dst!r})
+"""
+
+REMOVE_FILES_COMMAND = """
+try:
+    import os
+except ImportError:
+    import uos as os
+for path in {paths}:
+    try:
+        os.remove(path)
+        print(path)
+    except OSError:
+        pass
+"""
 
 
 class DirectoryExistsError(Exception):
     ...
 
 
-class Files(object):
-    def __init__(self, pyboard):
+class SpooledFile(PackageFile):
+    """A PackageFile whose data is in a tempfile.SpooledTemporaryFile.
+
+    Every open() rewinds the same file, which is fine for the upload reading
+    one file at a time. The file goes away with the last reference to it.
+    """
+
+    def __init__(self, path, spool, sha256=None):
+        super().__init__(path, spool.seek(0, io.SEEK_END), self._rewind)
+        self._spool = spool
+        self._sha256 = sha256
+
+    def _rewind(self):
+        self._spool.seek(0)
+        return _Unclosed(self._spool)
+
+
+class _Unclosed(object):
+    # Hands out a stream without closing it at the end of a with block.
+    def __init__(self, stream):
+        self._stream = stream
+
+    def __enter__(self):
+        return self._stream
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def compress_file(entry):
+    """Return a compressed stand-in for `entry`, or None if it doesn't pay off.
+
+    The stand-in is uploaded to the entry's path plus COMPRESSED_SUFFIX and
+    has to be inflated to the entry's path on the board afterwards. The
+    entry is compressed chunk by chunk; past PREPARE_MAX_SIZE, the result
+    spills to disk rather than memory.
+    """
+    if entry.size < COMPRESSION_MIN_SIZE:
+        return None
+    limit = entry.size * COMPRESSION_MAX_RATIO
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, COMPRESSION_WBITS)
+
+    def compressed_chunks():
+        for chunk in entry.chunks():
+            yield compressor.compress(chunk)
+        yield compressor.flush()
+
+    spool = tempfile.SpooledTemporaryFile(max_size=PREPARE_MAX_SIZE)
+    h = hashlib.sha256()
+    for chunk in compressed_chunks():
+        h.update(chunk)
+        spool.write(chunk)
+        if spool.tell() > limit:
+            spool.close()
+            return None
+    return SpooledFile(entry.path + COMPRESSED_SUFFIX, spool, h.hexdigest())
+
+
+def prefix_sha256(entry, size):
+    """The sha256 hex digest of the first `size` bytes of `entry`."""
+    h = hashlib.sha256()
+    for chunk in entry.chunks():
+        h.update(chunk[:size])
+        size -= len(chunk)
+        if size <= 0:
+            break
+    return h.hexdigest()
+
+
+def prepare_file(entry, compress=False):
+    """Hash `entry`, and compress it if asked and that pays off.
+
+    Files up to PREPARE_MAX_SIZE are read into memory here; larger ones are
+    hashed chunk by chunk and left to be streamed from the package. Returns
+    the file to send and its compressed stand-in (or None), both already
+    hashed. Runs on a worker thread; zipfile, zlib and hashlib let go of the
+    GIL while they work on large buffers.
+    """
+    if entry.size > PREPARE_MAX_SIZE:
+        entry.sha256()
+        loaded = entry
+    else:
+        data = entry.load()
+        loaded = PackageFile.from_bytes(entry.path, data, entry.sha256())
+    compressed = compress_file(loaded) if compress else None
+    return loaded, compressed
+
+
+class Prefetcher(object):
+    """Runs `prepare` on upcoming `files` in a worker pool, in order.
+
+    Iterating it yields each file's result as the consumer gets to it, with
+    at most `max_files` files and `max_bytes` bytes prepared ahead.
+    """
+
+    def __init__(
+        self,
+        files,
+        prepare,
+        workers=PREPARE_WORKERS,
+        max_files=PREFETCH_FILES,
+        max_bytes=PREFETCH_BYTES,
+    ):
+        self._files = iter(files)
+        self._prepare = prepare
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="prepare")
+        self._pending = collections.deque()
+        self._pending_bytes = 0
+
+    def fill(self):
+        """Queue upcoming files until the prefetch limits are reached."""
+        loop = asyncio.get_running_loop()
+        while len(self._pending) < self.max_files and (
+            not self._pending or self._pending_bytes < self.max_bytes
+        ):
+            entry = next(self._files, None)
+            if entry is None:
+                break
+            future = loop.run_in_executor(self._pool, self._prepare, entry)
+            self._pending.append((entry.size, future))
+            self._pending_bytes += entry.size
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self.fill()
+        if not self._pending:
+            raise StopAsyncIteration
+        size, future = self._pending.popleft()
+        self._pending_bytes -= size
+        result = await future
+        self.fill()
+        return result
+
+    async def close(self):
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        # Waiting for a file still being prepared must not hold up the loop.
+        await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self._pool.shutdown, wait=True, cancel_futures=True)
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+def error_message(ex):
+    """The board's traceback of a failed exec, or the PyboardError's message."""
+    if len(ex.args) > 2:
+        return ex.args[2].decode("utf-8", "replace")
+    return str(ex)
+
+
+def device_path(path):
+    """Normalize a package path to the absolute form the board reports."""
+    return "/" + path.lstrip("/")
+
+
+def resume_offset(entry, journal, device_files):
+    """Where an interrupted upload of `entry` can pick up again.
+
+    `device_files` are the board's {device path: (size, sha256)} of the
+    paths in the TransferJournal `journal`. Returns None when the board has
+    the file already, the size of its temp file when that is a prefix of the
+    data, and 0 when it has to be sent from the start.
+    """
+    sha256 = entry.sha256()
+    expected = (entry.size, sha256)
+    if (
+        journal.files.get(entry.path) == expected
+        and device_files.get(device_path(entry.path)) == expected
+    ):
+        return None
+    partial = journal.partial
+    if (
+        partial is None
+        or partial["path"] != entry.path
+        or (partial["size"], partial["sha256"]) != expected
+    ):
+        return 0
+    size, digest = device_files.get(device_path(partial["temp"]), (None, None))
+    if size is None or size > entry.size:
+        return 0
+    if prefix_sha256(entry, size) != digest:
+        return 0
+    return size
+
+
+class ExecTransport(object):
+    """Writes files with one raw REPL exec per operation."""
+
+    def __init__(self, pyboard, encoding, chunk_size):
         self._pyboard = pyboard
+        self.encoding = encoding
+        self.chunk_size = chunk_size
 
-    def mkdir(self, directory=None, exists_okay=True, directory_list: list = None):
+    async def start(self):
+        pass
+
+    async def open(self, path, offset=0):
+        mode = "ab" if offset else "wb"
+        await self._pyboard.exec_("f = open('{0}', '{1}')".format(path, mode))
+
+    async def write(self, data):
+        for i in range(0, len(data), self.chunk_size):
+            chunk = AsyncFiles.encode_chunk(
+                data[i : i + self.chunk_size], self.encoding
+            )
+            await self._pyboard.exec_("f.write({0})".format(chunk))
+
+    async def close(self):
+        await self._pyboard.exec_("f.close()")
+
+    async def rename(self, src, dst):
+        await self._pyboard.exec_(RENAME_COMMAND.format(src=src, dst=dst))
+
+    async def inflate(self, src, dst):
+        await self._pyboard.exec_("_inflate({0!r}, {1!r})".format(src, dst))
+
+    async def stop(self):
+        pass
+
+    async def abort(self):
+        # Close the file, so a retry in the same session resumes from what
+        # reached the flash. A session that lost sync is entered again with
+        # a soft reset, which closes it anyway.
+        if not self._pyboard.in_raw_repl:
+            return
+        try:
+            await self._pyboard.exec_("try:\n    f.close()\nexcept Exception:\n    pass")
+        except PyboardError:
+            pass
+
+
+class AsyncFiles(object):
+    """File operations on a board through an AsyncPyboard."""
+
+    def __init__(self, pyboard, keep_raw_repl=False):
+        self._pyboard = pyboard
+        # Reuse one raw REPL session across operations instead of entering
+        # (and soft rebooting into) raw REPL for every call.
+        self.keep_raw_repl = keep_raw_repl
+
+    async def _enter_raw_repl(self):
         try:
-            self._pyboard.enter_raw_repl()
+            await self._pyboard.enter_raw_repl(reuse=self.keep_raw_repl)
         except PyboardError:
             raise PyboardError
 
-        if directory_list is not None:
-            if directory is not None:
-                directory_list.append(directory)
-            for dir in directory_list:
-
-                # Execute os.mkdir command on the board.
-                command = """
-                    try:
-                        import os
-                    except ImportError:
-                        import uos as os
-                    os.mkdir('{0}')
-                """.format(
-                    dir
-                )
-                try:
-                    self._pyboard.exec_(textwrap.dedent(command))
-                    print(f"Directory Created: {dir}")
-                except PyboardError as ex:
-                    # Check if this is an OSError #17, i.e. directory already exists.
-                    if (
-                        ex.args[2].decode("utf-8").find("OSError: [Errno 17] EEXIST")
-                        != -1
-                    ):
-                        if not exists_okay:
-                            raise DirectoryExistsError(
-                                "Directory already exists: {0}".format(directory)
-                            )
-                        if exists_okay:
-                            print(f"Directory already exists -> Verified: {dir}")
-                    else:
-                        raise ex
+    async def _exit_raw_repl(self):
+        if not self.keep_raw_repl:
+            await self._pyboard.exit_raw_repl()
 
-        self._pyboard.exit_raw_repl()
+    @contextlib.asynccontextmanager
+    async def _session(self):
+        # One raw REPL session for several operations, which would otherwise
+        # each enter (and soft reboot into) their own.
+        keep_raw_repl = self.keep_raw_repl
+        await self._enter_raw_repl()
+        self.keep_raw_repl = True
+        try:
+            yield
+        finally:
+            self.keep_raw_repl = keep_raw_repl
+        await self._exit_raw_repl()
 
-    def put(
-        self,
-        files_and_data_to_bulk_write,
+    async def mkdir(
+        self, directory=None, exists_okay=True, directory_list: list = None
     ):
+        """Create `directory` and/or every directory in `directory_list`.
+
+        All directories are created in one exec, in the given order, so
+        parents have to come before their children. Returns a dict with the
+        "created" and "existing" directories.
+        """
+        directories = list(directory_list or [])
+        if directory is not None:
+            directories.append(directory)
+        report = {"created": [], "existing": []}
+        if not directories:
+            return report
+
+        await self._enter_raw_repl()
+        ret = await self._pyboard.exec_(MKDIR_COMMAND.format(paths=repr(directories)))
+        await self._exit_raw_repl()
+
+        for line in ret.decode("utf-8").splitlines():
+            line = line.strip()
+            if line.startswith("+"):
+                report["created"].append(line[1:])
+                print(f"Directory Created: {line[1:]}")
+            elif line.startswith("="):
+                report["existing"].append(line[1:])
+                print(f"Directory already exists -> Verified: {line[1:]}")
+        if report["existing"] and not exists_okay:
+            raise DirectoryExistsError(
+                "Directory already exists: {0}".format(", ".join(report["existing"]))
+            )
+        return report
+
+    async def free_memory(self):
+        """Return the free heap on the board (after a gc.collect()) in bytes."""
+        ret = await self._pyboard.exec_("import gc\ngc.collect()\nprint(gc.mem_free())")
+        return int(ret.strip())
+
+    async def mpy_version(self):
+        """Return the board's sys.implementation._mpy, or None if it has none."""
+        await self._enter_raw_repl()
+        ret = await self._pyboard.exec_(
+            "import sys\nprint(getattr(sys.implementation, '_mpy', None))"
+        )
+        await self._exit_raw_repl()
+        ret = ret.strip()
+        return None if ret == b"None" else int(ret)
+
+    async def auto_chunk_size(self):
+        """Pick a chunk size that the board can comfortably hold in RAM.
+
+        A chunk exists on the board several times at once while it is being
+        written (command text, compiled constant and decoded data), so only
+        an eighth of the free heap is used.
+        """
+        try:
+            free = await self.free_memory()
+        except (PyboardError, ValueError):
+            return BUFFER_SIZE
+        chunk_size = (free // 8) // MIN_BUFFER_SIZE * MIN_BUFFER_SIZE
+        return max(MIN_BUFFER_SIZE, min(chunk_size, MAX_BUFFER_SIZE))
+
+    async def _import_base64_decoder(self):
+        command = """
+            try:
+                from ubinascii import a2b_base64
+            except ImportError:
+                from binascii import a2b_base64
+        """
         try:
-            self._pyboard.enter_raw_repl()
+            await self._pyboard.exec_(textwrap.dedent(command))
+            return True
         except PyboardError:
-            raise PyboardError
+            return False
+
+    @staticmethod
+    def encode_chunk(chunk, encoding="auto"):
+        """Return the device side expression that evaluates to the bytes `chunk`."""
+        literal = None
+        if encoding in ("auto", "repr"):
+            literal = repr(bytes(chunk))
+            # Make sure to send explicit byte strings (handles python 2 compatibility).
+            if not literal.startswith("b"):
+                literal = "b" + literal
+            if encoding == "repr":
+                return literal
+        encoded = "a2b_base64(b'{0}')".format(
+            binascii.b2a_base64(chunk, newline=False).decode("ascii")
+        )
+        if literal is not None and len(literal) <= len(encoded):
+            return literal
+        return encoded
+
+    async def _define_inflate(self):
         try:
-            file_count = len(files_and_data_to_bulk_write.keys())
-            current_file = 0
-            for file, data in files_and_data_to_bulk_write.items():
-                current_file += 1
-                self._pyboard.exec_("f = open('{0}', 'wb')".format(file))
-                size = len(data)
-                written = 0
-                # Loop through and write a buffer size chunk of data at a time.
-                for i in range(0, size, BUFFER_SIZE):
-                    sys.stdout.write(
-                        f'\r[{current_file} of {file_count}]  "{file}"  >>>  {written} of {size}'
+            await self._pyboard.exec_(
+                INFLATE_COMMAND.format(wbits=COMPRESSION_WBITS, suffix=PART_SUFFIX)
+            )
+            return True
+        except PyboardError:
+            return False
+
+    async def inflate_files(self, pairs):
+        """Inflate (compressed path, final path) pairs on the board in one exec."""
+        command = "for src, dst in {0}:\n    _inflate(src, dst)\n".format(repr(pairs))
+        await self._pyboard.exec_(command)
+
+    async def hash_files(self, paths=None, sizes=False):
+        """Hash files on the board, VERIFY_BATCH paths per exec.
+
+        Returns a dict of device path to sha256 hex digest, or to (size,
+        sha256 hex digest) with `sizes` set. When `paths` is None every file
+        on the board is hashed in one exec, otherwise only the given paths
+        that exist.
+        """
+        if paths is None:
+            batches = [None]
+        else:
+            paths = [device_path(path) for path in paths]
+            batches = [
+                paths[i : i + VERIFY_BATCH] for i in range(0, len(paths), VERIFY_BATCH)
+            ]
+        hashes = dict()
+        for batch in batches:
+            ret = await self._pyboard.exec_(
+                HASH_FILES_COMMAND.format(paths=repr(batch))
+            )
+            for line in ret.decode("utf-8").splitlines():
+                line = line.strip()
+                if line:
+                    digest, size, path = line.split(" ", 2)
+                    hashes[path] = (int(size), digest) if sizes else digest
+        return hashes
+
+    async def verify(self, files):
+        """Check that the board has `files` as they are, without reading them back.
+
+        `files` is a {path: data} dict, an iterable of PackageFiles or a
+        Manifest. The board hashes its copies itself, VERIFY_BATCH files per
+        exec, and only reports the files that differ. Returns a dict of
+        device path to "missing", "size" or "hash", empty when all match.
+        """
+        if isinstance(files, Manifest):
+            expected = files.files
+        else:
+            expected = Manifest.from_package(package_files(files)).files
+        entries = [
+            (device_path(path), size, sha256.encode("ascii"))
+            for path, (size, sha256) in sorted(expected.items())
+        ]
+        mismatches = dict()
+        await self._enter_raw_repl()
+        for i in range(0, len(entries), VERIFY_BATCH):
+            ret = await self._pyboard.exec_(
+                VERIFY_FILES_COMMAND.format(files=repr(entries[i : i + VERIFY_BATCH]))
+            )
+            for line in ret.decode("utf-8").splitlines():
+                line = line.strip()
+                if line:
+                    problem, path = line.split(" ", 1)
+                    mismatches[path] = problem
+        await self._exit_raw_repl()
+        return mismatches
+
+    async def remove_files(self, paths):
+        """Remove files on the board in one exec, returning the removed paths."""
+        ret = await self._pyboard.exec_(
+            REMOVE_FILES_COMMAND.format(paths=repr(list(paths)))
+        )
+        return [line.strip() for line in ret.decode("utf-8").splitlines() if line.strip()]
+
+    async def read_manifest(self):
+        """Return the Manifest of what was uploaded to the board, or None."""
+        await self._enter_raw_repl()
+        ret = await self._pyboard.exec_(
+            READ_MANIFEST_COMMAND.format(path=MANIFEST_PATH)
+        )
+        await self._exit_raw_repl()
+        try:
+            return Manifest.from_json(ret.decode("utf-8"))
+        except ValueError:
+            return None
+
+    async def write_manifest(self, manifest):
+        await self.put(
+            {MANIFEST_PATH: manifest.to_json().encode("utf-8")}, manifest=False
+        )
+
+    async def update_manifest(self, manifest, removed=(), replace=False):
+        """Merge `manifest` into the board's manifest and return the result.
+
+        With `replace` set the board's manifest is overwritten instead.
+        """
+        async with self._session():
+            current = None if replace else await self.read_manifest()
+            if current is None:
+                current = Manifest()
+            current.update(manifest, removed)
+            await self.write_manifest(current)
+        return current
+
+    async def diff_manifest(self, files):
+        """Compare the board's manifest with a package, see Manifest.diff()."""
+        async with self._session():
+            current = await self.read_manifest() or Manifest()
+        return current.diff(Manifest.from_package(package_files(files)))
+
+    async def sync(
+        self,
+        files,
+        delete=False,
+        protected=("/boot.py",),
+        manifest=False,
+        version=None,
+        package=None,
+        **put_kwargs,
+    ):
+        """Upload only files that are missing or differ on the board.
+
+        `files` is a {path: data} dict or an iterable of PackageFiles. With
+        `delete` set, files on the board that are not part of the package
+        (and not in `protected`) are removed as well. With `manifest` set, the
+        board's manifest is updated afterwards, or replaced if `delete` is.
+        Returns a dict with the "uploaded", "unchanged" and "deleted" paths.
+        """
+        files = package_files(files)
+        async with self._session():
+            return await self._sync(
+                files, delete, protected, manifest, version, package, put_kwargs
+            )
+
+    async def _sync(
+        self, files, delete, protected, manifest, version, package, put_kwargs
+    ):
+        # Hash the package on worker threads while the board hashes its files.
+        async with Prefetcher(
+            files, lambda entry: (entry.path, entry.sha256())
+        ) as hashing:
+            hashing.fill()
+            await self._enter_raw_repl()
+            try:
+                if delete:
+                    device_hashes = await self.hash_files()
+                else:
+                    device_hashes = await self.hash_files(
+                        [entry.path for entry in files]
+                    )
+            except BaseException as ex:
+                if isinstance(ex, PyboardError):
+                    print(error_message(ex))
+                raise
+            await self._exit_raw_repl()
+            hashes = {path: digest async for path, digest in hashing}
+
+        changed = list()
+        unchanged = list()
+        for entry in files:
+            if device_hashes.get(device_path(entry.path)) == hashes[entry.path]:
+                unchanged.append(entry.path)
+            else:
+                changed.append(entry)
+        print(f"{len(changed)} changed, {len(unchanged)} unchanged files.")
+
+        deleted = list()
+        if delete:
+            package_paths = set(device_path(entry.path) for entry in files)
+            stale = [
+                path
+                for path in sorted(device_hashes)
+                if path not in package_paths
+                and path not in protected
+                and path != MANIFEST_PATH
+            ]
+            if stale:
+                await self._enter_raw_repl()
+                deleted = await self.remove_files(stale)
+                await self._exit_raw_repl()
+                for path in deleted:
+                    print(f"File Removed: {path}")
+
+        if changed:
+            await self.put(changed, manifest=False, **put_kwargs)
+        if manifest:
+            installed = Manifest(
+                {entry.path: (entry.size, hashes[entry.path]) for entry in files},
+                version,
+                package,
+            )
+            await self.update_manifest(installed, removed=deleted, replace=delete)
+        return {
+            "uploaded": [entry.path for entry in changed],
+            "unchanged": unchanged,
+            "deleted": deleted,
+        }
+
+    @staticmethod
+    async def _put_file(writer, entry, chunk_size, counter, offset=0, journal=None):
+        file = entry.path
+        size = entry.size
+        # Large files go to a temp name first, see PART_MIN_SIZE.
+        target = file + PART_SUFFIX if size >= PART_MIN_SIZE else file
+        if journal is not None and target != file:
+            journal.started(file, target, size, entry.sha256(), offset)
+        await writer.open(target, offset)
+        written = offset
+        # Loop through and write a chunk_size chunk of data at a time.
+        for chunk in entry.chunks(chunk_size, offset):
+            sys.stdout.write(f'\r{counter}  "{file}"  >>>  {written} of {size}')
+            sys.stdout.flush()
+            with instrumentation.span("chunk", offset=written, size=len(chunk)):
+                await writer.write(chunk)
+            written += len(chunk)
+            if journal is not None:
+                journal.progress(written)
+        await writer.close()
+        if target != file:
+            await writer.rename(target, file)
+        if journal is not None:
+            journal.done(file, size, entry.sha256())
+        sys.stdout.write(f'\r{counter}  "{file}"  >>>  {size} of {size}\n')
+
+    async def put(
+        self,
+        files,
+        encoding="auto",
+        chunk_size=None,
+        transport="exec",
+        compress=False,
+        manifest=False,
+        version=None,
+        package=None,
+        journal=None,
+        retries=MAX_RETRIES,
+    ):
+        """Write files to the board.
+
+        `files` is a {path: data} dict or an iterable of PackageFiles, whose
+        data is read and sent one chunk at a time. With `compress` set, files
+        that shrink are sent zlib-compressed and inflated on the board, if
+        its firmware can; otherwise they are sent as they are. With `manifest`
+        set, the files are recorded in the board's manifest afterwards, under
+        the given package `version` and name. With a TransferJournal as
+        `journal`, the progress is recorded in it, and whatever an earlier,
+        interrupted put recorded there and the board still has is not sent
+        again. The "pipeline" transport sends a chunk that arrived corrupted
+        again, up to `retries` times.
+        """
+        if encoding not in ENCODINGS:
+            raise ValueError("unknown chunk encoding: {0}".format(encoding))
+        if transport not in TRANSPORTS:
+            raise ValueError("unknown transport: {0}".format(transport))
+        files = package_files(files)
+        async with self._session():
+            with instrumentation.span(
+                "put", files=len(files), transport=transport, compress=compress
+            ):
+                try:
+                    await self._put(
+                        files,
+                        encoding,
+                        chunk_size,
+                        transport,
+                        compress,
+                        journal,
+                        retries,
                     )
-                    sys.stdout.flush()
-                    chunk_size = min(BUFFER_SIZE, size - i)
-                    chunk = repr(data[i : i + chunk_size])
-                    # Make sure to send explicit byte strings (handles python 2 compatibility).
-                    if not chunk.startswith("b"):
-                        chunk = "b" + chunk
-                    self._pyboard.exec_("f.write({0})".format(chunk))
-                    written = i
-                self._pyboard.exec_("f.close()")
-                sys.stdout.write(
-                    f'\r[{current_file} of {file_count}]  "{file}"  >>>  {size} of {size}\n'
+                except BaseException:
+                    if journal is not None:
+                        journal.save()
+                    raise
+            if journal is not None:
+                journal.clear()
+            if manifest:
+                await self.update_manifest(
+                    Manifest.from_package(files, version, package)
                 )
-        except PyboardError as ex:
-            print(ex.args[2].decode("utf-8"))
-            raise ex
-        self._pyboard.exit_raw_repl()
+
+    async def _put(
+        self, files, encoding, chunk_size, transport, compress, journal, retries
+    ):
+        # Start reading and compressing the first files while the board is
+        # being set up.
+        async with Prefetcher(
+            files, lambda entry: prepare_file(entry, compress)
+        ) as prepared:
+            prepared.fill()
+            await self._put_prepared(
+                files,
+                prepared,
+                encoding,
+                chunk_size,
+                transport,
+                compress,
+                journal,
+                retries,
+            )
+
+    async def _put_prepared(
+        self,
+        files,
+        prepared,
+        encoding,
+        chunk_size,
+        transport,
+        compress,
+        journal,
+        retries,
+    ):
+        await self._enter_raw_repl()
+        writer = None
+        try:
+            if chunk_size is None:
+                chunk_size = await self.auto_chunk_size()
+            device_files = dict()
+            if journal is not None and journal.paths():
+                # What the journal says was sent only counts if the board
+                # still has it.
+                device_files = await self.hash_files(journal.paths(), sizes=True)
+            if transport == "pipeline":
+                writer = PipelinedAgent(self._pyboard, chunk_size, retries=retries)
+            elif transport == "agent":
+                writer = UploadAgent(self._pyboard, chunk_size)
+            else:
+                if encoding != "repr" and not await self._import_base64_decoder():
+                    print("Board has no a2b_base64, falling back to repr encoding.")
+                    encoding = "repr"
+                writer = ExecTransport(self._pyboard, encoding, chunk_size)
+            if compress and not await self._define_inflate():
+                print("Board can't inflate, sending files uncompressed.")
+                compress = False
+            await writer.start()
+            file_count = len(files)
+            current_file = 0
+            async for original, compressed in prepared:
+                current_file += 1
+                counter = f"[{current_file} of {file_count}]"
+                path = original.path
+                entry = original
+                if compress and compressed is not None:
+                    entry = compressed
+                offset = 0
+                if journal is not None:
+                    offset = resume_offset(original, journal, device_files)
+                    if offset is None:
+                        print(f'{counter}  "{path}"  already on the board')
+                        continue
+                    if entry is not original:
+                        # Sent before, but interrupted before it was inflated.
+                        offset = resume_offset(entry, journal, device_files)
+                if offset is not None:
+                    with instrumentation.span(
+                        "file",
+                        path=path,
+                        size=original.size,
+                        sent_size=entry.size,
+                        resumed=offset,
+                    ):
+                        await self._put_file(
+                            writer, entry, chunk_size, counter, offset, journal
+                        )
+                if entry is not original:
+                    # Right away, so the board never holds more than one
+                    # compressed copy.
+                    with instrumentation.span("inflate", path=path):
+                        await writer.inflate(entry.path, path)
+                    if journal is not None:
+                        journal.done(path, original.size, original.sha256())
+            await writer.stop()
+        except BaseException as ex:
+            # Interrupts too, so the board isn't left with an open file or a
+            # running agent.
+            if writer is not None:
+                await writer.abort()
+            if isinstance(ex, PyboardError):
+                print(error_message(ex))
+            raise
+        await self._exit_raw_repl()
+
+
+class Files(object):
+    """Blocking file operations, AsyncFiles run on the Pyboard's event loop."""
+
+    encode_chunk = staticmethod(AsyncFiles.encode_chunk)
+
+    def __init__(self, pyboard, keep_raw_repl=False):
+        self._files = AsyncFiles(pyboard.async_pyboard, keep_raw_repl)
+        self._run = pyboard.run
+
+    @property
+    def keep_raw_repl(self):
+        return self._files.keep_raw_repl
+
+    @keep_raw_repl.setter
+    def keep_raw_repl(self, value):
+        self._files.keep_raw_repl = value
+
+    def mkdir(self, directory=None, exists_okay=True, directory_list: list = None):
+        return self._run(self._files.mkdir(directory, exists_okay, directory_list))
+
+    def free_memory(self):
+        return self._run(self._files.free_memory())
+
+    def mpy_version(self):
+        return self._run(self._files.mpy_version())
+
+    def auto_chunk_size(self):
+        return self._run(self._files.auto_chunk_size())
+
+    def inflate_files(self, pairs):
+        self._run(self._files.inflate_files(pairs))
+
+    def hash_files(self, paths=None, sizes=False):
+        return self._run(self._files.hash_files(paths, sizes))
+
+    def verify(self, files):
+        return self._run(self._files.verify(files))
+
+    def remove_files(self, paths):
+        return self._run(self._files.remove_files(paths))
+
+    def read_manifest(self):
+        return self._run(self._files.read_manifest())
+
+    def write_manifest(self, manifest):
+        self._run(self._files.write_manifest(manifest))
+
+    def update_manifest(self, manifest, removed=(), replace=False):
+        return self._run(self._files.update_manifest(manifest, removed, replace))
+
+    def diff_manifest(self, files):
+        return self._run(self._files.diff_manifest(files))
+
+    def sync(
+        self,
+        files,
+        delete=False,
+        protected=("/boot.py",),
+        manifest=False,
+        version=None,
+        package=None,
+        **put_kwargs,
+    ):
+        return self._run(
+            self._files.sync(
+                files, delete, protected, manifest, version, package, **put_kwargs
+            )
+        )
+
+    def put(
+        self,
+        files,
+        encoding="auto",
+        chunk_size=None,
+        transport="exec",
+        compress=False,
+        manifest=False,
+        version=None,
+        package=None,
+        journal=None,
+        retries=MAX_RETRIES,
+    ):
+        self._run(
+            self._files.put(
+                files,
+                encoding,
+                chunk_size,
+                transport,
+                compress,
+                manifest,
+                version,
+                package,
+                journal,
+                retries,
+            )
+        )
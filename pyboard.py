@@ -1,7 +1,86 @@
+import asyncio
+import os
+import struct
 import sys
 import time
 
-_rawdelay = None
+import instrumentation
+
+# Reads return as soon as data arrives, this only bounds how long an idle read
+# waits before timeouts are re-checked.
+READ_TIMEOUT = 0.05
+
+# Where the event loop can't wait on the port's file descriptor (Windows, or
+# any proactor loop), the port blocks with real timeouts in an executor thread,
+# and a write gives up after this long.
+WRITE_TIMEOUT = 10
+
+# Upper bounds for the raw REPL handshake. The handshake moves on as soon as the
+# board answers, these only apply to boards that stay silent.
+INTERRUPT_TIMEOUT = 1
+RAW_REPL_TIMEOUT = 1
+BOOT_INTERRUPT_TIMEOUT = 0.5
+RESET_TIMEOUT = 5
+RESET_INTERRUPT_INTERVAL = 0.2
+
+# Moving the REPL to another baud rate. The board falls back to the old rate on
+# its own unless the host answers at the new one within BAUD_SWITCH_TIMEOUT.
+BAUD_SWITCH_TIMEOUT = 1
+BAUD_SWITCH_SETTLE = 0.05
+BAUD_PROBE = "UuUu-baud-probe!"
+BAUD_REPLY = "UuUu-baud-reply!"
+BAUD_CONFIRM = "UuUu-baud-commit"
+# Printed at the old rate when the board refuses the UART, e.g. ESP32 ports
+# where "UART(0) is disabled (dedicated to REPL)".
+BAUD_UNSUPPORTED = "baud unsupported"
+# Printed at the old rate right before the board touches its UART; the host
+# only moves once it has read this, or the end of the exec if the board failed.
+BAUD_SWITCHING = "baud switching"
+
+SWITCH_BAUDRATE_COMMAND = """
+import machine, sys, time
+try:
+    import select
+except ImportError:
+    import uselect as select
+try:
+    import micropython
+except ImportError:
+    micropython = None
+def _baud_read(n, deadline, poller):
+    got = ""
+    while len(got) < n and time.ticks_diff(deadline, time.ticks_ms()) > 0:
+        if poller.poll(10):
+            got += sys.stdin.read(1)
+    return got
+if micropython:
+    micropython.kbd_intr(-1)
+poller = select.poll()
+poller.register(sys.stdin, select.POLLIN)
+sys.stdout.write({switching!r})
+time.sleep_ms(10)
+try:
+    machine.UART({uart}, {baudrate})
+    switched = True
+except Exception as ex:
+    switched = False
+    print({unsupported!r}, ex)
+if switched:
+    deadline = time.ticks_add(time.ticks_ms(), {timeout_ms})
+    ok = _baud_read(len({probe!r}), deadline, poller) == {probe!r}
+    if ok:
+        sys.stdout.write({reply!r})
+        ok = _baud_read(len({confirm!r}), deadline, poller) == {confirm!r}
+    if not ok:
+        while time.ticks_diff(deadline, time.ticks_ms()) > 0:
+            time.sleep_ms(10)
+        machine.UART({uart}, {old})
+        time.sleep_ms(50)
+if micropython:
+    micropython.kbd_intr(3)
+if switched:
+    print("baud ok" if ok else "baud reverted")
+"""
 
 stdout = sys.stdout.buffer
 
@@ -17,150 +96,323 @@ class PyboardError(BaseException):
         super().__init__(*args)
 
 
-class Pyboard:
-    def __init__(
-        self,
-        device,
-        baudrate=115200,
-        wait=0,
-        rawdelay=0,
+def open_serial(device, baudrate):
+    import serial
+
+    # Non-blocking both ways, AsyncPyboard does the waiting on the event loop
+    # (or makes the port blocking again where the loop can't watch it).
+    return serial.Serial(device, baudrate=baudrate, timeout=0, write_timeout=0)
+
+
+class AsyncPyboard:
+    """A board's raw REPL, driven from an asyncio event loop.
+
+    Serial I/O never blocks the loop, so one loop can talk to many boards at
+    once. `serial` is an open pyserial port, see open_serial().
+    """
+
+    def __init__(self, serial, rawdelay=0, use_raw_paste=True):
+        self.serial = serial
+        self.rawdelay = rawdelay
+        self.use_raw_paste = use_raw_paste
+        # Bytes received from the board but not consumed by a read yet.
+        self._rx_buffer = bytearray()
+        # Whether the next bytes received answer something we sent.
+        self._awaiting_reply = False
+        self.in_raw_repl = False
+        # Bytes the board reads ahead in raw-paste mode, once it has told us.
+        self.raw_paste_window = None
+        try:
+            self._fd = serial.fileno()
+        except (AttributeError, OSError):
+            self._use_blocking_io()
+
+    @classmethod
+    async def open(
+        cls, device, baudrate=115200, wait=0, rawdelay=0, use_raw_paste=True
     ):
-        global _rawdelay
-        _rawdelay = rawdelay
-        if True:
-            import serial
-
-            delayed = False
-            for attempt in range(wait + 1):
-                try:
-                    self.serial = serial.Serial(
-                        device,
-                        baudrate=baudrate,  # interCharTimeout=1
-                    )
-                    break
-                except (OSError, IOError):  # Py2 and Py3 have different errors
-                    if wait == 0:
-                        continue
-                    if attempt == 0:
-                        sys.stdout.write("Waiting {} seconds for pyboard ".format(wait))
-                        delayed = True
-                time.sleep(1)
-                sys.stdout.write(".")
-                sys.stdout.flush()
-            else:
-                if delayed:
-                    print("")
-                raise PyboardError("failed to access " + device)
-            if delayed:
-                print("")
+        """Open `device`, retrying for up to `wait` seconds while it's missing."""
+        for attempt in range(wait + 1):
+            try:
+                return cls(open_serial(device, baudrate), rawdelay, use_raw_paste)
+            except (OSError, IOError):
+                if attempt < wait:
+                    await asyncio.sleep(1)
+        raise PyboardError("failed to access " + device)
 
     def close(self):
         self.serial.close()
 
-    def read_until(self, min_num_bytes, ending, timeout=10, data_consumer=None):
-        data = self.serial.read(min_num_bytes)
-        if data_consumer:
-            data_consumer(data)
-        timeout_count = 0
-        while True:
-            if data.endswith(ending):
-                break
-            elif self.serial.inWaiting() > 0:
-                new_data = self.serial.read(1)
-                data = data + new_data
-                if data_consumer:
-                    data_consumer(new_data)
-                timeout_count = 0
+    def _use_blocking_io(self):
+        # pyserial's win32 write returns with write_timeout=0 before the
+        # overlapped write is done and reuses it for the next one, so only
+        # non-blocking ports with an fd the loop can watch stay non-blocking.
+        self._fd = None
+        self.serial.timeout = READ_TIMEOUT
+        self.serial.write_timeout = WRITE_TIMEOUT
+
+    def _read_blocking(self):
+        data = self.serial.read(1)
+        return data + self.serial.read(self.serial.in_waiting)
+
+    def _write_blocking(self, data):
+        try:
+            self.serial.write(data)
+        except OSError as ex:
+            raise PyboardError("can't write to the board: {}".format(ex))
+
+    async def _wait_ready(self, writing, timeout):
+        # Wait until the port can be read (or written), or for `timeout`.
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def wake():
+            if not ready.done():
+                ready.set_result(None)
+
+        add, remove = loop.add_reader, loop.remove_reader
+        if writing:
+            add, remove = loop.add_writer, loop.remove_writer
+        try:
+            add(self._fd, wake)
+        except NotImplementedError:
+            self._use_blocking_io()
+            return
+        timer = loop.call_later(timeout, wake)
+        try:
+            await ready
+        finally:
+            timer.cancel()
+            remove(self._fd)
+
+    async def _fill(self):
+        # Move whatever the port has into the receive buffer, waiting for at
+        # most READ_TIMEOUT when nothing is waiting.
+        data = self.serial.read(self.serial.in_waiting)
+        if not data:
+            if self._fd is None:
+                loop = asyncio.get_running_loop()
+                data = await loop.run_in_executor(None, self._read_blocking)
             else:
-                timeout_count += 1
-                if timeout is not None and timeout_count >= 100 * timeout:
-                    break
-                time.sleep(0.02)
+                await self._wait_ready(False, READ_TIMEOUT)
+                data = self.serial.read(self.serial.in_waiting)
+        if data:
+            self._rx_buffer += data
+            if self._awaiting_reply:
+                self._awaiting_reply = False
+                instrumentation.count(bytes_received=len(data), round_trips=1)
+            else:
+                instrumentation.count(bytes_received=len(data))
+        return len(data)
+
+    def _write_some(self, data):
+        # Hand the OS only what it takes right now. pyserial's POSIX write()
+        # keeps retrying on EAGAIN until everything is out, even with
+        # write_timeout=0, which would hold up the loop for a large write.
+        try:
+            return os.write(self._fd, data)
+        except BlockingIOError:
+            return 0
+
+    async def write(self, data):
+        size = len(data)
+        data = memoryview(bytes(data))
+        while data and self._fd is not None:
+            written = self._write_some(data)
+            data = data[written:]
+            if data:
+                await self._wait_ready(True, READ_TIMEOUT)
+        if data:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._write_blocking, bytes(data))
+        self._awaiting_reply = True
+        instrumentation.count(bytes_sent=size)
+
+    def in_waiting(self):
+        return len(self._rx_buffer) + self.serial.in_waiting
+
+    def flush_input(self):
+        self._rx_buffer.clear()
+        n = self.serial.in_waiting
+        while n > 0:
+            self.serial.read(n)
+            n = self.serial.in_waiting
+
+    async def read_exact(self, num_bytes, timeout=10):
+        """Read num_bytes, or fewer if nothing arrives for `timeout` seconds."""
+        buf = self._rx_buffer
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len(buf) < num_bytes:
+            if await self._fill():
+                if timeout is not None:
+                    deadline = time.monotonic() + timeout
+            elif deadline is not None and time.monotonic() >= deadline:
+                break
+        data = bytes(buf[:num_bytes])
+        del buf[:num_bytes]
         return data
 
-    def soft_reset(self):
-        # ctrl-C twice: interrupt any running program
-        self.serial.write(b"\x03")
-        time.sleep(0.3)
-        self.serial.write(b"\x03")
-        time.sleep(1)
+    async def read_until(
+        self,
+        min_num_bytes,
+        ending,
+        timeout=10,
+        data_consumer=None,
+        timeout_overall=None,
+    ):
+        # Scan the receive buffer for `ending`, only looking at bytes that
+        # arrived since the last scan. Anything after `ending` stays buffered
+        # for the next read. `timeout` is an idle timeout, like before, and
+        # `timeout_overall` bounds the whole read even if data keeps coming.
+        buf = self._rx_buffer
+        search_from = max(0, min_num_bytes - len(ending))
+        consumed = 0
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if timeout_overall is not None:
+            overall_deadline = time.monotonic() + timeout_overall
+        while True:
+            index = buf.find(ending, search_from)
+            if index >= 0:
+                end = index + len(ending)
+                data = bytes(buf[:end])
+                del buf[:end]
+                if data_consumer and end > consumed:
+                    data_consumer(data[consumed:])
+                return data
+            search_from = max(search_from, len(buf) - len(ending) + 1)
+            if data_consumer and len(buf) > consumed:
+                data_consumer(bytes(buf[consumed:]))
+                consumed = len(buf)
+            if await self._fill():
+                if timeout is not None:
+                    deadline = time.monotonic() + timeout
+            elif deadline is not None and time.monotonic() >= deadline:
+                timeout_overall = 0
+            if timeout_overall is not None and (
+                timeout_overall == 0 or time.monotonic() >= overall_deadline
+            ):
+                data = bytes(buf)
+                buf.clear()
+                return data
+
+    async def soft_reset(self):
+        if self.in_raw_repl:
+            await self.exit_raw_repl()
+
+        # ctrl-C twice: interrupt any running program, then wait for the
+        # friendly prompt (or at most INTERRUPT_TIMEOUT seconds)
+        self.flush_input()
+        await self.write(b"\x03")
+        await self.write(b"\x03")
+        await self.read_until(
+            1, b">>> ", timeout=INTERRUPT_TIMEOUT, timeout_overall=INTERRUPT_TIMEOUT
+        )
 
         # ctrl-D: soft reset the board
         # print("Performing Soft Reset")
-        # self.serial.write(b"\x04")  # ctrl-D: soft reset
-        self.serial.write(b"import machine\r\n")
-        self.serial.write(b"machine.reset()\r\n")
-
-    def enter_raw_repl(self, soft_reset=False):
+        # self.write(b"\x04")  # ctrl-D: soft reset
+        await self.write(b"import machine\r\n")
+        await self.write(b"machine.reset()\r\n")
+
+    async def enter_raw_repl(self, soft_reset=False, reuse=False):
+        # Keep using a raw REPL session that is still open if asked to.
+        if reuse and self.in_raw_repl:
+            return
+        with instrumentation.span("raw_repl", soft_reset=soft_reset):
+            await self._enter_raw_repl(soft_reset)
+
+    async def _enter_raw_repl(self, soft_reset):
         # Brief delay before sending RAW MODE char if requests
-        if _rawdelay > 0:
-            time.sleep(_rawdelay)
+        if self.rawdelay > 0:
+            await asyncio.sleep(self.rawdelay)
 
         if soft_reset:
-            self.soft_reset()
-            spam_ctrl_c_time = 20
-            while spam_ctrl_c_time > 0:
-                spam_ctrl_c_time -= 1
-                self.serial.write(b"\r\x03")
-                time.sleep(0.2)
-            time.sleep(1)
-            self.serial.write(b"\r\x03")
-
-        # ctrl-C twice: interrupt any running program
-
-        self.serial.write(b"\r\x03")
-        time.sleep(1)
-        self.serial.write(b"\r\x03")
-        time.sleep(1)
+            await self.soft_reset()
+            # Skip the echo of the reset command, then keep interrupting
+            # boot.py/main.py until the friendly prompt shows up.
+            await self.read_until(
+                1,
+                b"machine.reset()",
+                timeout=INTERRUPT_TIMEOUT,
+                timeout_overall=INTERRUPT_TIMEOUT,
+            )
+            deadline = time.monotonic() + RESET_TIMEOUT
+            while time.monotonic() < deadline:
+                await self.write(b"\r\x03")
+                data = await self.read_until(
+                    1,
+                    b">>> ",
+                    timeout=RESET_INTERRUPT_INTERVAL,
+                    timeout_overall=RESET_INTERRUPT_INTERVAL,
+                )
+                if data.endswith(b">>> "):
+                    break
 
         # flush input (without relying on serial.flushInput())
-        n = self.serial.inWaiting()
-        while n > 0:
-            self.serial.read(n)
-            n = self.serial.inWaiting()
+        self.flush_input()
 
         for retry in range(0, 5):
-            self.serial.write(b"\r\x01")  # ctrl-A: enter raw REPL
-            data = self.read_until(1, b"raw REPL; CTRL-B to exit\r\n>")
+            # ctrl-C twice: interrupt any running program, then ctrl-A: enter
+            # raw REPL. Whatever the interrupted program prints before the
+            # banner is skipped by read_until.
+            await self.write(b"\r\x03")
+            await self.write(b"\r\x03")
+            await self.write(b"\r\x01")
+            data = await self.read_until(
+                1,
+                b"raw REPL; CTRL-B to exit\r\n>",
+                timeout=RAW_REPL_TIMEOUT,
+                timeout_overall=RAW_REPL_TIMEOUT + INTERRUPT_TIMEOUT,
+            )
             if data.endswith(b"raw REPL; CTRL-B to exit\r\n>"):
                 break
-            else:
-                if retry >= 10:
-                    print(data)
-                    raise PyboardError("could not enter raw repl")
-                time.sleep(0.2)
+            instrumentation.count(retries=1)
+        else:
+            print(data)
+            raise PyboardError("could not enter raw repl")
 
-        self.serial.write(b"\x04")  # ctrl-D: soft reset
-        data = self.read_until(1, b"soft reboot\r\n")
+        await self.write(b"\x04")  # ctrl-D: soft reset
+        data = await self.read_until(1, b"soft reboot\r\n")
         if not data.endswith(b"soft reboot\r\n"):
             raise PyboardError("could not enter raw repl")
         # By splitting this into 2 reads, it allows boot.py to print stuff,
         # which will show up after the soft reboot and before the raw REPL.
         # Modification from original pyboard.py below:
-        #   Add a small delay and send Ctrl-C twice after soft reboot to ensure
-        #   any main program loop in main.py is interrupted.
-        time.sleep(0.5)
-        self.serial.write(b"\x03")
-        time.sleep(0.1)  # (slight delay before second interrupt
-        self.serial.write(b"\x03")
+        #   If the raw REPL prompt doesn't come back within
+        #   BOOT_INTERRUPT_TIMEOUT, send Ctrl-C twice to ensure any main
+        #   program loop started from boot.py is interrupted.
+        data = await self.read_until(
+            1,
+            b"raw REPL; CTRL-B to exit\r\n",
+            timeout=BOOT_INTERRUPT_TIMEOUT,
+            timeout_overall=BOOT_INTERRUPT_TIMEOUT,
+        )
+        if not data.endswith(b"raw REPL; CTRL-B to exit\r\n"):
+            instrumentation.count(retries=1)
+            await self.write(b"\x03")
+            await self.write(b"\x03")
+            data = await self.read_until(1, b"raw REPL; CTRL-B to exit\r\n")
         # End modification above.
-        data = self.read_until(1, b"raw REPL; CTRL-B to exit\r\n")
         if not data.endswith(b"raw REPL; CTRL-B to exit\r\n"):
             print(data)
             raise PyboardError("could not enter raw repl")
+        self.in_raw_repl = True
 
-    def exit_raw_repl(self):
-        self.serial.write(b"\r\x02")  # ctrl-B: enter friendly REPL
+    async def exit_raw_repl(self):
+        await self.write(b"\r\x02")  # ctrl-B: enter friendly REPL
+        self.in_raw_repl = False
 
-    def follow(self, timeout, data_consumer=None):
+    async def follow(self, timeout, data_consumer=None):
         # wait for normal output
-        data = self.read_until(1, b"\x04", timeout=timeout, data_consumer=data_consumer)
+        data = await self.read_until(
+            1, b"\x04", timeout=timeout, data_consumer=data_consumer
+        )
         if not data.endswith(b"\x04"):
             raise PyboardError("timeout waiting for first EOF reception")
         data = data[:-1]
 
         # wait for error output
-        data_err = self.read_until(1, b"\x04", timeout=timeout)
+        data_err = await self.read_until(1, b"\x04", timeout=timeout)
         if not data_err.endswith(b"\x04"):
             raise PyboardError("timeout waiting for second EOF reception")
         data_err = data_err[:-1]
@@ -168,58 +420,328 @@ class Pyboard:
         # return normal and error output
         return data, data_err
 
-    def exec_raw_no_follow(self, command):
+    async def raw_paste_write(self, command_bytes):
+        # Read initial header, with window size.
+        data = await self.read_exact(2)
+        window_size = struct.unpack("<H", data)[0]
+        self.raw_paste_window = window_size
+        window_remain = window_size
+
+        # Write out the command_bytes data.
+        i = 0
+        while i < len(command_bytes):
+            while window_remain == 0 or self.in_waiting():
+                data = await self.read_exact(1)
+                if data == b"\x01":
+                    # Device indicated that a new window of data can be sent.
+                    window_remain += window_size
+                elif data == b"\x04":
+                    # Device indicated abrupt end. Acknowledge it and finish.
+                    await self.write(b"\x04")
+                    return
+                else:
+                    # Unexpected data from device.
+                    raise PyboardError(
+                        "unexpected read during raw paste: {}".format(data)
+                    )
+            # Send out as much data as possible that fits within the allowed window.
+            b = command_bytes[i : min(i + window_remain, len(command_bytes))]
+            await self.write(b)
+            window_remain -= len(b)
+            i += len(b)
+
+        # Indicate end of data.
+        await self.write(b"\x04")
+
+        # Wait for device to acknowledge end of data.
+        data = await self.read_until(1, b"\x04")
+        if not data.endswith(b"\x04"):
+            raise PyboardError("could not complete raw paste: {}".format(data))
+
+    async def exec_raw_no_follow(self, command):
         if isinstance(command, bytes):
             command_bytes = command
         else:
             command_bytes = bytes(command, encoding="utf8")
 
         # check we have a prompt
-        data = self.read_until(1, b">")
+        data = await self.read_until(1, b">")
         if not data.endswith(b">"):
             raise PyboardError("could not enter raw repl")
 
-        # write command
+        if self.use_raw_paste:
+            # Try to enter raw-paste mode.
+            await self.write(b"\x05A\x01")
+            data = await self.read_exact(2)
+            if data == b"R\x00":
+                # Device understood raw-paste command but doesn't support it.
+                pass
+            elif data == b"R\x01":
+                # Device supports raw-paste mode, write out the command using this mode.
+                return await self.raw_paste_write(command_bytes)
+            else:
+                # Device doesn't support raw-paste, fall back to normal raw REPL.
+                data = await self.read_until(1, b"w REPL; CTRL-B to exit\r\n>")
+                if not data.endswith(b"w REPL; CTRL-B to exit\r\n>"):
+                    print(data)
+                    raise PyboardError("could not enter raw repl")
+            # Don't try to use raw-paste mode again for this connection.
+            self.use_raw_paste = False
+
+        # write command using standard raw REPL, 256 bytes every 10ms
         for i in range(0, len(command_bytes), 256):
-            self.serial.write(command_bytes[i : min(i + 256, len(command_bytes))])
-            time.sleep(0.01)
-        self.serial.write(b"\x04")
+            await self.write(command_bytes[i : min(i + 256, len(command_bytes))])
+            await asyncio.sleep(0.01)
+        await self.write(b"\x04")
 
         # check if we could exec command
-        data = self.serial.read(2)
+        data = await self.read_exact(2)
         if data != b"OK":
             raise PyboardError("could not exec command")
 
-    def exec_raw(self, command, timeout=10, data_consumer=None):
-        self.exec_raw_no_follow(command)
-        return self.follow(timeout, data_consumer)
-
-    def eval(self, expression):
-        ret = self.exec_("print({})".format(expression))
+    async def switch_baudrate(self, baudrate, uart_id=0):
+        """Move the raw REPL link to `baudrate`, on the board and on the host.
+
+        Both ends exchange a probe at the new rate before the board keeps it,
+        otherwise the board goes back to the current rate by itself. Returns
+        True if the link now runs at `baudrate`, False if it stayed put,
+        including when the board can't reconfigure its REPL UART at all.
+        """
+        old = self.serial.baudrate
+        await self.exec_raw_no_follow(
+            SWITCH_BAUDRATE_COMMAND.format(
+                uart=uart_id,
+                baudrate=baudrate,
+                old=old,
+                timeout_ms=int(BAUD_SWITCH_TIMEOUT * 1000),
+                probe=BAUD_PROBE,
+                reply=BAUD_REPLY,
+                confirm=BAUD_CONFIRM,
+                unsupported=BAUD_UNSUPPORTED,
+                switching=BAUD_SWITCHING,
+            )
+        )
+        # A traceback before the marker ends the exec at the old rate.
+        switching = BAUD_SWITCHING.encode()
+        data = await self.read_until(1, switching, timeout=BAUD_SWITCH_TIMEOUT)
+        if not data.endswith(switching):
+            if b"\x04" not in data:
+                raise PyboardError("no reply switching to {} baud".format(baudrate))
+            if data.count(b"\x04") < 2:
+                await self.read_until(1, b"\x04", timeout=BAUD_SWITCH_TIMEOUT)
+            return False
+        # Only talk at the new rate for the first half of the board's window,
+        # so its fallback output is read at the old rate again.
+        deadline = time.monotonic() + BAUD_SWITCH_TIMEOUT / 2
+        # A board that refuses the UART finishes the exec at the old rate,
+        # usually right after the marker.
+        data = await self.read_until(
+            1, b"\x04", timeout=None, timeout_overall=BAUD_SWITCH_SETTLE
+        )
+        if data.endswith(b"\x04"):
+            await self.read_until(1, b"\x04", timeout=BAUD_SWITCH_TIMEOUT)
+            return False
+        self.serial.baudrate = baudrate
+        try:
+            await self.write(BAUD_PROBE.encode())
+            reply = BAUD_REPLY.encode()
+            data = await self.read_until(
+                len(reply),
+                reply,
+                timeout=None,
+                timeout_overall=max(0, deadline - time.monotonic()),
+            )
+            if data.endswith(reply):
+                await self.write(BAUD_CONFIRM.encode())
+                data, data_err = await self.follow(
+                    max(READ_TIMEOUT, deadline - time.monotonic())
+                )
+                if data.strip().endswith(b"baud ok") and not data_err:
+                    return True
+        except PyboardError:
+            pass
+
+        instrumentation.count(retries=1)
+        self.serial.baudrate = old
+        data = await self.read_until(
+            1, b"baud reverted", timeout=2 * BAUD_SWITCH_TIMEOUT
+        )
+        if data.endswith(b"baud reverted"):
+            await self.follow(BAUD_SWITCH_TIMEOUT)
+            return False
+        # A slow refusal finishes the exec while the host listens at the new
+        # rate, so that output is gone. Ask for a fresh prompt at the old rate.
+        self.flush_input()
+        await self.write(b"\r\x01")
+        banner = b"raw REPL; CTRL-B to exit\r\n"
+        data = await self.read_until(1, banner, timeout=BAUD_SWITCH_TIMEOUT)
+        if not data.endswith(banner):
+            raise PyboardError("lost the board switching to {} baud".format(baudrate))
+        return False
+
+    async def exec_raw(self, command, timeout=10, data_consumer=None):
+        try:
+            await self.exec_raw_no_follow(command)
+            return await self.follow(timeout, data_consumer)
+        except BaseException:
+            # The board may be anywhere in the exec, so don't reuse the
+            # session; the next enter_raw_repl() starts over.
+            self.in_raw_repl = False
+            raise
+
+    async def eval(self, expression):
+        ret = await self.exec_("print({})".format(expression))
         ret = ret.strip()
         return ret
 
-    def exec_(self, command, stream_output=False):
+    async def exec_(self, command, stream_output=False):
         data_consumer = None
         if stream_output:
             data_consumer = stdout_write_bytes
-        ret, ret_err = self.exec_raw(command, data_consumer=data_consumer)
+        ret, ret_err = await self.exec_raw(command, data_consumer=data_consumer)
         if ret_err:
             raise PyboardError("exception", ret, ret_err)
         return ret
 
-    def execfile(self, filename, stream_output=False):
+    async def execfile(self, filename, stream_output=False):
         with open(filename, "rb") as f:
             pyfile = f.read()
-        return self.exec_(pyfile, stream_output=stream_output)
+        return await self.exec_(pyfile, stream_output=stream_output)
 
-    def get_time(self):
-        t = str(self.eval("pyb.RTC().datetime()"), encoding="utf8")[1:-1].split(", ")
+    async def get_time(self):
+        t = await self.eval("pyb.RTC().datetime()")
+        t = str(t, encoding="utf8")[1:-1].split(", ")
         return int(t[4]) * 3600 + int(t[5]) * 60 + int(t[6])
 
 
+class Pyboard:
+    """Blocking interface to a board, an AsyncPyboard on a private event loop."""
+
+    def __init__(
+        self,
+        device,
+        baudrate=115200,
+        wait=0,
+        rawdelay=0,
+        use_raw_paste=True,
+    ):
+        delayed = False
+        for attempt in range(wait + 1):
+            try:
+                serial = open_serial(device, baudrate)
+                break
+            except (OSError, IOError):  # Py2 and Py3 have different errors
+                if wait == 0:
+                    continue
+                if attempt == 0:
+                    sys.stdout.write("Waiting {} seconds for pyboard ".format(wait))
+                    delayed = True
+            time.sleep(1)
+            sys.stdout.write(".")
+            sys.stdout.flush()
+        else:
+            if delayed:
+                print("")
+            raise PyboardError("failed to access " + device)
+        if delayed:
+            print("")
+        self.async_pyboard = AsyncPyboard(serial, rawdelay, use_raw_paste)
+        self._loop = asyncio.new_event_loop()
+
+    def run(self, coroutine):
+        """Run a coroutine of this board's AsyncPyboard to completion."""
+        return self._loop.run_until_complete(coroutine)
+
+    @property
+    def serial(self):
+        return self.async_pyboard.serial
+
+    @property
+    def in_raw_repl(self):
+        return self.async_pyboard.in_raw_repl
+
+    @property
+    def raw_paste_window(self):
+        return self.async_pyboard.raw_paste_window
+
+    @property
+    def use_raw_paste(self):
+        return self.async_pyboard.use_raw_paste
+
+    @use_raw_paste.setter
+    def use_raw_paste(self, value):
+        self.async_pyboard.use_raw_paste = value
+
+    def close(self):
+        self.async_pyboard.close()
+        self._loop.close()
+
+    def write(self, data):
+        self.run(self.async_pyboard.write(data))
+
+    def in_waiting(self):
+        return self.async_pyboard.in_waiting()
+
+    def flush_input(self):
+        self.async_pyboard.flush_input()
+
+    def read_exact(self, num_bytes, timeout=10):
+        return self.run(self.async_pyboard.read_exact(num_bytes, timeout))
+
+    def read_until(
+        self,
+        min_num_bytes,
+        ending,
+        timeout=10,
+        data_consumer=None,
+        timeout_overall=None,
+    ):
+        return self.run(
+            self.async_pyboard.read_until(
+                min_num_bytes, ending, timeout, data_consumer, timeout_overall
+            )
+        )
+
+    def soft_reset(self):
+        self.run(self.async_pyboard.soft_reset())
+
+    def enter_raw_repl(self, soft_reset=False, reuse=False):
+        self.run(self.async_pyboard.enter_raw_repl(soft_reset, reuse))
+
+    def exit_raw_repl(self):
+        self.run(self.async_pyboard.exit_raw_repl())
+
+    def follow(self, timeout, data_consumer=None):
+        return self.run(self.async_pyboard.follow(timeout, data_consumer))
+
+    def raw_paste_write(self, command_bytes):
+        self.run(self.async_pyboard.raw_paste_write(command_bytes))
+
+    def exec_raw_no_follow(self, command):
+        self.run(self.async_pyboard.exec_raw_no_follow(command))
+
+    def switch_baudrate(self, baudrate, uart_id=0):
+        return self.run(self.async_pyboard.switch_baudrate(baudrate, uart_id))
+
+    def exec_raw(self, command, timeout=10, data_consumer=None):
+        return self.run(self.async_pyboard.exec_raw(command, timeout, data_consumer))
+
+    def eval(self, expression):
+        return self.run(self.async_pyboard.eval(expression))
+
+    def exec_(self, command, stream_output=False):
+        return self.run(self.async_pyboard.exec_(command, stream_output))
+
+    def execfile(self, filename, stream_output=False):
+        return self.run(self.async_pyboard.execfile(filename, stream_output))
+
+    def get_time(self):
+        return self.run(self.async_pyboard.get_time())
+
+
 # in Python2 exec is a keyword so one must use "exec_"
 # but for Python3 we want to provide the nicer version "exec"
+setattr(AsyncPyboard, "exec", AsyncPyboard.exec_)
 setattr(Pyboard, "exec", Pyboard.exec_)
 
 
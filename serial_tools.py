@@ -1,6 +1,5 @@
 import serial.tools.list_ports
 from serial import SerialException
-import time
 
 def get_com_ports():
     available_ports = serial.tools.list_ports.comports()
@@ -9,12 +8,28 @@ def get_com_ports():
         ports.append((port, desc, hwid))
     return ports
 
-def port_is_avaiable(com_port, baud=11500, timeout=1):
+# USB to UART bridges found on ESP development boards.
+USB_UART_CHIPS = ("CH340", "CP210")
+
+def is_usb_uart(description):
+    return any(chip in description.upper() for chip in USB_UART_CHIPS)
+
+def get_flashable_ports():
+    """Ports whose description matches a known ESP board USB to UART bridge."""
+    return [port for port, desc, hwid in get_com_ports() if is_usb_uart(desc)]
+
+def get_port_info(com_port):
+    """The pyserial ListPortInfo of `com_port` (VID/PID, serial number, ...), or None."""
+    for info in serial.tools.list_ports.comports():
+        if info.device == com_port:
+            return info
+    return None
+
+def port_is_avaiable(com_port, baud=115200, timeout=1):
     try:
-        serial_con = serial.Serial(com_port, baud, timeout=1)
+        serial_con = serial.Serial(com_port, baud, timeout=timeout)
         available = serial_con.isOpen()
         serial_con.close()
-        time.sleep(0.5)
         return available
     except SerialException:
         return False
\ No newline at end of file
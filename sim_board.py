@@ -0,0 +1,852 @@
+"""
+Simulated MicroPython board on a Linux pseudo-terminal.
+
+The simulator speaks the friendly REPL, the raw REPL and raw-paste mode well
+enough for pyboard.Pyboard and pyb_files.Files to talk to it exactly like they
+talk to a real ESP over a USB serial adapter. Submitted code runs in a
+restricted CPython namespace whose filesystem is rooted in a host directory and
+whose os/sys/gc/machine/hashlib/binascii/deflate modules are small stand-ins
+for their MicroPython counterparts.
+
+Link speed, per-transfer latency, the size of the device's UART RX buffer and
+the amount of free RAM can all be limited to mimic real hardware.
+
+    board = SimulatedBoard(baudrate=115200)
+    board.start()
+    pyb = pyboard.Pyboard(board.port, 115200)
+    ...
+    board.stop()
+"""
+import binascii
+import builtins
+import ctypes
+import errno
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import struct
+import tempfile
+import termios
+import threading
+import time
+import traceback
+import tty
+import types
+import zlib
+
+BANNER = b"MicroPython v1.22.0 on 2024-01-01; Simulated ESP32 module with ESP32\r\n"
+BANNER += b'Type "help()" for more information.\r\n'
+RAW_REPL_BANNER = b"raw REPL; CTRL-B to exit\r\n>"
+
+# Termios speed constants to baud rates, used to detect host/device mismatches.
+TERMIOS_BAUD_RATES = {
+    getattr(termios, "B{}".format(rate)): rate
+    for rate in (
+        9600,
+        19200,
+        38400,
+        57600,
+        115200,
+        230400,
+        460800,
+        500000,
+        576000,
+        921600,
+        1000000,
+        1500000,
+        2000000,
+    )
+    if hasattr(termios, "B{}".format(rate))
+}
+
+# With an unlimited link speed, how long bytes that overflow the RX buffer
+# wait for a reader before they are dropped.
+RX_GRACE = 0.002
+
+SAFE_BUILTINS = (
+    "abs all any bool bytearray bytes callable chr dict dir divmod enumerate "
+    "Exception filter float getattr hasattr hash hex id int isinstance "
+    "issubclass iter len list map max memoryview min next object oct ord pow "
+    "print range repr reversed round set setattr slice sorted str sum super "
+    "tuple type zip BaseException KeyboardInterrupt ImportError OSError "
+    "ValueError TypeError KeyError IndexError AttributeError MemoryError "
+    "NameError RuntimeError StopIteration ZeroDivisionError EOFError "
+    "NotImplementedError AssertionError __build_class__"
+).split()
+
+
+class _HardReset(BaseException):
+    pass
+
+
+class _FlashFile(object):
+    """A file opened for writing that takes `rate` bytes per second to write."""
+
+    def __init__(self, f, rate):
+        self._f = f
+        self._rate = rate
+
+    def write(self, data):
+        time.sleep(len(data) / self._rate)
+        return self._f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._f.close()
+
+
+class _RxStream(object):
+    """Bytes received by the device UART, optionally bounded like a ring buffer."""
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.overruns = 0
+        self._data = bytearray()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def feed(self, data, grace=0.0):
+        """Queue received bytes, dropping what doesn't fit.
+
+        Bytes that don't fit wait up to `grace` seconds (their time on the
+        wire) for a reader blocked on the stream to make room.
+        """
+        deadline = time.monotonic() + grace
+        with self._cond:
+            if self.capacity is not None:
+                while len(self._data) + len(data) > self.capacity:
+                    room = self.capacity - len(self._data)
+                    self._data += data[:room]
+                    data = data[room:]
+                    self._cond.notify_all()
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or self._closed:
+                        self.overruns += len(data)
+                        return
+                    self._cond.wait(remaining)
+            self._data += data
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def read(self, size=1, timeout=None):
+        """Block until `size` bytes (or a full buffer) are available, or closed/timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self.capacity is not None:
+            size = min(size, self.capacity)
+        with self._cond:
+            while len(self._data) < size and not self._closed:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining if remaining is not None else 0.1)
+            data = bytes(self._data[:size])
+            del self._data[:size]
+            self._cond.notify_all()
+            return data
+
+    def wait(self, timeout):
+        """Return True once data is available, False after `timeout` seconds."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self._data and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return bool(self._data)
+
+    def read_available(self):
+        with self._cond:
+            data = bytes(self._data)
+            self._data.clear()
+            self._cond.notify_all()
+            return data
+
+
+class _StdinBuffer(object):
+    def __init__(self, board):
+        self._board = board
+
+    def read(self, size=1):
+        data = b""
+        while len(data) < size:
+            data += self._board._rx.read(size - len(data))
+            self._board._check_alive()
+        return data
+
+    def readinto(self, buf, size=None):
+        if size is None:
+            size = len(buf)
+        data = self.read(size)
+        buf[: len(data)] = data
+        return len(data)
+
+
+class _Poll(object):
+    """select.poll() stand-in that can only watch stdin."""
+
+    def __init__(self, board):
+        self._board = board
+
+    def __call__(self):
+        return self
+
+    def register(self, stream, events=1):
+        pass
+
+    def poll(self, timeout=-1):
+        timeout = None if timeout < 0 else timeout / 1000.0
+        if self._board._rx.wait(3600 if timeout is None else timeout):
+            return [(self._board._modules["sys"].stdin, 1)]
+        return []
+
+
+class _Stdin(object):
+    def __init__(self, board):
+        self.buffer = _StdinBuffer(board)
+
+    def read(self, size=1):
+        return self.buffer.read(size).decode("utf-8", "replace")
+
+
+class _StdoutBuffer(object):
+    def __init__(self, board):
+        self._board = board
+
+    def write(self, data):
+        self._board._emit(bytes(data))
+        return len(data)
+
+
+class _Stdout(object):
+    def __init__(self, board):
+        self._board = board
+        self.buffer = _StdoutBuffer(board)
+
+    def write(self, text):
+        self._board._emit(str(text).encode("utf-8").replace(b"\n", b"\r\n"))
+        return len(text)
+
+
+class _DeflateIO(object):
+    """Stand-in for MicroPython's deflate.DeflateIO / zlib.DecompIO (read only)."""
+
+    def __init__(self, stream, fmt=0, wbits=0):
+        self._stream = stream
+        if fmt == 1 or wbits < 0:
+            self._decomp = zlib.decompressobj(-15)
+        elif fmt == 3:
+            self._decomp = zlib.decompressobj(31)
+        else:
+            self._decomp = zlib.decompressobj(47)
+        self._pending = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._pending) < size:
+            raw = self._stream.read(256)
+            if not raw:
+                self._pending += self._decomp.flush()
+                break
+            self._pending += self._decomp.decompress(raw)
+        if size < 0:
+            size = len(self._pending)
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[: len(data)] = data
+        return len(data)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SimulatedBoard(object):
+    """A MicroPython board on a pseudo-terminal.
+
+    `baudrate` limits the link speed (None for unlimited), `latency` is added
+    to every transfer from the host and `rx_buffer` bounds the UART receive
+    buffer, dropping what doesn't fit like real hardware does. `mem_free`
+    caps the code size an exec can take. The remaining flags turn firmware
+    features (raw paste, deflate, crc32) on and off. `max_baudrate` is the
+    fastest rate the simulated adapter carries without corrupting data, and
+    `flash_rate` how many bytes per second file writes take (None for
+    instant writes). `error_rate` is the chance of every byte read by running
+    code (like an upload agent's stdin) arriving with a flipped bit, `seed`
+    makes those errors repeatable.
+    """
+
+    def __init__(
+        self,
+        root=None,
+        baudrate=None,
+        latency=0.0,
+        mem_free=110000,
+        rx_buffer=None,
+        raw_paste=True,
+        raw_paste_window=128,
+        has_deflate=True,
+        has_crc32=True,
+        boot_delay=0.05,
+        platform="esp32",
+        mpy_version=6,
+        mpy_sub_version=2,
+        max_baudrate=None,
+        flash_rate=None,
+        error_rate=0.0,
+        seed=None,
+    ):
+        self.root = root
+        self._own_root = root is None
+        self.baudrate = baudrate
+        self.device_baudrate = baudrate
+        self.latency = latency
+        self.mem_free = mem_free
+        self.raw_paste = raw_paste
+        self.raw_paste_window = raw_paste_window
+        self.has_deflate = has_deflate
+        self.has_crc32 = has_crc32
+        self.boot_delay = boot_delay
+        self.platform = platform
+        self.mpy_version = mpy_version
+        self.mpy_sub_version = mpy_sub_version
+        self.max_baudrate = max_baudrate
+        self.flash_rate = flash_rate
+        self.error_rate = error_rate
+        self.bit_errors = 0
+        self._random = random.Random(seed)
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.execs = 0
+        # Times the device answered after the host sent it something.
+        self.round_trips = 0
+        self._awaiting_reply = False
+        self._rx = _RxStream(rx_buffer)
+        self._running = False
+        self._executing = False
+        self._kbd_intr = 3
+        self._device_thread = None
+        self._globals = None
+        self._master = None
+        self._slave = None
+        self._write_lock = threading.Lock()
+
+    # Lifecycle
+
+    @property
+    def port(self):
+        return os.ttyname(self._slave)
+
+    def start(self):
+        if self.root is None:
+            self.root = tempfile.mkdtemp(prefix="sim_board_")
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self._running = True
+        self._reset_globals()
+        self._mode = "friendly"
+        threading.Thread(target=self._reader, daemon=True).start()
+        self._device_thread = threading.Thread(target=self._device, daemon=True)
+        self._device_thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._rx.close()
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        if self._own_root and self.root:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def rx_overruns(self):
+        return self._rx.overruns
+
+    def counters(self):
+        """Snapshot of the traffic counters, for diffing around an operation."""
+        return {
+            "bytes_received": self.bytes_received,
+            "bytes_sent": self.bytes_sent,
+            "execs": self.execs,
+            "round_trips": self.round_trips,
+            "rx_overruns": self.rx_overruns,
+            "bit_errors": self.bit_errors,
+        }
+
+    # Link simulation
+
+    def _host_baudrate(self):
+        try:
+            speed = termios.tcgetattr(self._slave)[5]
+        except (termios.error, OSError):
+            return None
+        return TERMIOS_BAUD_RATES.get(speed)
+
+    def _link_ok(self):
+        if self.device_baudrate is None:
+            return True
+        if self.max_baudrate and self.device_baudrate > self.max_baudrate:
+            # Faster than the adapter/cable can carry reliably.
+            return False
+        host = self._host_baudrate()
+        return host is None or host == self.device_baudrate
+
+    def _line_delay(self, size):
+        if self.device_baudrate:
+            return size * 10.0 / self.device_baudrate
+        return 0.0
+
+    def _reader(self):
+        while self._running:
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                break
+            if not data:
+                break
+            if self.latency:
+                time.sleep(self.latency)
+            delay = self._line_delay(len(data))
+            if delay:
+                time.sleep(delay)
+            if not self._link_ok():
+                # A baud mismatch turns the incoming bytes into framing errors.
+                data = b"\x00" * (len(data) // 2)
+            elif self.error_rate and self._executing:
+                data = self._add_noise(data)
+            self.bytes_received += len(data)
+            if self._executing and self._kbd_intr >= 0 and b"\x03" in data:
+                data = data.replace(b"\x03", b"")
+                self._interrupt()
+            self._awaiting_reply = True
+            self._rx.feed(data, grace=delay or RX_GRACE)
+
+    def _add_noise(self, data):
+        data = bytearray(data)
+        for i in range(len(data)):
+            if self._random.random() < self.error_rate:
+                data[i] ^= 1 << self._random.randrange(8)
+                self.bit_errors += 1
+        return bytes(data)
+
+    def _emit(self, data):
+        if not data:
+            return
+        with self._write_lock:
+            self.bytes_sent += len(data)
+            if self._awaiting_reply:
+                self._awaiting_reply = False
+                self.round_trips += 1
+            delay = self._line_delay(len(data))
+            if delay:
+                time.sleep(delay)
+            if not self._link_ok():
+                data = b"\xff" * len(data)
+            try:
+                os.write(self._master, data)
+            except OSError:
+                pass
+
+    def _interrupt(self):
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(
+            ctypes.c_ulong(self._device_thread.ident),
+            ctypes.py_object(KeyboardInterrupt),
+        )
+
+    def _check_alive(self):
+        if not self._running:
+            raise SystemExit
+
+    # REPL state machine
+
+    def _device(self):
+        try:
+            self._boot(hard=True)
+            line = bytearray()
+            while self._running:
+                c = self._rx.read(1)
+                if not c:
+                    continue
+                try:
+                    if self._mode == "raw":
+                        line = self._raw_char(c, line)
+                    else:
+                        line = self._friendly_char(c, line)
+                except KeyboardInterrupt:
+                    line = bytearray()
+                except _HardReset:
+                    line = bytearray()
+                    self._boot(hard=True)
+        except SystemExit:
+            pass
+
+    def _boot(self, hard=False):
+        self._reset_globals()
+        if hard:
+            time.sleep(self.boot_delay)
+            self.device_baudrate = self.baudrate
+            self._mode = "friendly"
+            self._emit(b"\r\n" + BANNER + b">>> ")
+        else:
+            self._emit(b"MPY: soft reboot\r\n")
+            if self._mode == "raw":
+                self._emit(RAW_REPL_BANNER)
+            else:
+                self._emit(BANNER + b">>> ")
+
+    def _friendly_char(self, c, line):
+        if c == b"\x01":
+            self._mode = "raw"
+            self._emit(b"\r\n" + RAW_REPL_BANNER)
+            return bytearray()
+        if c == b"\x02":
+            self._emit(b"\r\n" + BANNER + b">>> ")
+            return bytearray()
+        if c == b"\x03":
+            self._emit(b"\r\n>>> ")
+            return bytearray()
+        if c == b"\x04":
+            self._emit(b"\r\n")
+            self._boot()
+            return bytearray()
+        if c in (b"\r", b"\n"):
+            self._emit(b"\r\n")
+            if line.strip():
+                self._emit(self._execute(bytes(line)))
+            self._emit(b">>> ")
+            return bytearray()
+        self._emit(c)
+        line += c
+        return line
+
+    def _raw_char(self, c, line):
+        if c == b"\x01":
+            self._emit(RAW_REPL_BANNER)
+            return bytearray()
+        if c == b"\x02":
+            self._mode = "friendly"
+            self._emit(b"\r\n" + BANNER + b">>> ")
+            return bytearray()
+        if c == b"\x03":
+            return bytearray()
+        if c == b"\x05" and not line and self.raw_paste:
+            if self._rx.read(2) == b"A\x01":
+                self._emit(b"R\x01" + struct.pack("<H", self.raw_paste_window))
+                self._raw_paste()
+            return bytearray()
+        if c == b"\x04":
+            self._emit(b"OK")
+            if not line:
+                self._emit(b"\r\n")
+                self._boot()
+                return bytearray()
+            self._run_raw(bytes(line))
+            return bytearray()
+        line += c
+        return line
+
+    def _raw_paste(self):
+        code = bytearray()
+        remaining = self.raw_paste_window
+        while True:
+            c = self._rx.read(1)
+            if not c:
+                return
+            if c == b"\x04":
+                break
+            if c == b"\x03":
+                # MicroPython's paste reader raises KeyboardInterrupt.
+                self._emit(b"\x04\x04KeyboardInterrupt: \r\n\x04>")
+                return
+            code += c
+            remaining -= 1
+            if remaining == 0:
+                self._emit(b"\x01")
+                remaining = self.raw_paste_window
+        self._emit(b"\x04")
+        self._run_raw(bytes(code))
+
+    def _run_raw(self, code):
+        self.execs += 1
+        err = self._execute(code)
+        self._emit(b"\x04" + err + b"\x04>")
+
+    # Code execution sandbox
+
+    def _execute(self, code):
+        """Run code, streaming stdout as it is produced; returns the traceback."""
+        err = b""
+        try:
+            if len(code) * 2 > self.mem_free:
+                raise MemoryError("memory allocation failed, allocating %d bytes" % len(code))
+            compiled = compile(code, "<stdin>", "exec")
+            self._executing = True
+            try:
+                exec(compiled, self._globals)
+            finally:
+                self._executing = False
+        except (_HardReset, SystemExit):
+            raise
+        except BaseException as ex:
+            err = self._format_exception(ex)
+        return err
+
+    def _format_exception(self, ex):
+        lines = ["Traceback (most recent call last):"]
+        for frame in traceback.extract_tb(ex.__traceback__):
+            if frame.filename == "<stdin>":
+                lines.append('  File "<stdin>", line {}, in {}'.format(frame.lineno, frame.name))
+        name = type(ex).__name__
+        if isinstance(ex, OSError):
+            # MicroPython has no OSError subclasses like FileNotFoundError.
+            name = "OSError"
+        if isinstance(ex, OSError) and ex.errno is not None:
+            code = errno.errorcode.get(ex.errno, str(ex.errno))
+            lines.append("{}: [Errno {}] {}".format(name, ex.errno, code))
+        elif str(ex):
+            lines.append("{}: {}".format(name, ex))
+        else:
+            lines.append(name)
+        return ("\r\n".join(lines) + "\r\n").encode("utf-8")
+
+    def _reset_globals(self):
+        allowed = {name: getattr(builtins, name) for name in SAFE_BUILTINS}
+        allowed["__import__"] = self._import
+        allowed["open"] = self._open
+        allowed["print"] = self._print
+        self._globals = {"__builtins__": allowed, "__name__": "__main__"}
+        self._kbd_intr = 3
+        self._modules = self._build_modules()
+
+    def _print(self, *args, sep=" ", end="\n", file=None):
+        (file or self._modules["sys"].stdout).write(sep.join(str(a) for a in args) + end)
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if name.startswith("u") and name[1:] in self._modules:
+            name = name[1:]
+        try:
+            return self._modules[name]
+        except KeyError:
+            raise ImportError("no module named '{}'".format(name))
+
+    def _path(self, path):
+        cwd = self._cwd
+        full = os.path.normpath(os.path.join(cwd, str(path)))
+        if not full.startswith("/"):
+            full = "/" + full
+        return os.path.join(self.root, full.lstrip("/"))
+
+    def _open(self, path, mode="r", *args):
+        local = self._path(path)
+        if os.path.isdir(local):
+            raise OSError(errno.EISDIR, "")
+        try:
+            f = open(local, mode)
+        except FileNotFoundError:
+            raise OSError(errno.ENOENT, "")
+        if self.flash_rate and any(c in mode for c in "wa+"):
+            return _FlashFile(f, self.flash_rate)
+        return f
+
+    def _build_modules(self):
+        board = self
+        self._cwd = "/"
+
+        def mkdir(path):
+            local = board._path(path)
+            if os.path.exists(local):
+                raise OSError(errno.EEXIST, "")
+            try:
+                os.mkdir(local)
+            except FileNotFoundError:
+                raise OSError(errno.ENOENT, "")
+
+        def wrap_oserror(func):
+            def wrapper(*args):
+                try:
+                    return func(*args)
+                except FileNotFoundError:
+                    raise OSError(errno.ENOENT, "")
+                except FileExistsError:
+                    raise OSError(errno.EEXIST, "")
+                except IsADirectoryError:
+                    raise OSError(errno.EISDIR, "")
+                except OSError as ex:
+                    raise OSError(ex.errno, "")
+
+            return wrapper
+
+        def stat(path):
+            st = os.stat(board._path(path))
+            mode = 0x4000 if os.path.isdir(board._path(path)) else 0x8000
+            return (mode, 0, 0, 0, 0, 0, st.st_size, 0, 0, 0)
+
+        def ilistdir(path="."):
+            local = board._path(path)
+            for name in sorted(os.listdir(local)):
+                kind = 0x4000 if os.path.isdir(os.path.join(local, name)) else 0x8000
+                size = 0 if kind == 0x4000 else os.path.getsize(os.path.join(local, name))
+                yield (name, kind, 0, size)
+
+        def chdir(path):
+            local = board._path(path)
+            if not os.path.isdir(local):
+                raise OSError(errno.ENOENT, "")
+            relative = os.path.relpath(local, board.root)
+            board._cwd = "/" if relative == "." else "/" + relative
+
+        def rename(old, new):
+            os.replace(board._path(old), board._path(new))
+
+        def statvfs(path="/"):
+            return (4096, 4096, 512, 256, 256, 0, 0, 0, 0, 255)
+
+        os_module = types.SimpleNamespace(
+            mkdir=mkdir,
+            remove=wrap_oserror(lambda p: os.remove(board._path(p))),
+            rmdir=wrap_oserror(lambda p: os.rmdir(board._path(p))),
+            rename=wrap_oserror(rename),
+            stat=wrap_oserror(stat),
+            listdir=wrap_oserror(lambda p=".": sorted(os.listdir(board._path(p)))),
+            ilistdir=wrap_oserror(ilistdir),
+            getcwd=lambda: board._cwd,
+            chdir=wrap_oserror(chdir),
+            statvfs=statvfs,
+            sync=lambda: None,
+            uname=lambda: (board.platform, board.platform, "1.22.0", "v1.22.0", "ESP32 module"),
+        )
+
+        stdin = _Stdin(board)
+        stdout = _Stdout(board)
+        sys_module = types.SimpleNamespace(
+            stdin=stdin,
+            stdout=stdout,
+            stderr=stdout,
+            platform=board.platform,
+            implementation=types.SimpleNamespace(
+                name="micropython",
+                version=(1, 22, 0, ""),
+                _mpy=board.mpy_version
+                | (board.mpy_sub_version << 8)
+                | ((9 if board.platform == "esp8266" else 10) << 10),
+            ),
+            version="3.4.0; MicroPython v1.22.0",
+            maxsize=2**31 - 1,
+            modules={},
+            exit=lambda *args: None,
+        )
+
+        gc_module = types.SimpleNamespace(
+            collect=lambda: None,
+            mem_free=lambda: board.mem_free,
+            mem_alloc=lambda: 20000,
+        )
+
+        def kbd_intr(char):
+            board._kbd_intr = char
+
+        micropython_module = types.SimpleNamespace(
+            kbd_intr=kbd_intr,
+            const=lambda value: value,
+            mem_info=lambda *args: None,
+        )
+
+        class UART(object):
+            def __init__(self, uart_id, baudrate=115200, **kwargs):
+                self.init(baudrate, **kwargs)
+
+            def init(self, baudrate=115200, **kwargs):
+                if self is not None and baudrate:
+                    # Let pending output drain at the old rate before switching.
+                    time.sleep(0.01)
+                    board.device_baudrate = baudrate
+
+        def reset():
+            raise _HardReset()
+
+        machine_module = types.SimpleNamespace(
+            UART=UART,
+            reset=reset,
+            soft_reset=lambda: None,
+            unique_id=lambda: b"\x24\x0a\xc4\x00\x00\x01",
+            freq=lambda *args: 240000000,
+        )
+
+        def sleep(seconds):
+            time.sleep(seconds)
+
+        time_module = types.SimpleNamespace(
+            sleep=sleep,
+            sleep_ms=lambda ms: time.sleep(ms / 1000.0),
+            sleep_us=lambda us: time.sleep(us / 1000000.0),
+            ticks_ms=lambda: int(time.monotonic() * 1000) & 0x3FFFFFFF,
+            ticks_us=lambda: int(time.monotonic() * 1000000) & 0x3FFFFFFF,
+            ticks_diff=lambda a, b: a - b,
+            ticks_add=lambda a, b: a + b,
+            time=time.time,
+        )
+
+        binascii_module = types.SimpleNamespace(
+            a2b_base64=binascii.a2b_base64,
+            b2a_base64=binascii.b2a_base64,
+            hexlify=binascii.hexlify,
+            unhexlify=binascii.unhexlify,
+        )
+        if board.has_crc32:
+            binascii_module.crc32 = binascii.crc32
+
+        hashlib_module = types.SimpleNamespace(
+            sha256=hashlib.sha256,
+            sha1=hashlib.sha1,
+        )
+
+        modules = {
+            "os": os_module,
+            "sys": sys_module,
+            "gc": gc_module,
+            "micropython": micropython_module,
+            "machine": machine_module,
+            "time": time_module,
+            "binascii": binascii_module,
+            "hashlib": hashlib_module,
+            "struct": struct,
+            "json": json,
+            "errno": types.SimpleNamespace(
+                EEXIST=errno.EEXIST, ENOENT=errno.ENOENT, errorcode=errno.errorcode
+            ),
+            "io": types.SimpleNamespace(BytesIO=io.BytesIO, StringIO=io.StringIO),
+            "select": types.SimpleNamespace(poll=_Poll(board), POLLIN=1),
+        }
+        if board.has_deflate:
+            modules["deflate"] = types.SimpleNamespace(
+                DeflateIO=_DeflateIO, AUTO=0, RAW=1, ZLIB=2, GZIP=3
+            )
+        return modules
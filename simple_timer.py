@@ -4,21 +4,22 @@ class SimpleTimer:
     def __init__(self):
         self.start_time = None
         self.end_time = None
-        self.result = None
+        # Not "result", which would hide the result() method.
+        self.elapsed = None
     
     def start(self):
-        self.result = None
+        self.elapsed = None
         self.start_time = time.time()
         return self.start_time
 
     def end(self):
         self.end_time = time.time()
-        self.result = self.end_time - self.start_time
+        self.elapsed = self.end_time - self.start_time
         return self.end_time
 
     def result(self):
-        return self.result
+        return self.elapsed
 
     def end_with_results(self):
         self.end()
-        return self.result
\ No newline at end of file
+        return self.elapsed
\ No newline at end of file
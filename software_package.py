@@ -0,0 +1,125 @@
+import hashlib
+import io
+from zipfile import ZipFile
+
+READ_SIZE = 16384
+
+
+class PackageFile(object):
+    """One file of a software package, read on demand.
+
+    `opener` returns a fresh binary stream of the file's data every time it
+    is called, so the data is only read when it is about to be sent.
+    """
+
+    def __init__(self, path, size, opener):
+        self.path = path
+        self.size = size
+        self._opener = opener
+        self._sha256 = None
+
+    @classmethod
+    def from_bytes(cls, path, data, sha256=None):
+        entry = cls(path, len(data), lambda: io.BytesIO(data))
+        entry._sha256 = sha256
+        return entry
+
+    def open(self):
+        return self._opener()
+
+    def chunks(self, chunk_size=READ_SIZE, offset=0):
+        with self.open() as stream:
+            if offset:
+                stream.seek(offset)
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def read(self):
+        with self.open() as stream:
+            return stream.read()
+
+    def load(self):
+        """Read the whole file, remembering its hash for sha256()."""
+        data = self.read()
+        self._sha256 = hashlib.sha256(data).hexdigest()
+        return data
+
+    def sha256(self):
+        if self._sha256 is None:
+            h = hashlib.sha256()
+            for chunk in self.chunks():
+                h.update(chunk)
+            self._sha256 = h.hexdigest()
+        return self._sha256
+
+    def __repr__(self):
+        return "PackageFile({!r}, {})".format(self.path, self.size)
+
+
+def package_files(files):
+    """Normalize a {path: data} dict or an iterable of PackageFiles to a list."""
+    if isinstance(files, dict):
+        return [PackageFile.from_bytes(path, data) for path, data in files.items()]
+    return list(files)
+
+
+def parent_directories(paths):
+    """Every parent directory of `paths`, parents before children."""
+    directories = set()
+    for path in paths:
+        parts = path.strip("/").split("/")[:-1]
+        for i in range(1, len(parts) + 1):
+            directories.add("/" + "/".join(parts[:i]))
+    return sorted(directories, key=lambda directory: (directory.count("/"), directory))
+
+
+class SoftwarePackage(object):
+    """A software package zip, read member by member without extracting it.
+
+    The root of the zip maps to the root of the board's filesystem.
+    """
+
+    def __init__(self, software):
+        self._zf = ZipFile(software)
+        self._infos = [info for info in self._zf.infolist() if not info.is_dir()]
+
+    def close(self):
+        self._zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def version(self):
+        """The package version, taken from the zip comment (None if empty)."""
+        comment = self._zf.comment.decode("utf-8", "replace").strip()
+        return comment or None
+
+    @staticmethod
+    def board_path(name):
+        return "/" + name.replace("\\", "/").strip("/")
+
+    def files(self):
+        return [
+            PackageFile(
+                self.board_path(info.filename),
+                info.file_size,
+                lambda info=info: self._zf.open(info),
+            )
+            for info in self._infos
+        ]
+
+    def directories(self):
+        """Directories to create on the board, derived from the member names."""
+        paths = list()
+        for info in self._zf.infolist():
+            path = self.board_path(info.filename)
+            # Count explicit (possibly empty) directory entries as parents too.
+            paths.append(path + "/." if info.is_dir() else path)
+        return parent_directories(paths)
@@ -0,0 +1,93 @@
+import asyncio
+import sys
+import time
+
+import pytest
+
+import pyboard
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="SimulatedBoard needs a Linux pty"
+)
+
+
+@pytest.fixture
+def board():
+    from sim_board import SimulatedBoard
+
+    with SimulatedBoard(baudrate=115200) as board:
+        yield board
+
+
+def test_large_write_keeps_loop_responsive(board):
+    """A write far bigger than the pty buffer must wait on the loop, not spin."""
+
+    async def run():
+        pyb = await pyboard.AsyncPyboard.open(board.port, 115200)
+        try:
+            await pyb.enter_raw_repl()
+            gaps = list()
+            stop = asyncio.Event()
+
+            async def ticker():
+                last = time.perf_counter()
+                while not stop.is_set():
+                    await asyncio.sleep(0.005)
+                    now = time.perf_counter()
+                    gaps.append(now - last)
+                    last = now
+
+            task = asyncio.create_task(ticker())
+            start_cpu = time.process_time()
+            start = time.perf_counter()
+            # A comment line, the board keeps it as the command being received.
+            await pyb.write(b"#" + b"x" * 60 * 1024)
+            elapsed = time.perf_counter() - start
+            cpu = time.process_time() - start_cpu
+            stop.set()
+            await task
+            return elapsed, cpu, max(gaps)
+        finally:
+            pyb.close()
+
+    elapsed, cpu, longest_gap = asyncio.run(run())
+    # 60 KB at 115200 baud takes seconds on the wire.
+    assert elapsed > 1.0
+    assert longest_gap < 0.1
+    assert cpu < elapsed / 2
+
+
+def test_blocking_io_without_fd(board):
+    """Ports the loop can't watch block in an executor with real timeouts."""
+
+    async def run():
+        pyb = await pyboard.AsyncPyboard.open(board.port, 115200)
+        try:
+            # What a Windows port looks like: no fd for the event loop.
+            pyb._use_blocking_io()
+            await pyb.enter_raw_repl()
+            ticks = 0
+            stop = asyncio.Event()
+
+            async def ticker():
+                nonlocal ticks
+                while not stop.is_set():
+                    await asyncio.sleep(0.005)
+                    ticks += 1
+
+            task = asyncio.create_task(ticker())
+            start = time.perf_counter()
+            await pyb.write(b"#" + b"x" * 20 * 1024 + b"\n")
+            output = await pyb.exec_("print(sum(range(10)))")
+            elapsed = time.perf_counter() - start
+            stop.set()
+            await task
+            return pyb.serial.timeout, output, ticks, elapsed
+        finally:
+            pyb.close()
+
+    timeout, output, ticks, elapsed = asyncio.run(run())
+    assert timeout == pyboard.READ_TIMEOUT
+    assert output.strip() == b"45"
+    # The loop kept running while the executor waited on the port.
+    assert ticks > elapsed / 0.005 / 2
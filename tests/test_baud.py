@@ -0,0 +1,86 @@
+import sys
+import time
+
+import pytest
+
+import device_profiles
+import provisioning
+import pyboard
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="SimulatedBoard needs a Linux pty"
+)
+
+
+def refusing_uart(board, delay):
+    """Have the board's machine.UART fail like ESP32's REPL UART, after `delay`."""
+
+    def refuse(*args, **kwargs):
+        time.sleep(delay)
+        raise ValueError("UART(0) is disabled (dedicated to REPL)")
+
+    build = board._build_modules
+
+    def build_refusing():
+        modules = build()
+        modules["machine"].UART = refuse
+        return modules
+
+    board._build_modules = build_refusing
+
+
+def test_switch_baudrate():
+    from sim_board import SimulatedBoard
+
+    with SimulatedBoard(baudrate=115200) as board:
+        pyb = pyboard.Pyboard(board.port, 115200)
+        try:
+            pyb.enter_raw_repl()
+            assert pyb.switch_baudrate(921600)
+            assert pyb.serial.baudrate == 921600
+            assert pyb.eval("1 + 1") == b"2"
+        finally:
+            pyb.close()
+        assert board.device_baudrate == 921600
+
+
+# A slow refusal arrives after the host moved to the new rate.
+@pytest.mark.parametrize("delay", [0, 0.08, 0.6])
+def test_switch_baudrate_refused(delay):
+    """A board that can't reconfigure its REPL UART stays usable at the old rate."""
+    from sim_board import SimulatedBoard
+
+    with SimulatedBoard(baudrate=115200) as board:
+        refusing_uart(board, delay)
+        pyb = pyboard.Pyboard(board.port, 115200)
+        try:
+            pyb.enter_raw_repl()
+            assert not pyb.switch_baudrate(921600)
+            assert pyb.serial.baudrate == 115200
+            assert pyb.eval("1 + 1") == b"2"
+        finally:
+            pyb.close()
+
+
+class LostBoard(object):
+    """Stands in for a Pyboard whose baud switch loses the board."""
+
+    def __init__(self):
+        self.reentered = False
+
+    def switch_baudrate(self, baudrate):
+        raise pyboard.PyboardError(f"lost the board switching to {baudrate} baud")
+
+    def enter_raw_repl(self):
+        self.reentered = True
+
+
+def test_negotiation_falls_back_when_the_switch_fails(tmp_path):
+    profiles = device_profiles.ProfileCache(str(tmp_path / "profiles.json"))
+    pyb = LostBoard()
+    messages = list()
+    rate = provisioning.negotiate_repl_baud(pyb, "sim", profiles, messages.append)
+    assert rate == provisioning.REPL_BAUD_RATE
+    assert pyb.reentered
+    assert profiles.get("sim")["repl_baud"] == provisioning.REPL_BAUD_RATE
+    assert messages[-1] == f"Uploading at {provisioning.REPL_BAUD_RATE} baud.\n"
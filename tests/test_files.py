@@ -0,0 +1,136 @@
+import contextlib
+import io
+import os
+import random
+import sys
+
+import pytest
+
+import pyboard
+import pyb_files
+from software_package import PackageFile
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="SimulatedBoard needs a Linux pty"
+)
+
+
+@contextlib.contextmanager
+def files_on(board):
+    pyb = pyboard.Pyboard(board.port, board.baudrate)
+    try:
+        pyb.enter_raw_repl()
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield pyb_files.Files(pyb, keep_raw_repl=True)
+    finally:
+        pyb.close()
+
+
+def board_file(board, path):
+    with open(os.path.join(board.root, path.lstrip("/")), "rb") as f:
+        return f.read()
+
+
+def test_put_falls_back_without_raw_paste():
+    """Firmware without raw-paste mode gets its commands the plain raw REPL way."""
+    from sim_board import SimulatedBoard
+
+    data = random.Random(1).randbytes(5000)
+    with SimulatedBoard(baudrate=921600, raw_paste=False) as board:
+        with files_on(board) as fh:
+            fh.put({"/a.bin": data})
+            assert not fh._files._pyboard.use_raw_paste
+        assert board_file(board, "/a.bin") == data
+
+
+def test_mkdir_reports_created_and_existing():
+    from sim_board import SimulatedBoard
+
+    with SimulatedBoard(baudrate=921600) as board:
+        with files_on(board) as fh:
+            first = fh.mkdir(directory_list=["/lib", "/lib/a"])
+            second = fh.mkdir(directory_list=["/lib", "/lib/b"])
+            with pytest.raises(pyb_files.DirectoryExistsError):
+                fh.mkdir("/lib/a", exists_okay=False)
+    assert first == {"created": ["/lib", "/lib/a"], "existing": []}
+    assert second == {"created": ["/lib/b"], "existing": ["/lib"]}
+
+
+def test_sync_uploads_only_changes_and_deletes_stale():
+    from sim_board import SimulatedBoard
+
+    with SimulatedBoard(baudrate=921600) as board:
+        with files_on(board) as fh:
+            fh.put({"/boot.py": b"# boot\n", "/a.py": b"a = 1\n", "/old.py": b"x\n"})
+            report = fh.sync(
+                {"/a.py": b"a = 2\n", "/new.py": b"n = 1\n"}, delete=True
+            )
+            again = fh.sync({"/a.py": b"a = 2\n", "/new.py": b"n = 1\n"})
+        assert sorted(os.listdir(board.root)) == ["a.py", "boot.py", "new.py"]
+        assert board_file(board, "/a.py") == b"a = 2\n"
+    assert sorted(report["uploaded"]) == ["/a.py", "/new.py"]
+    assert report["deleted"] == ["/old.py"]
+    assert again["uploaded"] == []
+    assert sorted(again["unchanged"]) == ["/a.py", "/new.py"]
+
+
+def test_verify_reports_what_differs():
+    from sim_board import SimulatedBoard
+
+    package = {f"/f{i}.bin": bytes([i]) * 100 for i in range(4)}
+    with SimulatedBoard(baudrate=921600) as board:
+        with files_on(board) as fh:
+            fh.put(package)
+            assert fh.verify(package) == {}
+            with open(os.path.join(board.root, "f1.bin"), "wb") as f:
+                f.write(b"\xff" * 100)
+            with open(os.path.join(board.root, "f2.bin"), "wb") as f:
+                f.write(b"\x02" * 50)
+            os.remove(os.path.join(board.root, "f3.bin"))
+            mismatches = fh.verify(package)
+    assert mismatches == {"/f1.bin": "hash", "/f2.bin": "size", "/f3.bin": "missing"}
+
+
+def test_manifest_diff_against_a_new_package():
+    from sim_board import SimulatedBoard
+
+    with SimulatedBoard(baudrate=921600) as board:
+        with files_on(board) as fh:
+            assert fh.read_manifest() is None
+            fh.put(
+                {"/a.py": b"a = 1\n", "/b.py": b"b = 1\n", "/c.py": b"c = 1\n"},
+                manifest=True,
+                version="1.0",
+                package="app.zip",
+            )
+            installed = fh.read_manifest()
+            diff = fh.diff_manifest(
+                {"/a.py": b"a = 1\n", "/b.py": b"b = 2\n", "/d.py": b"d = 1\n"}
+            )
+    assert (installed.version, installed.package) == ("1.0", "app.zip")
+    assert diff == {
+        "added": ["/d.py"],
+        "changed": ["/b.py"],
+        "removed": ["/c.py"],
+        "unchanged": ["/a.py"],
+    }
+
+
+@pytest.mark.parametrize("has_deflate", [True, False])
+def test_compressed_put(has_deflate):
+    """Compressed files are inflated on the board, or sent as they are if it can't."""
+    from sim_board import SimulatedBoard
+
+    text = b"".join(b"line %d of some python source\n" % (i % 50) for i in range(2000))
+    package = {"/big.py": text, "/small.py": b"x = 1\n"}
+    with SimulatedBoard(baudrate=921600, has_deflate=has_deflate) as board:
+        with files_on(board) as fh:
+            fh.put(package, transport="pipeline", compress=True)
+        assert sorted(os.listdir(board.root)) == ["big.py", "small.py"]
+        for path, data in package.items():
+            assert board_file(board, path) == data
+        sent = board.counters()["bytes_received"]
+    if has_deflate:
+        assert sent < len(text) / 2
+    else:
+        assert sent > len(text)
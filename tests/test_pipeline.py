@@ -0,0 +1,40 @@
+import contextlib
+import io
+import os
+import random
+import sys
+
+import pytest
+
+import pyboard
+import pyb_files
+from software_package import PackageFile
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="SimulatedBoard needs a Linux pty"
+)
+
+
+def test_pipeline_recovers_from_corrupted_frames():
+    """Frames hit by bit errors are sent again until every file arrives intact."""
+    from sim_board import SimulatedBoard
+
+    rng = random.Random(1)
+    files = [
+        PackageFile.from_bytes(f"/f{i}.bin", rng.randbytes(rng.randrange(2000, 20000)))
+        for i in range(6)
+    ]
+    with SimulatedBoard(baudrate=921600, error_rate=3e-4, seed=1) as board:
+        pyb = pyboard.Pyboard(board.port, 921600)
+        try:
+            pyb.enter_raw_repl()
+            fh = pyb_files.Files(pyb, keep_raw_repl=True)
+            # Let the upload pick its RAM-derived chunk size, as installs do.
+            with contextlib.redirect_stdout(io.StringIO()):
+                fh.put(files, transport="pipeline", manifest=False)
+        finally:
+            pyb.close()
+        assert board.counters()["bit_errors"] > 0
+        for entry in files:
+            with open(os.path.join(board.root, entry.path.lstrip("/")), "rb") as f:
+                assert f.read() == entry.read()
@@ -0,0 +1,147 @@
+import contextlib
+import io
+import os
+import random
+import re
+import sys
+
+import pytest
+
+import pyboard
+import pyb_files
+from software_package import PackageFile
+from transfer_journal import TransferJournal
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="SimulatedBoard needs a Linux pty"
+)
+
+
+def package(compressible=False):
+    rng = random.Random(1)
+    if compressible:
+        words = [b"alpha", b"beta", b"gamma", b"delta"]
+        big = b" ".join(rng.choice(words) for _ in range(20000))
+    else:
+        big = rng.randbytes(20000)
+    return [
+        PackageFile.from_bytes("/a.py", b"print(1)\n" * 50),
+        PackageFile.from_bytes("/big.bin", big),
+        PackageFile.from_bytes("/c.py", b"x = 2\n" * 40),
+    ]
+
+
+def assert_uploaded(board, files):
+    for entry in files:
+        with open(os.path.join(board.root, entry.path.lstrip("/")), "rb") as f:
+            assert f.read() == entry.read(), entry.path
+    assert sorted(os.listdir(board.root)) == ["a.py", "big.bin", "c.py"]
+
+
+def test_exec_transport_resumes_in_same_session(tmp_path):
+    """A link error mid-upload is retried in the same raw REPL session."""
+    from sim_board import SimulatedBoard
+
+    files = package()
+    journal_file = str(tmp_path / "journal.json")
+    with SimulatedBoard(baudrate=115200) as board:
+        pyb = pyboard.Pyboard(board.port, 115200)
+        try:
+            async_pyboard = pyb.async_pyboard
+            write = async_pyboard.write
+            writes = 0
+
+            async def failing_write(data):
+                nonlocal writes
+                writes += 1
+                if writes == 40:
+                    raise pyboard.PyboardError("injected link error")
+                await write(data)
+
+            async_pyboard.write = failing_write
+            pyb.enter_raw_repl()
+            fh = pyb_files.Files(pyb, keep_raw_repl=True)
+            journal = TransferJournal("board", journal_file, interval=0)
+            with contextlib.redirect_stdout(io.StringIO()):
+                with pytest.raises(pyboard.PyboardError):
+                    fh.put(
+                        files,
+                        transport="exec",
+                        chunk_size=1024,
+                        journal=journal,
+                        manifest=False,
+                    )
+            assert journal.partial["offset"] > 0
+            sent = board.counters()["bytes_received"]
+            journal = TransferJournal("board", journal_file, interval=0)
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                fh.put(
+                    files,
+                    transport="exec",
+                    chunk_size=1024,
+                    journal=journal,
+                    manifest=False,
+                )
+        finally:
+            pyb.close()
+        assert '"/a.py"  already on the board' in out.getvalue()
+        # Only the rest of big.bin (base64 and exec overhead included) and c.py.
+        assert board.counters()["bytes_received"] - sent < 30000
+        assert_uploaded(board, files)
+
+
+class InterruptedOutput(io.StringIO):
+    """Stdout that hits Ctrl+C once big.bin's progress passes 8 KiB."""
+
+    def write(self, text):
+        progress = re.search(r'"/big\.bin[^"]*"  >>>  (\d+) of', text)
+        if progress and int(progress.group(1)) >= 8192:
+            raise KeyboardInterrupt
+        return super().write(text)
+
+
+@pytest.mark.parametrize(
+    "transport, compress",
+    [("exec", False), ("agent", False), ("pipeline", False), ("pipeline", True)],
+)
+def test_journal_resumes_after_replug(tmp_path, transport, compress):
+    """An interrupted put picks up where it stopped on a freshly opened board."""
+    from sim_board import SimulatedBoard
+
+    files = package(compressible=compress)
+    root = tmp_path / "board"
+    root.mkdir()
+    journal_file = str(tmp_path / "journal.json")
+
+    def put(stdout):
+        with SimulatedBoard(root=str(root), baudrate=115200) as board:
+            pyb = pyboard.Pyboard(board.port, 115200)
+            try:
+                pyb.enter_raw_repl()
+                fh = pyb_files.Files(pyb, keep_raw_repl=True)
+                journal = TransferJournal("board", journal_file, interval=0)
+                with contextlib.redirect_stdout(stdout):
+                    fh.put(
+                        files,
+                        transport=transport,
+                        compress=compress,
+                        chunk_size=1024,
+                        journal=journal,
+                    )
+            finally:
+                pyb.close()
+        return journal
+
+    with pytest.raises(KeyboardInterrupt):
+        put(InterruptedOutput())
+    out = io.StringIO()
+    journal = put(out)
+    with open(root / "big.bin", "rb") as f:
+        assert f.read() == files[1].read()
+    assert sorted(os.listdir(root)) == ["a.py", "big.bin", "c.py"]
+    assert '"/a.py"  already on the board' in out.getvalue()
+    # big.bin went on from where it stopped.
+    assert re.search(r'"/big\.bin[^"]*"  >>>  0 of', out.getvalue()) is None
+    # A complete put leaves nothing to resume.
+    assert journal.files == {} and journal.partial is None
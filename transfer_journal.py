@@ -0,0 +1,114 @@
+"""
+Progress of uploads, kept on the host so an interrupted upload can resume.
+
+While Files.put uploads to a board it records every file it finished sending
+and how far it got into the file it is sending. The journal is only a hint:
+on the next upload the board reports the size and hash of what it really
+has, and only what matches is skipped.
+
+    journal = TransferJournal(adapter_key(port))
+    fh.put(files, journal=journal)   # resumes what an earlier put left
+"""
+import json
+import os
+import threading
+import time
+
+JOURNAL_FILE = "transfer_journal.json"
+
+# The offset into the file being sent is saved at most this often (seconds).
+JOURNAL_INTERVAL = 1.0
+
+
+class TransferJournal(object):
+    """The upload progress of one board, kept in a JSON file under `key`.
+
+    `files` maps the device paths sent completely to their (size, sha256),
+    `partial` describes the file being sent when the upload stopped: a dict
+    of its "path", the "temp" path it is written to, its "size" and "sha256",
+    and the "offset" sent so far. Like device_profiles.ProfileCache, every
+    save re-reads the file, so the journals of other boards are kept.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, key, path=JOURNAL_FILE, interval=JOURNAL_INTERVAL):
+        self.key = key
+        self.path = path
+        self.interval = interval
+        self.files = dict()
+        self.partial = None
+        self._saved = 0.0
+        self.load()
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def _write(self, journals):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(journals, f, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+    def load(self):
+        with self._lock:
+            entry = self._read().get(self.key, dict())
+        self.files = {path: tuple(value) for path, value in entry.get("files", {}).items()}
+        self.partial = entry.get("partial")
+
+    def save(self):
+        with self._lock:
+            journals = self._read()
+            journals[self.key] = {
+                "files": {path: list(value) for path, value in self.files.items()},
+                "partial": self.partial,
+            }
+            self._write(journals)
+        self._saved = time.monotonic()
+
+    def clear(self):
+        """Forget the board's progress, after a complete upload."""
+        self.files = dict()
+        self.partial = None
+        with self._lock:
+            journals = self._read()
+            if journals.pop(self.key, None) is not None:
+                self._write(journals)
+
+    def paths(self):
+        """The device paths worth checking on the board before resuming."""
+        paths = list(self.files)
+        if self.partial is not None:
+            paths.append(self.partial["temp"])
+        return paths
+
+    def started(self, path, temp, size, sha256, offset=0):
+        """`path` is being written to `temp`, from `offset` on."""
+        self.partial = {
+            "path": path,
+            "temp": temp,
+            "size": size,
+            "sha256": sha256,
+            "offset": offset,
+        }
+        self.save()
+
+    def progress(self, offset):
+        if self.partial is None:
+            return
+        self.partial["offset"] = offset
+        if time.monotonic() - self._saved >= self.interval:
+            self.save()
+
+    def done(self, path, size, sha256):
+        self.files[path] = (size, sha256)
+        if self.partial is not None and self.partial["path"] == path:
+            self.partial = None
+        self.save()
+
+    def __repr__(self):
+        return "TransferJournal({!r}, {} files)".format(self.key, len(self.files))